@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+    Compiles a synthetic template (see odtgen.py) with a new Renderer, as
+    a new worker process does, from the ODT template and from the file
+    saved by CompiledTemplate.save.
+
+    Usage: python benchmarks/cold_start.py [name=value ...]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import odtgen
+from secretary import Renderer
+
+
+def best(function, repeat=5):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+
+    return min(times)
+
+
+def main(scale):
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, 'template.odt')
+        with open(template, 'wb') as output:
+            output.write(odtgen.template(**scale))
+
+        saved = os.path.join(directory, 'template.secretary')
+        Renderer().compile(template).save(saved)
+
+        print('%-10s %8.1fms' % (
+            'template', best(lambda: Renderer().compile(template)) * 1000))
+        print('%-10s %8.1fms' % (
+            'saved', best(lambda: Renderer().load_compiled(saved)) * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(odtgen.parse_scale(sys.argv[1:] or ['fields=400', 'styles=5000']))
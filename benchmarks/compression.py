@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+    Compares the compression policies of rendered documents: time spent
+    packing documents and their size. Rendered documents get a few big SVG
+    pictures, as the image filter would add, so there are several members
+    to compress in parallel.
+
+    Usage: python benchmarks/compression.py [rows]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from secretary import Renderer, COMPRESSION_NONE, COMPRESSION_FAST, \
+    COMPRESSION_DEFAULT, COMPRESSION_BEST
+
+
+TEMPLATE = os.path.join(os.path.dirname(__file__), '..', 'simple_template.odt')
+
+POLICIES = [
+    ('none', COMPRESSION_NONE),
+    ('fast', COMPRESSION_FAST),
+    ('default', COMPRESSION_DEFAULT),
+    ('best', COMPRESSION_BEST),
+]
+
+
+def svg_picture(index, size=512 * 1024):
+    circle = '<circle cx="%d" cy="%d" r="%d" fill="#%06x"/>\n'
+    circles = ''.join(circle % (i % 640, i % 480, i % 50, i * 7919 % 0xffffff)
+                      for i in range(index, index + size // 50))
+    return ('<svg xmlns="http://www.w3.org/2000/svg">%s</svg>' % circles
+            ).encode('utf-8')
+
+
+def main(rows):
+    countries = [{'country': 'Country %d' % i, 'capital': 'Capital %d' % i}
+                 for i in range(rows)]
+
+    for workers in (0, 4):
+        for name, policy in POLICIES:
+            engine = Renderer(compression=policy, compression_workers=workers)
+            render_context = engine._render(TEMPLATE, countries=countries)
+            files = render_context.files
+            for index in range(4):
+                files['Pictures/chart%d.svg' % index] = svg_picture(index)
+
+            def pack():
+                return engine._pack_document(dict(files))
+
+            seconds = min(timeit.repeat(pack, number=1, repeat=5))
+            size = len(pack().getvalue())
+            print('%-8s workers=%d %8.1fms %10d bytes' % (
+                name, workers, seconds * 1000, size))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+    Renders letters of a synthetic template (see odtgen.py) one document
+    per letter, and merged into a single document by
+    Renderer.render_merged.
+
+    Usage: python benchmarks/mail_merge.py [letters] [name=value ...]
+"""
+from __future__ import print_function
+
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import odtgen
+from secretary import Renderer
+
+
+def main(letters, scale):
+    media_path = tempfile.mkdtemp()
+    try:
+        template = os.path.join(media_path, 'template.odt')
+        with open(template, 'wb') as output:
+            output.write(odtgen.template(**scale))
+
+        engine = Renderer(media_path=media_path)
+        context = odtgen.context(media_path, **scale)
+        contexts = [dict(context, title='Letter %d' % i)
+                    for i in range(letters)]
+        engine.compile(template)
+
+        start = time.time()
+        size = sum(len(engine.render(template, **context))
+                   for context in contexts)
+        print('documents  %8.2fs %10dKB' % (time.time() - start, size // 1024))
+
+        start = time.time()
+        output = io.BytesIO()
+        engine.render_merged_to(template, output, contexts)
+        print('merged     %8.2fs %10dKB' % (time.time() - start,
+                                           len(output.getvalue()) // 1024))
+    finally:
+        shutil.rmtree(media_path)
+
+
+if __name__ == '__main__':
+    letters = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    main(letters, odtgen.parse_scale(
+        sys.argv[2:] or ['rows=5', 'images=1', 'markdown=2']))
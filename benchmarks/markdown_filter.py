@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+    Times the markdown filter over a report of many markdown comments, most
+    of them repeated boilerplate, with and without the markdown cache.
+
+    Usage: python benchmarks/markdown_filter.py [comments]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from secretary import Renderer, RenderContext, RENDER_CONTEXT_KEY
+
+
+TEMPLATE = os.path.join(os.path.dirname(__file__), '..', 'simple_template.odt')
+
+BOILERPLATE = [
+    '**Terms:** payment due in *30 days*. See [conditions](http://example.com).',
+    '# Notes\n\n- Prices include **taxes**\n- Delivery in *5 days*\n',
+    'Shipping costs are *not* refundable.\n\n    reference: 0001\n',
+]
+
+
+def main(comments):
+    texts = [BOILERPLATE[i % len(BOILERPLATE)] if i % 10 else
+             'Comment number **%d** on *item %d*' % (i, i)
+             for i in range(comments)]
+
+    for entries in (0, 1024):
+        engine = Renderer(markdown_cache_entries=entries)
+        compiled = engine.compile(TEMPLATE)
+
+        def render():
+            context = {RENDER_CONTEXT_KEY: RenderContext(engine, compiled)}
+            for text in texts:
+                engine.markdown_filter(context, text)
+
+        seconds = min(timeit.repeat(render, number=1, repeat=3))
+        print('markdown_cache_entries=%-5d %8.1fms' % (entries,
+                                                       seconds * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3000)
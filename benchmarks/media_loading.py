@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+    Renders a document with many images, served by a media loader which
+    waits a few milliseconds for every image, as a loader fetching them
+    from a remote storage would. Images are loaded one by one and with
+    pools of media workers.
+
+    Usage: python benchmarks/media_loading.py [images] [latency ms]
+"""
+from __future__ import print_function
+
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from secretary import Renderer
+from test_secretary import images_template
+
+
+TEMPLATE = os.path.join(os.path.dirname(__file__), '..', 'samples', 'images',
+                        'template.odt')
+
+
+def main(images, latency):
+    template = images_template(TEMPLATE)
+    values = ['image %d' % i for i in range(images)]
+
+    def loader(value, *args, **kwargs):
+        time.sleep(latency)
+        return (io.BytesIO(value.encode('utf-8')), 'image/png')
+
+    for workers in (1, 8, 32):
+        engine = Renderer(media_workers=workers)
+        engine.media_loader(loader)
+        engine.compile(template)
+
+        start = time.time()
+        engine.render(template, images=values)
+        print('media_workers=%-3d %8.1fms' % (
+            workers, (time.time() - start) * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 300,
+         float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.01)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+    Builds synthetic ODT templates, and the variables to render them, at a
+    given scale:
+
+        rows      rows of the table of the template, rendered by a loop
+        fields    fields printed in every row
+        images    placeholder images, loaded by the default media loader
+        markdown  rows with a field using the markdown filter
+        styles    automatic styles of content.xml and common styles of
+                  styles.xml, as templates exported from Writer have
+        header    1 to print a field in the page header, 0 for a static
+                  styles.xml
+
+    Usage: python benchmarks/odtgen.py output.odt [name=value ...]
+"""
+from __future__ import print_function
+
+import io
+import os
+import sys
+import zlib
+import struct
+import zipfile
+
+NAMESPACES = (
+    'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+    'xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0" '
+    'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+    'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+    'xmlns:draw="urn:oasis:names:tc:opendocument:xmlns:drawing:1.0" '
+    'xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0" '
+    'xmlns:xlink="http://www.w3.org/1999/xlink" '
+    'xmlns:svg="urn:oasis:names:tc:opendocument:xmlns:svg-compatible:1.0" '
+    'office:version="1.2"'
+)
+
+MIMETYPE = 'application/vnd.oasis.opendocument.text'
+
+DEFAULTS = {'rows': 1000, 'fields': 5, 'images': 0, 'markdown': 0,
+            'styles': 50, 'header': 1}
+
+MARKDOWN = [
+    '**Terms:** payment due in *30 days*.',
+    'Delivery:\n\n- packed in *boxes*\n- shipped by **air**\n',
+    'See [conditions](http://example.com/conditions).',
+]
+
+
+def png(width=64, height=64, seed=0):
+    """Returns a PNG picture of width x height pixels."""
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    pixels = b''.join(
+        b'\x00' + bytes(bytearray((x * 4 + seed) % 256 for x in range(width)))
+        * 3 for y in range(height))
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>2I5B', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(pixels)) + chunk(b'IEND', b''))
+
+
+def field(content, description=None):
+    description = ' text:description="%s"' % description if description else ''
+    return '<text:text-input%s>%s</text:text-input>' % (description, content)
+
+
+def text_style(name, index):
+    return ('<style:style style:name="%s" style:family="text">'
+            '<style:text-properties fo:color="#%06x" fo:font-size="%dpt"/>'
+            '</style:style>' % (name, index * 7919 % 0xffffff, 8 + index % 8))
+
+
+def content_xml(rows, fields, images, markdown, styles):
+    cells = ''.join(
+        '<table:table-cell><text:p text:style-name="T%d">%s</text:p>'
+        '</table:table-cell>' % (i % max(styles, 1),
+                                 field('{{ row.field_%d }}' % i))
+        for i in range(fields))
+    if markdown:
+        cells += ('<table:table-cell><text:p>%s</text:p></table:table-cell>' %
+                  field('{{ row.notes|markdown }}'))
+
+    table = (
+        '<table:table table:name="Rows">'
+        '<table:table-row><table:table-cell><text:p>%s</text:p>'
+        '</table:table-cell></table:table-row>'
+        '<table:table-row>%s</table:table-row>'
+        '<table:table-row><table:table-cell><text:p>%s</text:p>'
+        '</table:table-cell></table:table-row>'
+        '</table:table>' % (field('{% for row in rows %}', 'table-row'),
+                            cells, field('{% endfor %}', 'table-row')))
+
+    frames = ''.join(
+        '<text:p><draw:frame draw:name="{{ images[%d]|image }}" '
+        'text:anchor-type="paragraph" svg:width="1in" svg:height="1in">'
+        '<draw:image xlink:href="Pictures/placeholder.png" xlink:type="simple" '
+        'xlink:show="embed" xlink:actuate="onLoad"/></draw:frame></text:p>' % i
+        for i in range(images))
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<office:document-content %s><office:automatic-styles>%s'
+            '</office:automatic-styles><office:body><office:text>'
+            '<text:p>Report %s</text:p>%s%s</office:text></office:body>'
+            '</office:document-content>' % (
+                NAMESPACES,
+                ''.join(text_style('T%d' % i, i) for i in range(styles)),
+                field('{{ title }}'), table, frames)).encode('utf-8')
+
+
+def styles_xml(styles, header):
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<office:document-styles %s><office:styles>%s</office:styles>'
+            '<office:master-styles><style:master-page style:name="Standard">'
+            '<style:header><text:p>%s</text:p></style:header>'
+            '</style:master-page></office:master-styles>'
+            '</office:document-styles>' % (
+                NAMESPACES,
+                ''.join(text_style('Common_%d' % i, i) for i in range(styles)),
+                field('{{ title }}') if header else 'Report')).encode('utf-8')
+
+
+def manifest_xml(images):
+    entries = [('/', MIMETYPE), ('content.xml', 'text/xml'),
+               ('styles.xml', 'text/xml')]
+    if images:
+        entries.append(('Pictures/placeholder.png', 'image/png'))
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:'
+            'opendocument:xmlns:manifest:1.0" manifest:version="1.2">%s'
+            '</manifest:manifest>' % ''.join(
+                '<manifest:file-entry manifest:full-path="%s" '
+                'manifest:media-type="%s"/>' % entry for entry in entries)
+            ).encode('utf-8')
+
+
+def template(rows=DEFAULTS['rows'], fields=DEFAULTS['fields'],
+             images=DEFAULTS['images'], markdown=DEFAULTS['markdown'],
+             styles=DEFAULTS['styles'], header=DEFAULTS['header']):
+    """Returns the data of an ODT template of the given scale."""
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(zipfile.ZipInfo('mimetype'), MIMETYPE)
+        archive.writestr('content.xml', content_xml(rows, fields, images,
+                                                    markdown, styles))
+        archive.writestr('styles.xml', styles_xml(styles, header))
+        archive.writestr('META-INF/manifest.xml', manifest_xml(images))
+        if images:
+            archive.writestr('Pictures/placeholder.png', png())
+
+    return output.getvalue()
+
+
+def context(media_path, rows=DEFAULTS['rows'], fields=DEFAULTS['fields'],
+            images=DEFAULTS['images'], markdown=DEFAULTS['markdown'],
+            styles=DEFAULTS['styles'], header=DEFAULTS['header']):
+    """
+        Returns the template variables of a template of the given scale.
+        Pictures of images are written to `media_path`.
+    """
+    names = []
+    for index in range(images):
+        name = 'picture%d.png' % index
+        with open(os.path.join(media_path, name), 'wb') as picture:
+            picture.write(png(seed=index))
+        names.append(name)
+
+    return {
+        'title': 'Synthetic report & <benchmark>',
+        'images': names,
+        'rows': [dict([('field_%d' % i, 'Value %d.%d & <co>' % (row, i))
+                       for i in range(fields)] +
+                      [('notes', MARKDOWN[row % len(MARKDOWN)]
+                        if row < markdown else '')])
+                 for row in range(rows)],
+    }
+
+
+def parse_scale(args):
+    """Returns the scale given as name=value arguments."""
+    scale = dict(DEFAULTS)
+    for arg in args:
+        name, value = arg.split('=', 1)
+        if name not in DEFAULTS:
+            raise SystemExit('Unknown parameter %r, use one of: %s' % (
+                name, ', '.join(sorted(DEFAULTS))))
+        scale[name] = int(value)
+
+    return scale
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        raise SystemExit(__doc__)
+
+    with open(sys.argv[1], 'wb') as output:
+        output.write(template(**parse_scale(sys.argv[2:])))
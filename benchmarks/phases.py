@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmark suite: times every phase of Renderer, and measures the memory
+    allocated by each one, over synthetic templates of growing scale (see
+    odtgen.py). Phases are:
+
+        unpack          Renderer._unpack_template
+        parse           parsing of content.xml by the XML backend
+        prepare         Renderer._prepare_document_tags
+        unescape        Renderer._unescape_entities
+        compile         compilation of the prepared XML by jinja
+        render          jinja rendering of content.xml
+        reparse         parsing of the rendered XML into a DOM
+        replace_images  Renderer.replace_images
+        pack            Renderer._pack_document
+        total           Renderer.render of a compiled template
+
+    Results are saved as JSON, so runs of different versions can be
+    compared:
+
+        python benchmarks/phases.py --output before.json
+        git checkout feature
+        python benchmarks/phases.py --output after.json --compare before.json
+
+    Usage: python benchmarks/phases.py [--quick] [--scenario NAME ...]
+                                       [--repeat N] [--output FILE]
+                                       [--compare FILE]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import timeit
+import argparse
+import platform
+import tempfile
+import subprocess
+from xml.dom.minidom import parseString
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import odtgen
+from secretary import Renderer, RenderContext, RENDER_CONTEXT_KEY
+
+
+# Scenarios: (name, scale). Every group grows one parameter of the scale,
+# for scaling curves.
+SCENARIOS = [
+    ('rows-1k', {'rows': 1000}),
+    ('rows-10k', {'rows': 10000}),
+    ('rows-50k', {'rows': 50000}),
+    ('fields-20', {'rows': 1000, 'fields': 20}),
+    ('fields-80', {'rows': 1000, 'fields': 80}),
+    ('images-20', {'rows': 100, 'images': 20}),
+    ('images-200', {'rows': 100, 'images': 200}),
+    ('markdown-1k', {'rows': 1000, 'markdown': 1000}),
+    ('styles-5k', {'rows': 1000, 'styles': 5000}),
+    ('static-styles-5k', {'rows': 1000, 'styles': 5000, 'header': 0}),
+]
+
+QUICK_SCENARIOS = [
+    ('rows-1k', {'rows': 1000}),
+    ('images-20', {'rows': 100, 'images': 20}),
+    ('markdown-1k', {'rows': 1000, 'markdown': 1000}),
+    ('styles-5k', {'rows': 1000, 'styles': 5000}),
+]
+
+
+def phases(engine, template, variables):
+    """
+        Returns the (name, setup, run) phases of rendering `template`: setup
+        returns the arguments of run, and is not measured.
+    """
+    backend = engine.xml_backend
+    files = engine._unpack_template(template)
+    compiled = engine.compile(template)
+
+    def prepared():
+        content = backend.parse(files['content.xml'])
+        engine._prepare_document_tags(content)
+        return backend.serialize(content).encode(
+            'ascii', 'xmlcharrefreplace').decode('utf-8')
+
+    def render_context():
+        context = RenderContext(engine, compiled)
+        engine._local.context = context
+        return context
+
+    def rendered():
+        context = render_context()
+        kwargs = dict(variables, **{RENDER_CONTEXT_KEY: context})
+        return context, compiled.content_template.render(**kwargs)
+
+    def reparsed():
+        context, result = rendered()
+        return context, parseString(result.encode('ascii',
+                                                  'xmlcharrefreplace'))
+
+    return [
+        ('unpack', lambda: (template,), engine._unpack_template),
+        ('parse', lambda: (files['content.xml'],), backend.parse),
+        ('prepare', lambda: (backend.parse(files['content.xml']),),
+         engine._prepare_document_tags),
+        ('unescape', lambda: (prepared(),), engine._unescape_entities),
+        ('compile', lambda: (engine._unescape_entities(prepared()),),
+         engine.environment.from_string),
+        ('render', lambda: (render_context(),),
+         lambda context: compiled.content_template.render(
+             **dict(variables, **{RENDER_CONTEXT_KEY: context}))),
+        ('reparse', lambda: (rendered()[1].encode('ascii',
+                                                  'xmlcharrefreplace'),),
+         parseString),
+        ('replace_images', lambda: reversed(reparsed()),
+         engine.replace_images),
+        ('pack', lambda: (engine._render(compiled, **variables).files,),
+         engine._pack_document),
+        ('total', lambda: (), lambda: engine.render(compiled, **variables)),
+    ]
+
+
+def measure(setup, run, repeat):
+    """Returns (seconds, peak allocated bytes) of run(*setup())."""
+    def timed():
+        args = tuple(setup())
+        start = timeit.default_timer()
+        run(*args)
+        return timeit.default_timer() - start
+
+    seconds = min(timed() for i in range(repeat))
+
+    peak = None
+    if tracemalloc is not None:
+        args = tuple(setup())
+        tracemalloc.start()
+        try:
+            run(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return seconds, peak
+
+
+def run_scenarios(scenarios, repeat):
+    results = []
+    for name, scale in scenarios:
+        scale = dict(odtgen.DEFAULTS, **scale)
+        media_path = tempfile.mkdtemp()
+        try:
+            template = os.path.join(media_path, 'template.odt')
+            with open(template, 'wb') as output:
+                output.write(odtgen.template(**scale))
+
+            engine = Renderer(media_path=media_path)
+            variables = odtgen.context(media_path, **scale)
+            for phase, setup, run in phases(engine, template, variables):
+                seconds, peak = measure(setup, run, repeat)
+                results.append({'scenario': name, 'scale': scale,
+                                'phase': phase, 'seconds': seconds,
+                                'peak_bytes': peak})
+                print('%-16s %-15s %10.2fms %10s' % (
+                    name, phase, seconds * 1000,
+                    '%dKB' % (peak // 1024) if peak is not None else '-'))
+        finally:
+            engine._local.context = None
+            shutil.rmtree(media_path)
+
+    return results
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """Prints the ratio of every phase time to the one of `previous`."""
+    before = dict(((result['scenario'], result['phase']), result)
+                  for result in previous['results'])
+
+    print('\nCompared to %s:' % (previous.get('revision') or 'previous run'))
+    for result in results:
+        old = before.get((result['scenario'], result['phase']))
+        if old is None or not old['seconds']:
+            continue
+
+        print('%-16s %-15s %10.2fms %10.2fms %7.2fx' % (
+            result['scenario'], result['phase'], old['seconds'] * 1000,
+            result['seconds'] * 1000, result['seconds'] / old['seconds']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Times every phase of Renderer over synthetic templates.')
+    parser.add_argument('--quick', action='store_true',
+                        help='run a reduced set of scenarios')
+    parser.add_argument('--scenario', action='append',
+                        help='run only this scenario (repeatable)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of every phase, the best one is kept')
+    parser.add_argument('--output', help='save results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of a previous run')
+    args = parser.parse_args()
+
+    scenarios = QUICK_SCENARIOS if args.quick else SCENARIOS
+    if args.scenario:
+        scenarios = [scenario for scenario in SCENARIOS
+                     if scenario[0] in args.scenario]
+
+    results = run_scenarios(scenarios, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'revision': revision(),
+                       'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'results': results}, output, indent=1)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    Measures how template preparation (Renderer._prepare_document_tags)
+    scales with the number of fields of a template. Time per field should
+    stay flat as the number of fields grows.
+
+    Usage: python benchmarks/prepare_tags.py [backend ...]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from secretary import Renderer
+
+
+NAMESPACES = (
+    'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+    'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+    'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0"'
+)
+
+
+def field(content, description=None):
+    description = ' text:description="%s"' % description if description else ''
+    return '<text:text-input%s>%s</text:text-input>' % (description, content)
+
+
+def catalog_template(fields):
+    """
+        Returns the content.xml of a catalog like template with `fields`
+        fields: a long table with a loop every few rows, followed by as many
+        paragraphs, all of them children of office:text.
+    """
+    rows, paragraphs = [], []
+    for group in range(fields // 10):
+        rows.append(
+            '<table:table-row><table:table-cell><text:p>%s</text:p>'
+            '</table:table-cell></table:table-row>' % field(
+                '{% for product in group.products %}', 'table-row'))
+        rows.extend(
+            '<table:table-row><table:table-cell><text:p>%s %s</text:p>'
+            '</table:table-cell></table:table-row>' % (
+                field('{{ product.name }}'), field('{{ product.price }}'))
+            for row in range(2))
+        rows.append(
+            '<table:table-row><table:table-cell><text:p>%s</text:p>'
+            '</table:table-cell></table:table-row>' % field(
+                '{% endfor %}', 'table-row'))
+        paragraphs.extend(
+            '<text:p>Note %s</text:p>' % field('{{ note }}')
+            for paragraph in range(4))
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<office:document-content %s><office:body><office:text>'
+            '<table:table>%s</table:table>%s'
+            '</office:text></office:body></office:document-content>' % (
+                NAMESPACES, ''.join(rows), ''.join(paragraphs))).encode('utf-8')
+
+
+def main(backends):
+    for backend in backends:
+        engine = Renderer(xml_backend=backend)
+        for fields in (1000, 2000, 4000, 8000, 16000):
+            xml = catalog_template(fields)
+
+            def prepare():
+                engine._prepare_document_tags(engine.xml_backend.parse(xml))
+
+            seconds = min(timeit.repeat(prepare, number=1, repeat=3))
+            print('%-8s %6d fields %8.3fs %8.1fus/field' % (
+                backend, fields, seconds, seconds * 1e6 / fields))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or ['minidom', 'etree'])
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+    Times `import secretary`, in new Python processes, and the construction
+    of Renderer objects, as frameworks creating a Renderer for every request
+    do.
+
+    Usage: python benchmarks/startup.py [processes] [renderers]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+
+def process_time(code, processes):
+    # Best time of a new Python process running code
+    def run():
+        start = timeit.default_timer()
+        subprocess.check_call([sys.executable, '-c', code], cwd=ROOT)
+        return timeit.default_timer() - start
+
+    return min(run() for i in range(processes))
+
+
+def main(processes, renderers):
+    python = process_time('pass', processes)
+    jinja = process_time('import jinja2', processes)
+    secretary = process_time('import secretary', processes)
+    print('import jinja2     %8.1fms' % ((jinja - python) * 1000))
+    print('import secretary  %8.1fms' % ((secretary - python) * 1000))
+
+    from secretary import Renderer
+    seconds = min(timeit.repeat(Renderer, number=renderers, repeat=3))
+    print('Renderer()        %8.1fus' % (seconds / renderers * 1000000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]] or (20, 10000))
@@ -0,0 +1,6 @@
+import sys
+
+# The asyncio tests use syntax of Python 3.5
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append('test_secretary_async.py')
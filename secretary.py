@@ -25,15 +25,27 @@ Secretary
 from __future__ import unicode_literals, print_function
 
 import io
+import os
 import re
 import sys
+import zlib
+import mmap
+import time
+import json
+import struct
+import pickle
+import marshal
 import logging
+import hashlib
 import zipfile
+import tempfile
+import threading
 import jinja2
 from os import path
-from mimetypes import guess_type, guess_extension
-from uuid import uuid4
-from xml.dom.minidom import parseString
+from fnmatch import fnmatch
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple, deque
+from xml.parsers import expat
 from xml.parsers.expat import ExpatError, ErrorString
 from jinja2 import Environment, Undefined, Markup
 
@@ -46,6 +58,13 @@ else:
     xrange = range
     basestring = (str, bytes)
 
+
+def parseString(string):
+    # xml.dom.minidom, like the other XML parsers, mimetypes and markdown2,
+    # is imported on first use, to keep `import secretary` fast
+    from xml.dom.minidom import parseString
+    return parseString(string)
+
 FLOW_REFERENCES = {
     'text:p'             : 'text:p',
     'paragraph'          : 'text:p',
@@ -69,6 +88,41 @@ FLOW_REFERENCES = {
     'after::cell'        : 'table:table-cell',
 }
 
+# Entities unescaped within jinja instructions. Earlier versions of
+# Secretary unescaped '&apos;' to "\\'", kept for compatibility.
+XML_UNESCAPED_ENTITIES = {
+    'gt'  : '>',
+    'lt'  : '<',
+    'amp' : '&',
+    'quot': '"',
+    'apos': "\\'",
+}
+
+# Archive members read and written by Renderer. Other members of templates
+# are copied to rendered documents without being decompressed.
+RENDERED_MEMBERS = ('mimetype', 'content.xml', 'styles.xml',
+                    'META-INF/manifest.xml')
+
+# Members of compiled template files (see CompiledTemplate.save) holding
+# the prepared sources and compiled code of the template. The version of
+# the format is increased on incompatible changes.
+COMPILED_MEMBERS_DIR = 'Secretary/'
+COMPILED_META = COMPILED_MEMBERS_DIR + 'meta.json'
+COMPILED_FORMAT = 1
+
+# Number of CPUs, read once: os.cpu_count reads it from the system on every
+# call. Renderer defaults are derived from it.
+_CPU_COUNT = getattr(os, 'cpu_count', lambda: None)() or 1
+
+# Members of at least this size are compressed in parallel. See
+# Renderer.__init__ compression_workers argument.
+PARALLEL_COMPRESSION_SIZE = 128 * 1024
+
+# Validation levels of rendered XML documents. See Renderer.__init__
+VALIDATE_NONE       = 'none'
+VALIDATE_WELLFORMED = 'wellformed'
+VALIDATE_DOM        = 'dom'
+
 # ---- Exceptions
 class SecretaryError(Exception):
     pass
@@ -102,430 +156,2365 @@ def pad_string(value, length=5):
     value = str(value)
     return value.zfill(length)
 
-class Renderer(object):
-    """
-        Main engine to convert and ODT document into a jinja
-        compatible template.
 
-        Basic use example:
-            engine = Renderer()
-            result = engine.render(template, var1=val1, var2=val2, ...)
+# ************************************************
+#
+#           XML BACKENDS
+#
+# ************************************************
 
+class XMLBackend(object):
+    """
+        Interface to the XML library used to prepare templates. Renderer
+        only works with documents and nodes through these methods, so
+        templates can be prepared with any XML library. Rendering always
+        works with minidom documents (see to_minidom).
 
-        Renderer provides an environment property which should be used
-        to add custom filters to the ODF render.
-            engine = Renderer()
-            engine.environment.filters['custom_filter'] = filterFn
-            result = engine.render('template.odt', var1=val1, ...)
+        Documents and nodes are opaque objects for Renderer. Node names are
+        qualified names as found in the ODF document (e.g. "text:p").
     """
 
-    def __init__(self, environment=None, **kwargs):
-        """
-        Create a Renderer instance.
+    #: Name of this backend, as given to Renderer(xml_backend=...)
+    name = None
 
-        args:
-            environment: Use this jinja2 environment. If not specified, we
-                         create a new environment for this class instance.
+    def parse(self, data):
+        """Returns a document from XML data (bytes)."""
+        raise NotImplementedError
 
-        """
-        self.log = logging.getLogger(__name__)
-        self.log.debug('Initing a Renderer instance\nTemplate')
+    def serialize(self, document):
+        """Returns document as a string, like minidom's toxml()."""
+        raise NotImplementedError
 
-        if environment:
-            self.environment = environment
-        else:
-            self.environment = Environment(undefined=UndefinedSilently,
-                                           autoescape=True,
-                                           finalize=self.finalize_value)
-            # Register filters
-            self.environment.filters['pad'] = pad_string
-            self.environment.filters['markdown'] = self.markdown_filter
-            self.environment.filters['image'] = self.image_filter
-            self.environment.globals['SafeValue'] = jinja2.Markup
+    def to_minidom(self, document):
+        """Returns document as a minidom Document."""
+        return parseString(self.serialize(document))
 
-        self.media_path = kwargs.pop('media_path', '')
-        self.media_callback = self.fs_loader
+    def find(self, document, name):
+        """Returns the first element of document named `name`."""
+        raise NotImplementedError
 
-        self._compile_tags_expressions()
+    def fields(self, document):
+        """Returns a list of the text:text-input elements of document."""
+        raise NotImplementedError
 
-    @jinja2.evalcontextfilter
-    def finalize_value(self, value, *args):
-        """Escapes variables values."""
-        if isinstance(value, Markup):
-            return value
+    def text(self, node):
+        """Returns the text of the first child of node, or None."""
+        raise NotImplementedError
 
-        return Markup(self.get_escaped_var_value(value))
+    def attribute(self, node, name):
+        """Returns the value of attribute `name` of node, or ''."""
+        raise NotImplementedError
 
-    def media_loader(self, callback):
-        """This sets the the media loader. A user defined function which
-        loads media. The function should take a template value, optionals
-        args and kwargs. Is media exists should return a tuple whose first
-        element if a file object type representing the media and its second
-        elements is the media mimetype.
+    def node_name(self, node):
+        raise NotImplementedError
 
-        See Renderer.fs_loader funcion for an example"""
-        self.media_callback = callback
-        return callback
+    def parent(self, document, node):
+        """Returns the parent of node, or None for a root or detached node."""
+        raise NotImplementedError
 
-    def _unpack_template(self, template):
-        # And Open/libreOffice is just a ZIP file. Here we unarchive the file
-        # and return a dict with every file in the archive
-        self.log.debug('Unpacking template file')
+    def insert_text(self, document, node, text, after=False):
+        """Insert a text before (or after) node."""
+        raise NotImplementedError
 
-        archive_files = {}
-        archive = zipfile.ZipFile(template, 'r')
-        for zfile in archive.filelist:
-            archive_files[zfile.filename] = archive.read(zfile.filename)
+    def insert_span(self, document, node, text, after=False):
+        """Insert a <text:span> containing text before (or after) node."""
+        raise NotImplementedError
 
-        return archive_files
+    def remove(self, document, node):
+        """Remove node from its parent."""
+        raise NotImplementedError
 
-        self.log.debug('Unpack completed')
+    def clear(self, document, node):
+        """Remove every child of node."""
+        raise NotImplementedError
 
-    def _pack_document(self, files):
-        # Store to a zip files in files
-        self.log.debug('packing document')
-        zip_file = io.BytesIO()
+    def edit(self, document, insertions, removals):
+        """
+            Apply a batch of changes to document. insertions is a list of
+            (node, text, span, after) tuples: insert text before node (or
+            right after it, if after is true), inside a <text:span> if span is
+            true. removals is a list of nodes to remove. Insertions are done
+            in order, before any removal.
+
+            Subclasses should rebuild the children of every changed parent
+            once, instead of inserting and removing nodes one by one.
+        """
+        for node, text, span, after in insertions:
+            insert = self.insert_span if span else self.insert_text
+            insert(document, node, text, after)
+
+        for node in removals:
+            self.remove(document, node)
+
+    def _changes_by_parent(self, document, insertions, removals):
+        # Returns {parent: {child: (before, after, removed)}}, where before
+        # and after are lists of (text, span) to insert around child. Texts
+        # inserted right after a node push the previous ones, so after is
+        # reversed.
+        changes = {}
+
+        def child_changes(node):
+            parent = self.parent(document, node)
+            return changes.setdefault(parent, {}).setdefault(
+                node, ([], [], []))
+
+        for node, text, span, after in insertions:
+            before_node, after_node, _ = child_changes(node)
+            if after:
+                after_node.insert(0, (text, span))
+            else:
+                before_node.append((text, span))
 
-        mimetype = files['mimetype']
-        del files['mimetype']
+        for node in removals:
+            child_changes(node)[2].append(True)
 
-        zipdoc = zipfile.ZipFile(zip_file, 'a', zipfile.ZIP_DEFLATED)
+        return changes
 
-        # Store mimetype without without compression using a ZipInfo object
-        # for compatibility with Py2.6 which doesn't have compress_type
-        # parameter in ZipFile.writestr function
-        mime_zipinfo = zipfile.ZipInfo('mimetype')
-        zipdoc.writestr(mime_zipinfo, mimetype)
 
-        for fname, content in files.items():
-            zipdoc.writestr(fname, content)
+class MinidomBackend(XMLBackend):
+    """Templates preparation using xml.dom.minidom."""
 
-        self.log.debug('Document packing completed')
+    name = 'minidom'
 
-        return zip_file
+    def parse(self, data):
+        return parseString(data)
 
+    def serialize(self, document):
+        return document.toxml()
 
-    @staticmethod
-    def _inc_node_tags_count(node, is_block=False):
-        """ Increase field count of node and its parents """
+    def to_minidom(self, document):
+        return document
 
-        if node is None:
-            return
+    def find(self, document, name):
+        return document.getElementsByTagName(name)[0]
 
-        for attr in ['field_count', 'block_count', 'var_count']:
-            if not hasattr(node, attr):
-                setattr(node, attr, 0)
+    def fields(self, document):
+        return document.getElementsByTagName('text:text-input')
 
-        node.field_count += 1
-        if is_block:
-            node.block_count += 1
-        else:
-            node.var_count += 1
+    def text(self, node):
+        if not node.hasChildNodes():
+            return None
 
-        Renderer._inc_node_tags_count(node.parentNode, is_block)
+        return getattr(node.childNodes[0], 'data', None)
 
+    def attribute(self, node, name):
+        return node.getAttribute(name)
 
-    def _compile_tags_expressions(self):
-        self.tag_pattern = re.compile(r'(?is)^({0}|{1}).*({2}|{3})$'.format(
-            self.environment.variable_start_string,
-            self.environment.block_start_string,
-            self.environment.variable_end_string,
-            self.environment.block_end_string
-        ))
-
-        self.variable_pattern = re.compile(r'(?is)({0})(.*)({1})$'.format(
-            self.environment.variable_start_string,
-            self.environment.variable_end_string
-        ))
-
-        self.block_pattern = re.compile(r'(?is)({0})(.*)({1})$'.format(
-            self.environment.block_start_string,
-            self.environment.block_end_string
-        ))
-
-        self._compile_escape_expressions()
-
-
-    def _compile_escape_expressions(self):
-        # Compiles escape expressions
-        self.escape_map = dict()
-        unescape_rules = {
-            r'&gt;': r'>',
-            r'&lt;': r'<',
-            r'&amp;': r'&',
-            r'&quot;': r'"',
-            r'&apos;': r'\'',
-        }
+    def node_name(self, node):
+        return node.nodeName
 
-        for key, value in unescape_rules.items():
-            exp = r'(?is)(({0}|{1})[^{3}{4}]*?)({2})([^{0}{1}]*?({3}|{4}))'
-            key = re.compile(exp.format(
-                self.environment.variable_start_string,
-                self.environment.block_start_string,
-                key,
-                self.environment.variable_end_string,
-                self.environment.block_end_string
-            ))
+    def parent(self, document, node):
+        return node.parentNode
 
-            self.escape_map[key] = r'\1{0}\4'.format(value)
+    def _insert(self, node, new_node, after):
+        parent = node.parentNode
+        if not after:
+            parent.insertBefore(new_node, node)
+        elif node.isSameNode(parent.lastChild):
+            parent.appendChild(new_node)
+        else:
+            parent.insertBefore(new_node, node.nextSibling)
+
+    def insert_text(self, document, node, text, after=False):
+        self._insert(node, document.createTextNode(text), after)
+
+    def insert_span(self, document, node, text, after=False):
+        span = document.createElement('text:span')
+        span.appendChild(document.createTextNode(text))
+        self._insert(node, span, after)
+
+    def remove(self, document, node):
+        node.parentNode.removeChild(node)
+
+    def clear(self, document, node):
+        while node.firstChild is not None:
+            node.removeChild(node.firstChild)
+
+    def _new_nodes(self, document, items):
+        for text, span in items:
+            node = document.createTextNode(text)
+            if span:
+                span_node = document.createElement('text:span')
+                span_node.appendChild(node)
+                node = span_node
+
+            yield node
+
+    def edit(self, document, insertions, removals):
+        changes = self._changes_by_parent(document, insertions, removals)
+        for parent, node_changes in changes.items():
+            children = []
+            for child in parent.childNodes:
+                if child not in node_changes:
+                    children.append(child)
+                    continue
+
+                before, after, removed = node_changes[child]
+                children.extend(self._new_nodes(document, before))
+                if removed:
+                    child.parentNode = None
+                    child.previousSibling = child.nextSibling = None
+                else:
+                    children.append(child)
+                children.extend(self._new_nodes(document, after))
 
-    def _is_jinja_tag(self, tag):
-        """
-            Returns True is tag (str) is a valid jinja instruction tag.
-        """
+            # Rebuild the children list and their links in a single pass
+            previous = None
+            for child in children:
+                child.parentNode = parent
+                child.previousSibling = previous
+                if previous is not None:
+                    previous.nextSibling = child
+                previous = child
 
-        return len(self.tag_pattern.findall(tag)) > 0
+            if previous is not None:
+                previous.nextSibling = None
+            parent.childNodes[:] = children
 
 
-    def _is_block_tag(self, tag):
-        """
-            Returns True is tag (str) is a jinja flow control tag.
-        """
-        return len(self.block_pattern.findall(tag)) > 0
+class _ElementTreeDocument(object):
+    # An ElementTree root element and a child -> parent map, which
+    # ElementTree doesn't provide.
+    __slots__ = ('root', 'parents')
 
+    def __init__(self, root):
+        self.root = root
+        self.parents = dict(
+            (child, parent) for parent in root.iter() for child in parent)
 
-    def _tags_in_document(self, document):
-        """
-            Yields a list of available jinja instructions tags in document.
-        """
-        tags = document.getElementsByTagName('text:text-input')
 
-        for tag in tags:
-            if not tag.hasChildNodes():
-                continue
+# minidom writes attributes sorted by name before Python 3.8, and in
+# document order since
+_MINIDOM_SORTS_ATTRIBUTES = sys.version_info < (3, 8)
 
-            content = tag.childNodes[0].data.strip()
-            if not self._is_jinja_tag(content):
-                continue
 
-            yield tag
+class ElementTreeBackend(XMLBackend):
+    """
+        Templates preparation using xml.etree.ElementTree. Documents are
+        parsed without namespace processing, so elements keep their prefixed
+        names, and serialized the same way minidom does. Prepared templates
+        are identical to those prepared with minidom.
+    """
 
+    name = 'etree'
 
-    def _census_tags(self, document):
-        """
-        Make a census of all available jinja tags in document. We count all
-        the children tags nodes within their parents. This process is necesary
-        to automaticaly avoid generating invalid documents when mixing block
-        tags in differents parts of a document.
-        """
-        for tag in self._tags_in_document(document):
-            content = tag.childNodes[0].data.strip()
-            block_tag = self._is_block_tag(content)
+    def __init__(self):
+        from xml.etree import ElementTree
+        self.etree = ElementTree
 
-            self._inc_node_tags_count(tag.parentNode, block_tag)
+    def parse(self, data):
+        etree = self.etree
+        try:
+            builder = etree.TreeBuilder(insert_comments=True, insert_pis=True)
+            comment, pi = builder.comment, builder.pi
+        except TypeError:
+            # Before Python 3.8, TreeBuilder doesn't build comments and
+            # processing instructions: build them as 3.8 does
+            builder = etree.TreeBuilder()
+
+            def comment(text):
+                self._insert(builder, etree.Comment, text)
+
+            def pi(target, text):
+                self._insert(builder, etree.ProcessingInstruction,
+                             target + ' ' + text if text else target)
+
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = builder.start
+        parser.EndElementHandler = builder.end
+        parser.CharacterDataHandler = builder.data
+        parser.CommentHandler = comment
+        parser.ProcessingInstructionHandler = pi
+        parser.Parse(data, True)
+
+        return _ElementTreeDocument(builder.close())
 
+    @staticmethod
+    def _insert(builder, tag, text):
+        # Adds to the tree of builder an element with just text
+        builder.start(tag, {})
+        if text:
+            builder.data(text)
+        builder.end(tag)
+
+    def serialize(self, document):
+        output = ['<?xml version="1.0" ?>']
+        self._serialize(document.root, output.append)
+        return ''.join(output)
+
+    def _serialize(self, element, write):
+        tag = element.tag
+        if tag is self.etree.Comment:
+            write('<!--%s-->' % element.text)
+        elif tag is self.etree.ProcessingInstruction:
+            write('<?%s?>' % element.text)
+        else:
+            self._serialize_element(element, write)
+
+        if element.tail:
+            write(_escape_xml(element.tail))
+
+    def _serialize_element(self, element, write):
+        tag = element.tag
+        write('<' + tag)
+        attributes = element.attrib.items()
+        if _MINIDOM_SORTS_ATTRIBUTES:
+            attributes = sorted(attributes)
+        for name, value in attributes:
+            write(' %s="%s"' % (name, _escape_xml(value)))
+
+        if element.text or len(element):
+            write('>')
+            if element.text:
+                write(_escape_xml(element.text))
+            for child in element:
+                self._serialize(child, write)
+            write('</%s>' % tag)
+        else:
+            write('/>')
 
-    def  _prepare_document_tags(self, document):
-        """ Here we search for every field node present in xml_document.
-        For each field we found we do:
-        * if field is a print field ({{ field }}), we replace it with a
-          <text:span> node.
+    def find(self, document, name):
+        return next(document.root.iter(name))
 
-        * if field is a control flow ({% %}), then we find immediate node of
-          type indicated in field's `text:description` attribute and replace
-          the whole node and its childrens with field's content.
+    def fields(self, document):
+        return list(document.root.iter('text:text-input'))
 
-          If `text:description` attribute starts with `before::` or `after::`,
-          then we move field content before or after the node in description.
+    def text(self, node):
+        return node.text
 
-          If no `text:description` is available, find the immediate common
-          parent of this and any other field and replace its child and
-          original parent of field with the field content.
+    def attribute(self, node, name):
+        return node.get(name, '')
 
-          e.g.: original
-          <table>
-              <table:row>
-                  <field>{% for bar in bars %}</field>
-              </table:row>
-              <paragraph>
-                  <field>{{ bar }}</field>
-              </paragraph>
-              <table:row>
-                  <field>{% endfor %}</field>
-              </table:row>
-          </table>
+    def node_name(self, node):
+        return node.tag
 
-          After processing:
-          <table>
-              {% for bar in bars %}
-              <paragraph>
-                  <text:span>{{ bar }}</text:span>
-              </paragraph>
-              {% endfor %}
-          </table>
-        """
+    def parent(self, document, node):
+        return document.parents.get(node)
 
-        # -------------------------------------------------------------------- #
-        # We have to replace a node, let's call it "placeholder", with the
-        # content of our jinja tag. The placeholder can be a node with all its
-        # children. Node's "text:description" attribute indicates how far we
-        # can scale up in the tree hierarchy to get our placeholder node. When
-        # said attribute is not present, then we scale up until we find a
-        # common parent for this tag and any other tag.
-        # -------------------------------------------------------------------- #
-        self.log.debug('Preparing document tags')
-        self._census_tags(document)
+    def _add_text(self, document, node, text, after):
+        # ElementTree keeps texts in the .text and .tail of elements. Add
+        # text right before (or after) node.
+        if after:
+            node.tail = text + (node.tail or '')
+            return
 
-        for tag in self._tags_in_document(document):
-            placeholder = tag
-            content = tag.childNodes[0].data.strip()
-            is_block = self._is_block_tag(content)
-            scale_to = tag.getAttribute('text:description').strip().lower()
+        parent = document.parents[node]
+        index = list(parent).index(node)
+        if index:
+            previous = parent[index - 1]
+            previous.tail = (previous.tail or '') + text
+        else:
+            parent.text = (parent.text or '') + text
+
+    def insert_text(self, document, node, text, after=False):
+        self._add_text(document, node, text, after)
+
+    def insert_span(self, document, node, text, after=False):
+        parent = document.parents[node]
+        index = list(parent).index(node)
+        span = parent.makeelement('text:span', {})
+        span.text = text
+        if after:
+            span.tail, node.tail = node.tail, None
+            index += 1
+
+        parent.insert(index, span)
+        document.parents[span] = parent
+
+    def remove(self, document, node):
+        if node.tail:
+            # Keep the text following node
+            tail, node.tail = node.tail, None
+            self._add_text(document, node, tail, False)
+
+        document.parents.pop(node).remove(node)
+
+    def clear(self, document, node):
+        node.text = None
+        for child in list(node):
+            self.remove(document, child)
+
+    def _make_span(self, document, parent):
+        span = parent.makeelement('text:span', {})
+        document.parents[span] = parent
+        return span
 
-            if content.lower().find('|markdown') > 0:
-                # Take whole paragraph when handling a markdown field
-                scale_to = 'text:p'
+    def _detach(self, document, node):
+        del document.parents[node]
+
+    def edit(self, document, insertions, removals):
+        changes = self._changes_by_parent(document, insertions, removals)
+        for parent, node_changes in changes.items():
+            # The new content of parent, as a list of texts and elements
+            content = [parent.text]
+            for child in list(parent):
+                if child not in node_changes:
+                    content.extend((child, child.tail))
+                    continue
+
+                before, after, removed = node_changes[child]
+                for text, span in before:
+                    content.append(self._new_span(document, parent, text)
+                                   if span else text)
+                if removed:
+                    self._detach(document, child)
+                else:
+                    content.append(child)
+                for text, span in after:
+                    content.append(self._new_span(document, parent, text)
+                                   if span else text)
+                content.append(child.tail)
 
-            if scale_to:
-                if FLOW_REFERENCES.get(scale_to, False):
-                    placeholder = self._parent_of_type(
-                        tag, FLOW_REFERENCES[scale_to]
-                    )
+            self._set_content(parent, content)
 
-                new_node = self.create_text_node(document, content)
+    def _new_span(self, document, parent, text):
+        span = self._make_span(document, parent)
+        span.text = text
+        return span
 
-            elif is_block:
-                # expand up the placeholder until a shared parent is found
-                while not placeholder.parentNode.field_count > 1:
-                    placeholder = placeholder.parentNode
+    def _set_content(self, parent, content):
+        # ElementTree keeps the text following an element in its tail
+        text, children, tails = [], [], []
+        texts = text
+        for item in content:
+            if item is None:
+                continue
+            if isinstance(item, basestring):
+                texts.append(item)
+            else:
+                texts = []
+                children.append(item)
+                tails.append(texts)
 
-                if placeholder:
-                    new_node = self.create_text_node(document, content)
+        parent.text = ''.join(text) or None
+        parent[:] = children
+        for child, tail in zip(children, tails):
+            child.tail = ''.join(tail) or None
 
-            else:
-                new_node = self.create_text_span_node(document, content)
 
-            placeholder_parent = placeholder.parentNode
-            if not scale_to.startswith('after::'):
-                placeholder_parent.insertBefore(new_node, placeholder)
-            else:
-                if placeholder.isSameNode(placeholder_parent.lastChild):
-                    placeholder_parent.appendChild(new_node)
-                else:
-                    placeholder_parent.insertBefore(
-                        new_node, placeholder.nextSibling
-                    )
+class LxmlBackend(ElementTreeBackend):
+    """
+        Templates preparation using lxml. The prepared templates are
+        equivalent to those prepared with minidom, but not byte to byte
+        identical (e.g. quotes in text are not escaped).
+    """
 
-            if scale_to.startswith(('after::', 'before::')):
-                # Don't remove whole field tag, only "text:text-input" container
-                placeholder = self._parent_of_type(tag, 'text:p')
-                placeholder_parent = placeholder.parentNode
+    name = 'lxml'
 
+    def __init__(self):
+        try:
+            from lxml import etree
+        except ImportError:
+            raise SecretaryError('Could not import lxml library. Install it using "pip install lxml"')
 
-            # Finally, remove the placeholder
-            placeholder_parent.removeChild(placeholder)
+        self.etree = etree
+        self.parser = etree.XMLParser(huge_tree=True, resolve_entities=False)
 
-    def _unescape_entities(self, xml_text):
-        """
-        Unescape links and '&amp;', '&lt;', '&quot;' and '&gt;' within jinja
-        instructions. The regexs rules used here are compiled in
-        _compile_escape_expressions.
-        """
-        for regexp, replacement in self.escape_map.items():
-            while True:
-                xml_text, substitutions = regexp.subn(replacement, xml_text)
-                if not substitutions:
-                    break
+    def _qname(self, document, name):
+        # 'text:p' -> '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}p'
+        prefix, _, local = name.rpartition(':')
+        if not prefix:
+            return name
 
-        return self._unescape_links(xml_text)
+        return '{%s}%s' % (document.nsmap[prefix], local)
 
-    def _unescape_links(self, xml_text):
-        """Fix Libreoffice auto escaping of xlink:href attribute values.
-        This unescaping is only done on 'secretary' scheme URLs."""
-        robj = re.compile(r'(?is)(xlink:href=\")secretary:(.*?)(\")')
+    def parse(self, data):
+        return self.etree.fromstring(data, self.parser)
 
-        def replacement(match):
-            return Markup(''.join([
-                match.group(1),
-                self.variable_pattern.sub(r'\1 SafeValue(\2) \3',
-                                          unquote(match.group(2))),
-                match.group(3)
-            ]))
+    def serialize(self, document):
+        return '<?xml version="1.0" ?>' + \
+            self.etree.tostring(document, encoding='unicode')
 
-        while True:
-            xml_text, rep = robj.subn(replacement, xml_text)
-            if not rep:
-                break
+    def find(self, document, name):
+        return next(document.iter(self._qname(document, name)))
 
-        return xml_text
+    def fields(self, document):
+        return list(document.iter(self._qname(document, 'text:text-input')))
 
-    @staticmethod
-    def get_escaped_var_value(value):
-        """
-        Encodes XML reserved chars in value (eg. &, <, >) and also replaces
-        the control chars \n and \t control chars to their ODF counterparts.
-        """
-        value = Markup.escape(value)
-        return (
-            value.replace('\n', Markup('<text:line-break/>'))
-                 .replace('\t', Markup('<text:tab/>'))
-                 .replace('\x0b', '<text:space/>')
-                 .replace('\x0c', '<text:space/>')
-        )
+    def attribute(self, node, name):
+        return node.get(self._qname(node, name), '')
 
+    def node_name(self, node):
+        local = self.etree.QName(node).localname
+        return '%s:%s' % (node.prefix, local) if node.prefix else local
 
-    def add_media_to_archive(self, media, mime, name=''):
-        """
-        Adds to "Pictures" archive folder the file in `media` and register
-        it into manifest file.
-        """
-        extension = None
-        if hasattr(media, 'name') and not name:
-            extension = path.splitext(media.name)
-            name      = extension[0]
-            extension = extension[1]
+    def parent(self, document, node):
+        return node.getparent()
 
-        if not extension:
-            extension = guess_extension(mime)
+    def _add_text(self, document, node, text, after):
+        if after:
+            node.tail = text + (node.tail or '')
+            return
 
-        media_path = 'Pictures/%s%s' % (name, extension)
-        media.seek(0)
-        self.files[media_path] = media.read(-1)
-        if hasattr(media, 'close'):
-            media.close()
+        previous = node.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + text
+        else:
+            parent = node.getparent()
+            parent.text = (parent.text or '') + text
+
+    def insert_span(self, document, node, text, after=False):
+        parent = node.getparent()
+        # Create the span in the tree, so it uses the declared text prefix
+        span = self.etree.SubElement(parent, self._qname(document, 'text:span'))
+        span.text = text
+        if after:
+            span.tail, node.tail = node.tail, None
+            node.addnext(span)
+        else:
+            node.addprevious(span)
 
-        files_node = self.manifest.getElementsByTagName('manifest:manifest')[0]
-        node = self.create_node(self.manifest, 'manifest:file-entry', files_node)
-        node.setAttribute('manifest:full-path', media_path)
-        node.setAttribute('manifest:media-type', mime)
+    def remove(self, document, node):
+        if node.tail:
+            tail, node.tail = node.tail, None
+            self._add_text(document, node, tail, False)
 
-        return media_path
+        node.getparent().remove(node)
 
+    def clear(self, document, node):
+        node.text = None
+        for child in list(node):
+            node.remove(child)
 
-    def fs_loader(self, media, *args, **kwargs):
-        """Loads a file from the file system.
-        :param media: A file object or a relative or absolute path of a file.
-        :type media: unicode
-        """
-        if hasattr(media, 'seek') and hasattr(media, 'read'):
-            return (media, 'image/jpeg')
-        elif path.isfile(media):
-            filename = media
-        else:
-            if not self.media_path:
-                self.log.debug('media_path property not specified to load images from.')
-                return
+    def _make_span(self, document, parent):
+        # Create the span in the tree, so it uses the declared text prefix
+        return self.etree.SubElement(parent, self._qname(document, 'text:span'))
 
-            filename = path.join(self.media_path, media)
-            if not path.isfile(filename):
-                self.log.debug('Media file "%s" does not exists.' % filename)
-                return
+    def _detach(self, document, node):
+        pass
 
-        mime = guess_type(filename)
-        return (open(filename, 'rb'), mime[0] if mime else None)
 
+XML_BACKENDS = {
+    'minidom': MinidomBackend,
+    'etree': ElementTreeBackend,
+    'lxml': LxmlBackend,
+}
 
-    def replace_images(self, xml_document):
-        """Perform images replacements"""
-        self.log.debug('Inserting images')
-        frames = xml_document.getElementsByTagName('draw:frame')
 
-        for frame in frames:
+def get_xml_backend(backend):
+    """
+        Returns an XMLBackend instance. backend could be an XMLBackend
+        instance or the name of one of XML_BACKENDS.
+    """
+    if isinstance(backend, XMLBackend):
+        return backend
+
+    if backend not in XML_BACKENDS:
+        raise ValueError('Unknown XML backend: %r' % backend)
+
+    return XML_BACKENDS[backend]()
+
+
+# ************************************************
+#
+#           COMPRESSION POLICIES
+#
+# ************************************************
+
+class CompressionPolicy(object):
+    """
+        Selects how the members of rendered documents are compressed.
+
+        args:
+            level: zlib compression level, from 0 to 9, of members no rule
+                   applies to. 0 stores members without compression.
+                   Defaults to zlib's default level (6).
+            rules: A list of (pattern, level) tuples. pattern is matched,
+                   using fnmatch, against the name of the member and its
+                   mimetype (e.g. 'Pictures/*', 'image/svg+xml'). The level
+                   of the first matching rule is used.
+            store_compressed: Store members which are compressed already,
+                              like PNG or JPEG images (default True).
+                              Deflating them costs time and barely saves
+                              any space.
+            copy_raw: Copy the members of the template Secretary doesn't
+                      render as they are compressed in the template (default
+                      True). When False, they are compressed again following
+                      this policy.
+
+        The mimetype member is always stored, as required by ODF.
+    """
+
+    #: Mimetypes of compressed data, see store_compressed
+    COMPRESSED_TYPES = ('image/png', 'image/jpeg', 'image/gif', 'image/webp',
+                        'audio/*', 'video/*', 'application/zip',
+                        'application/gzip', 'application/x-7z-compressed')
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION, rules=None,
+                 store_compressed=True, copy_raw=True):
+        self.default_level = level
+        self.rules = list(rules or [])
+        self.store_compressed = store_compressed
+        self.copy_raw = copy_raw
+
+        for pattern, rule_level in [(None, level)] + self.rules:
+            if rule_level != zlib.Z_DEFAULT_COMPRESSION and \
+                    not 0 <= rule_level <= 9:
+                raise ValueError('Invalid compression level: %r' % rule_level)
+
+    def __repr__(self):
+        return '%s(level=%r, rules=%r, store_compressed=%r, copy_raw=%r)' % (
+            self.__class__.__name__, self.default_level, self.rules,
+            self.store_compressed, self.copy_raw)
+
+    def level(self, name):
+        """Returns the compression level of member `name`. 0 means stored."""
+        from mimetypes import guess_type
+        mimetype = guess_type(name)[0] or ''
+        for pattern, level in self.rules:
+            if fnmatch(name, pattern) or fnmatch(mimetype, pattern):
+                return level
+
+        if self.store_compressed and any(
+                fnmatch(mimetype, pattern) for pattern in self.COMPRESSED_TYPES):
+            return 0
+
+        return self.default_level
+
+
+#: Store every member: fastest, biggest documents.
+COMPRESSION_NONE = CompressionPolicy(level=0)
+#: Fast compression, e.g. for documents converted right away to PDF.
+COMPRESSION_FAST = CompressionPolicy(level=1)
+#: zlib's default level. This is the default policy of Renderer.
+COMPRESSION_DEFAULT = CompressionPolicy()
+#: Smallest documents, compressing again the members copied from templates.
+COMPRESSION_BEST = CompressionPolicy(level=9, copy_raw=False)
+
+
+# ************************************************
+#
+#           INSTRUMENTATION
+#
+# ************************************************
+
+# Clocks used to time render stages: wall time and CPU time of the thread
+_wall_clock = getattr(time, 'perf_counter', time.time)
+_cpu_clock = getattr(time, 'thread_time',
+                     getattr(time, 'process_time', getattr(time, 'clock', None)))
+
+
+class RenderObserver(object):
+    """
+        Base class of render observers. Observers passed to Renderer are
+        notified of the stages of every render, e.g. to export their
+        statistics to a metrics system. Stages are:
+
+            unpack      unzip the template (when it is not cached)
+            prepare     prepare the fields of the template
+            unescape    unescape the jinja instructions of the template
+            compile     compile the template with jinja
+            render      evaluate the jinja templates
+            validate    check that rendered XML is well-formed
+            reparse     parse rendered XML into a DOM
+            images      load and insert images
+            pack        zip the rendered document
+
+        A stage may run many times in a render (e.g. render runs for
+        content.xml and styles.xml), its statistics are accumulated.
+        Observers are called from the rendering threads.
+
+        Example exporting the time of every stage:
+
+            class MetricsObserver(RenderObserver):
+                def on_stage_end(self, stage, stats):
+                    metrics.timing('secretary.' + stage.name, stage.wall_time)
+
+            engine = Renderer(observers=[MetricsObserver()])
+    """
+
+    def on_stage_start(self, stage, stats):
+        """Called when `stage`, a StageStats object, starts."""
+
+    def on_stage_end(self, stage, stats):
+        """Called when `stage`, a StageStats object, ends."""
+
+    def on_render_end(self, stats):
+        """Called with the RenderStats of a render when it is finished."""
+
+
+class StageStats(object):
+    """
+        Statistics of a render stage: the times it ran, its wall and CPU
+        time (in seconds), the bytes it read and wrote, counters of the
+        items it processed (fields, images, markdown...) and, if memory is
+        traced, its peak of allocated memory in bytes.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.peak_memory = None
+        self.counters = {}
+
+    def __repr__(self):
+        return '<StageStats %s: %.6fs>' % (self.name, self.wall_time)
+
+    def as_dict(self):
+        return dict(self.__dict__, counters=dict(self.counters))
+
+
+class RenderStats(object):
+    """
+        Statistics of a render: a StageStats for every stage run, in the
+        order stages first ran, and the totals of the render.
+
+        Counters are `fields` (fields prepared), `images` (images
+        inserted), `markdown` (markdown filter calls) and `cached` (1 if
+        the compiled template was taken from the cache).
+    """
+
+    def __init__(self, observers=(), trace_memory=False):
+        self.stages = OrderedDict()
+        self.counters = {}
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.observers = list(observers)
+        self.trace_memory = trace_memory
+        self._stages = []   # Stages running, innermost last
+
+    def __getitem__(self, name):
+        return self.stages[name]
+
+    def __repr__(self):
+        return '<RenderStats %.6fs: %s>' % (self.wall_time, ', '.join(
+            '%s %.6fs' % (stage.name, stage.wall_time)
+            for stage in self.stages.values()))
+
+    def count(self, name, value=1):
+        """Adds `value` to a counter of the render and its running stage."""
+        self.counters[name] = self.counters.get(name, 0) + value
+        if self._stages:
+            counters = self._stages[-1].counters
+            counters[name] = counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager timing the stage `name`. Yields its StageStats."""
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageStats(name)
+
+        for observer in self.observers:
+            observer.on_stage_start(stage, self)
+
+        memory = self.trace_memory and _memory_tracing.start()
+        self._stages.append(stage)
+        wall, cpu = _wall_clock(), _cpu_clock()
+        try:
+            yield stage
+        finally:
+            stage.wall_time += _wall_clock() - wall
+            stage.cpu_time += _cpu_clock() - cpu
+            stage.calls += 1
+            self._stages.pop()
+            peak = memory and _memory_tracing.peak(memory)
+            if peak is not None:
+                stage.peak_memory = max(stage.peak_memory or 0, peak)
+
+            for observer in self.observers:
+                observer.on_stage_end(stage, self)
+
+    def as_dict(self):
+        """Returns the statistics as a dict, e.g. to be exported as JSON"""
+        return {
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'counters': dict(self.counters),
+            'stages': [stage.as_dict() for stage in self.stages.values()],
+        }
+
+
+class _MemoryTracing(object):
+    # Renders tracing memory allocations with tracemalloc, which is process
+    # wide: tracing is started by the first traced render and stopped by the
+    # last one. Allocations of concurrent renders can't be told apart, so
+    # stages are only measured while a single render is traced.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.renders = 0
+        self.generation = 0     # Incremented when a traced render starts
+        self.started = False
+
+    def acquire(self):
+        # Called when a traced render starts. Returns False if tracemalloc
+        # is not available.
+        try:
+            import tracemalloc
+        except ImportError:
+            return False
+
+        with self.lock:
+            if self.renders == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started = True
+            self.renders += 1
+            self.generation += 1
+
+        return True
+
+    def release(self):
+        # Called when a render started by acquire ends
+        import tracemalloc
+
+        with self.lock:
+            self.renders -= 1
+            if self.renders == 0 and self.started:
+                tracemalloc.stop()
+                self.started = False
+
+    def start(self):
+        # Returns the state of tracing when a stage starts, or None if the
+        # stage can't be measured.
+        with self.lock:
+            if self.renders != 1:
+                return None
+
+            import tracemalloc
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            return self.generation, tracemalloc.get_traced_memory()[0]
+
+    def peak(self, state):
+        # Returns the peak of memory allocated since start returned `state`,
+        # or None if another traced render started since then.
+        generation, start = state
+        with self.lock:
+            if self.renders != 1 or self.generation != generation:
+                return None
+
+            import tracemalloc
+            return max(0, tracemalloc.get_traced_memory()[1] - start)
+
+
+_memory_tracing = _MemoryTracing()
+
+
+class _NoStats(object):
+    # Stand-in of RenderStats used when renders are not instrumented
+    def count(self, name, value=1):
+        pass
+
+    @contextmanager
+    def stage(self, name):
+        yield None
+
+_NO_STATS = _NoStats()
+
+
+# ************************************************
+#
+#           COMPILED TEMPLATES CACHE
+#
+# ************************************************
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'entries', 'size',
+                                     'max_entries', 'max_size'])
+
+
+class CompiledTemplate(object):
+    """
+        A template ready to be rendered, as returned by Renderer.compile.
+
+        Holds the per-template work done before rendering an ODT template:
+        the jinja templates of content.xml and styles.xml, the prepared
+        content.xml document (with an empty office:body) and every other
+        member of the template archive. The prepared content.xml is also
+        kept serialized around its office:body, so renders which don't
+        change it (e.g. by adding styles) don't copy it. Parts with no
+        jinja syntax have no template (styles.xml has no source either):
+        they are copied to rendered documents as they are. Instances are
+        immutable and can be rendered as many times as needed:
+
+            compiled = engine.compile('template.odt')
+            result = compiled.render(var1=val1, var2=val2, ...)
+
+        CompiledTemplate objects can be pickled, along with their Renderer,
+        as long as the filters of the Renderer environment can be pickled.
+        Jinja templates are compiled again from their prepared sources when
+        unpickling.
+    """
+
+    __slots__ = ('renderer', 'files', 'content', 'content_template',
+                 'styles_template', 'content_source', 'styles_source', 'size',
+                 'content_head', 'content_tail', 'manifest', '_variables',
+                 '_automatic_styles', '_style_names', '_head_parts')
+
+    def __init__(self, renderer, files, content, content_template,
+                 styles_template, content_source, styles_source):
+        init = super(CompiledTemplate, self).__setattr__
+        init('renderer', renderer)
+        init('files', files)
+        init('content', content)
+        init('content_template', content_template)
+        init('styles_template', styles_template)
+        init('content_source', content_source)
+        init('styles_source', styles_source)
+        init('_variables', None)
+
+        # content.xml before and after its office:body, and the manifest,
+        # shared by the renders which don't change them
+        head, tail = Renderer._content_parts(content)
+        init('content_head', head)
+        init('content_tail', tail)
+
+        # The office:automatic-styles node of content.xml, the names of its
+        # styles and the head split around this node (with its end tag
+        # left out), so that renders can add styles without copying the
+        # node. See RenderContext._automatic_styles
+        auto_styles = _child_element(content.documentElement,
+                                     'office:automatic-styles')
+        head_parts = None
+        if auto_styles is not None:
+            start = head.find('<office:automatic-styles')
+            auto_styles_xml = auto_styles.toxml()
+            end = start + len(auto_styles_xml)
+            if head[start:end] == auto_styles_xml:
+                if auto_styles_xml.endswith('/>'):
+                    auto_styles_xml = auto_styles_xml[:-2] + '>'
+                else:
+                    auto_styles_xml = auto_styles_xml[
+                        :-len('</office:automatic-styles>')]
+                head_parts = (head[:start], auto_styles_xml, head[end:])
+
+        if head_parts is None:
+            auto_styles = None
+        init('_automatic_styles', auto_styles)
+        init('_style_names', frozenset(
+            node.getAttribute('style:name') for node in
+            (auto_styles.childNodes if auto_styles is not None else ())
+            if node.nodeType == node.ELEMENT_NODE and
+            node.hasAttribute('style:name')))
+        init('_head_parts', head_parts)
+        manifest = files['META-INF/manifest.xml']
+        if isinstance(manifest, _RawMember):
+            manifest = manifest.decompress()
+        init('manifest', parseString(manifest))
+
+        # Approximated memory used by this template. Used by TemplateCache
+        # to honor its max_size limit. Members kept compressed are views of
+        # the template data, counted once.
+        buffers = set(data.buffer for data in files.values()
+                      if isinstance(data, _RawMember))
+        init('size', len(content_source) + len(styles_source or '') +
+                     len(head) + len(tail) +
+                     sum(len(data) for data in files.values()
+                         if isinstance(data, bytes)) +
+                     sum(buffer.size for buffer in buffers))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('CompiledTemplate objects are immutable')
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return (_load_compiled_template,
+                (self.renderer, self.files, self.content.toxml('utf-8'),
+                 self.content_source, self.styles_source))
+
+    @property
+    def variables(self):
+        """
+            The names of the variables referenced by this template (its
+            content.xml and styles.xml), as a frozenset. Environment
+            globals are not included.
+        """
+        if self._variables is None:
+            super(CompiledTemplate, self).__setattr__(
+                '_variables', self.renderer._template_variables(self))
+
+        return self._variables
+
+    def save(self, output):
+        """
+            Save this template to `output`, a filename or a writable file
+            object. Renderer.load_compiled loads saved templates ready to be
+            rendered, without preparing nor compiling them again:
+
+                engine.compile('template.odt').save('template.secretary')
+                ...
+                compiled = engine.load_compiled('template.secretary')
+
+            Saved templates keep the members of the template, the prepared
+            jinja sources and the Python code jinja compiled them into. The
+            code is only reused by the same Python and jinja2 versions;
+            other versions compile the sources again. Templates must be
+            loaded by a Renderer whose environment has the same syntax
+            settings (delimiters, autoescape, extensions...).
+        """
+        environment = self.renderer.environment
+        meta = {
+            'format': COMPILED_FORMAT,
+            'python': _code_tag(),
+            'jinja2': jinja2.__version__,
+            'environment': _environment_key(environment),
+        }
+
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zipdoc:
+            for name, data in self.files.items():
+                if isinstance(data, _RawMember):
+                    data.write(zipdoc)
+                else:
+                    zipdoc.writestr(_zipinfo(name, 0 if name == 'mimetype'
+                                             else 6), data)
+
+            compiled = {
+                'meta.json': json.dumps(meta, sort_keys=True),
+                'content.xml': self.content.toxml('utf-8'),
+            }
+            for name, template, source in (
+                    ('content', self.content_template, self.content_source),
+                    ('styles', self.styles_template, self.styles_source)):
+                if source is not None:
+                    compiled[name + '.jinja'] = source.encode('utf-8')
+                if template is not None:
+                    code = compile(environment.compile(source, raw=True),
+                                   '<template>', 'exec')
+                    compiled[name + '.code'] = marshal.dumps(code)
+
+            for name in sorted(compiled):
+                zipdoc.writestr(_zipinfo(COMPILED_MEMBERS_DIR + name, 6),
+                                compiled[name])
+
+    def render(self, **kwargs):
+        """
+            Render this template. Returns the rendered document in binary
+            format, like Renderer.render.
+        """
+        return self.renderer.render(self, **kwargs)
+
+    def render_to(self, fileobj, **kwargs):
+        """
+            Render this template into `fileobj`, like Renderer.render_to.
+        """
+        self.renderer.render_to(self, fileobj, **kwargs)
+
+
+def _load_compiled_template(renderer, files, content, content_source,
+                            styles_source):
+    # Rebuild a pickled CompiledTemplate
+    return CompiledTemplate(renderer, files, parseString(content),
+                            renderer._source_template(content_source),
+                            renderer._source_template(styles_source),
+                            content_source, styles_source)
+
+
+def _code_tag():
+    # Identifies the Python versions able to load marshalled code
+    implementation = getattr(sys, 'implementation', None)
+    return getattr(implementation, 'cache_tag', None) or \
+        'python%d%d' % sys.version_info[:2]
+
+
+def _environment_key(environment):
+    # The settings of a jinja environment its compiled code depends on
+    finalize = environment.finalize
+    if finalize is not None:
+        for kind in ('contextfunction', 'evalcontextfunction',
+                     'environmentfunction'):
+            if getattr(finalize, kind, False):
+                finalize = kind
+                break
+        else:
+            finalize = 'function'
+
+    autoescape = environment.autoescape
+    if callable(autoescape):
+        autoescape = 'function'
+
+    return [environment.block_start_string, environment.block_end_string,
+            environment.variable_start_string,
+            environment.variable_end_string,
+            environment.comment_start_string, environment.comment_end_string,
+            environment.line_statement_prefix,
+            environment.line_comment_prefix, environment.trim_blocks,
+            environment.lstrip_blocks, environment.newline_sequence,
+            environment.keep_trailing_newline,
+            bool(getattr(environment, 'is_async', False)),
+            autoescape, finalize, sorted(environment.extensions)]
+
+
+class LRUCache(object):
+    """
+        A bounded, thread safe LRU cache of objects with a `size`
+        attribute. Renderer uses it for compiled templates (TemplateCache),
+        media files (MediaCache) and converted markdown texts.
+
+        Entries are evicted, least recently used first, when the cache holds
+        more than `max_entries` of them or when the sum of their sizes
+        exceeds `max_size`. A limit of 0 (or None) means unlimited, except
+        for `max_entries=0` which disables the cache.
+    """
+
+    def __init__(self, max_entries, max_size=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __reduce__(self):
+        # Cached entries are not pickled, only the cache limits
+        return (type(self), (self.max_entries, self.max_size))
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Returns the entry cached under `key` or None."""
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+
+            # Re-insert the entry to mark it as the most recently used
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store `value` under `key`, evicting old entries if needed."""
+        if self.max_entries == 0:
+            return
+
+        if self.max_size and value.size > self.max_size:
+            # Never cache an entry bigger than the whole cache
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous.size
+
+            self._entries[key] = value
+            self.size += value.size
+
+            while self._entries and (
+                    (self.max_entries and
+                     len(self._entries) > self.max_entries) or
+                    (self.max_size and self.size > self.max_size)):
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def clear(self):
+        """Remove every entry and reset hit and miss counters."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Returns a CacheInfo tuple with the cache statistics."""
+        return CacheInfo(self.hits, self.misses, len(self._entries),
+                         self.size, self.max_entries, self.max_size)
+
+
+class TemplateCache(LRUCache):
+    """
+        A bounded LRU cache of CompiledTemplate objects, used by
+        Renderer.compile. Sizes are the approximated memory used by the
+        templates, in bytes.
+    """
+
+    def __init__(self, max_entries=32, max_size=64 * 1024 * 1024):
+        super(TemplateCache, self).__init__(max_entries, max_size)
+
+
+class MediaCache(LRUCache):
+    """
+        A bounded LRU cache of the media files loaded by Renderer.fs_loader,
+        the default media loader, shared by every render of a Renderer.
+        Files are identified by their path, modification time and size.
+    """
+
+
+# Media file data, as stored in MediaCache
+_LoadedMedia = namedtuple('_LoadedMedia', ['data', 'size'])
+
+
+class _MediaFile(io.BytesIO):
+    # A media file loaded from MediaCache
+    def __init__(self, data, name, key):
+        super(_MediaFile, self).__init__(data)
+        self.name = name
+        self._media_key = key
+
+
+def _media_key(filename):
+    # Identifies the content of a file on disk, see
+    # RenderContext.add_media_to_archive
+    stat = os.stat(filename)
+    return (path.abspath(filename), stat.st_mtime, stat.st_size)
+
+
+# Name of the jinja context variable holding the current RenderContext
+RENDER_CONTEXT_KEY = '__secretary__'
+
+
+class LazyVariable(object):
+    """
+        A template variable computed only if the template uses it:
+
+            engine.render('invoice.odt', invoice=invoice,
+                          rates=LazyVariable(fetch_exchange_rates))
+
+        `provider` is called with no arguments, at most once per render,
+        when the rendered template references the variable (see
+        CompiledTemplate.variables), even from a branch which is not taken.
+        Lazy variables the template doesn't reference are left out of the
+        template context. Providers may return awaitables, which are run
+        like those of media loaders (see Renderer.render_async).
+    """
+
+    __slots__ = ('provider',)
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def __repr__(self):
+        return 'LazyVariable(%r)' % (self.provider,)
+
+
+
+def _child_element(parent, name):
+    # Returns the first child element of a minidom node named `name`
+    for node in parent.childNodes:
+        if node.nodeType == node.ELEMENT_NODE and node.nodeName == name:
+            return node
+    return None
+
+
+class RenderContext(object):
+    """
+        Holds the state of a single render: the members of the archive being
+        generated, its content, styles and manifest documents and the images
+        requested by the image filter.
+
+        A new instance is created for every render, so a single Renderer can
+        render documents on many threads at once. Custom filters can reach
+        the current RenderContext through the jinja context:
+
+            @jinja2.contextfilter
+            def custom_filter(context, value):
+                render_context = RenderContext.of(context)
+                ...
+    """
+
+    def __init__(self, renderer, compiled):
+        self.renderer = renderer
+        self.compiled = compiled
+        self.files = dict(compiled.files)
+        self.styles = None
+        # Copies of the content and manifest documents of the template,
+        # made the first time they are used (see content and manifest)
+        self._content = None
+        self._manifest = None
+        self.template_images = dict()
+        self.render_vars = {}
+        # Paths of the media added to the archive, by file name and by
+        # content hash (see add_media_to_archive)
+        self.media_paths = {}
+        # Copy of the office:automatic-styles node of content.xml (see
+        # _automatic_styles), the styles added by this render (all the
+        # styles once the node is copied) by name, the styles added before
+        # the node is copied, and the names of the styles added by
+        # register_style, by their attributes and properties.
+        self._auto_styles = None
+        self._styles = {}
+        self._added_styles = []
+        self._registered_styles = {}
+        # Event loop of the render_async call running this render, where
+        # awaitables returned by media loaders are run
+        self.event_loop = getattr(renderer._local, 'event_loop', None)
+
+    @staticmethod
+    def of(context):
+        """Returns the RenderContext of a jinja context."""
+        return context.get(RENDER_CONTEXT_KEY)
+
+    @property
+    def content(self):
+        """
+            The content.xml document of this render, with an empty
+            office:body. It is copied from the template the first time it
+            is used.
+        """
+        if self._content is None:
+            if self._added_styles:
+                self._automatic_styles()
+
+            content = self.compiled.content.cloneNode(True)
+            if self._auto_styles is not None:
+                # Keep the styles added to the copy of automatic styles
+                root = content.documentElement
+                root.replaceChild(self._auto_styles, _child_element(
+                    root, 'office:automatic-styles'))
+            self._content = content
+        return self._content
+
+    @property
+    def manifest(self):
+        """
+            The manifest document of this render, copied from the template
+            the first time it is used.
+        """
+        if self._manifest is None:
+            self._manifest = self.compiled.manifest.cloneNode(True)
+        return self._manifest
+
+    def content_parts(self):
+        """
+            Returns the serialized content.xml document before and after
+            its office:body node.
+        """
+        compiled = self.compiled
+        if self._content is not None:
+            return Renderer._content_parts(self._content)
+        if self._auto_styles is not None:
+            before, _, after = compiled._head_parts
+            return (before + self._auto_styles.toxml() + after,
+                    compiled.content_tail)
+        if self._added_styles:
+            before, auto_styles, after = compiled._head_parts
+            return (before + auto_styles +
+                    ''.join(node.toxml() for node in self._added_styles) +
+                    '</office:automatic-styles>' + after,
+                    compiled.content_tail)
+        return compiled.content_head, compiled.content_tail
+
+    def add_image(self, value, args, kwargs):
+        """
+        Register an image to be loaded by the media loader. Returns the
+        key under which the image was registered.
+        """
+        from uuid import uuid4
+        key = uuid4().hex
+        self.template_images[key] = {
+            'value': value,
+            'args': args,
+            'kwargs': kwargs
+        }
+
+        return key
+
+    def add_media_to_archive(self, media, mime, name=''):
+        """
+        Adds to "Pictures" archive folder the file in `media` and register
+        it into manifest file. Returns the path of the file in the archive.
+
+        Media already added to the archive, identified by the hash of their
+        content, are added only once: the path of the first one is returned.
+        Files opened by Renderer.fs_loader are also identified by their
+        path, modification time and size, so they are read only once.
+        """
+        identity = getattr(media, '_media_key', None)
+        if identity is not None:
+            identity = ('file', identity, mime)
+            if identity in self.media_paths:
+                if hasattr(media, 'close'):
+                    media.close()
+                return self.media_paths[identity]
+
+        media.seek(0)
+        data = media.read(-1)
+        if hasattr(media, 'close'):
+            media.close()
+
+        content_hash = None
+        if isinstance(data, (bytes, bytearray)):
+            content_hash = ('hash', hashlib.sha1(data).hexdigest(), mime)
+
+        media_path = self.media_paths.get(content_hash)
+        if media_path is None:
+            media_path = self._add_media_file(media, data, mime, name)
+            if content_hash is not None:
+                self.media_paths[content_hash] = media_path
+
+        if identity is not None:
+            self.media_paths[identity] = media_path
+
+        return media_path
+
+    def _add_media_file(self, media, data, mime, name):
+        extension = None
+        if hasattr(media, 'name') and not name:
+            extension = path.splitext(media.name)
+            name      = extension[0]
+            extension = extension[1]
+
+        if not extension:
+            from mimetypes import guess_extension
+            extension = guess_extension(mime)
+
+        media_path = 'Pictures/%s%s' % (name, extension)
+        self.files[media_path] = data
+
+        files_node = self.manifest.getElementsByTagName('manifest:manifest')[0]
+        node = self.renderer.create_node(self.manifest, 'manifest:file-entry',
+                                         files_node)
+        node.setAttribute('manifest:full-path', media_path)
+        node.setAttribute('manifest:media-type', mime)
+
+        return media_path
+
+    def _automatic_styles(self):
+        # Returns the office:automatic-styles node of content.xml of this
+        # render, indexing its styles by name the first time. Unless
+        # content.xml was already copied, just this node is copied from the
+        # template, with the styles added so far. It is only needed to
+        # return the styles of the template (get_style_by_name), as new
+        # styles are kept apart (see _add_style).
+        if self._auto_styles is None:
+            if self._content is None and \
+                    self.compiled._automatic_styles is not None:
+                self._auto_styles = \
+                    self.compiled._automatic_styles.cloneNode(True)
+            else:
+                self._auto_styles = self.content.getElementsByTagName(
+                    'office:automatic-styles')[0]
+
+            self._styles = {}
+            for style_node in self._auto_styles.childNodes:
+                if style_node.nodeType == style_node.ELEMENT_NODE and \
+                   style_node.hasAttribute('style:name'):
+                    self._styles.setdefault(
+                        style_node.getAttribute('style:name'), style_node)
+
+            for style_node in self._added_styles:
+                self._add_style(style_node)
+            self._added_styles = []
+
+        return self._auto_styles
+
+    def _has_style(self, style_name):
+        # Tells if content.xml has an automatic style named style_name,
+        # without copying the automatic styles of the template
+        if self._auto_styles is None and self.compiled._automatic_styles \
+                is None:
+            self._automatic_styles()
+
+        return style_name in self._styles or (
+            self._auto_styles is None and
+            style_name in self.compiled._style_names)
+
+    def _add_style(self, style_node):
+        # Adds style_node to the automatic styles of content.xml. Until
+        # they are copied, added styles are kept apart and serialized after
+        # the styles of the template (see content_parts).
+        if self._auto_styles is None and self.compiled._automatic_styles \
+                is None:
+            self._automatic_styles()
+
+        self._styles.setdefault(style_node.getAttribute('style:name'),
+                                style_node)
+        if self._auto_styles is None:
+            self._added_styles.append(style_node)
+            return style_node
+
+        return self._auto_styles.appendChild(style_node)
+
+    def get_style_by_name(self, style_name):
+        """
+            Search in <office:automatic-styles> for style_name.
+            Return None if style_name is not found. Otherwise
+            return the style node
+        """
+        if style_name not in self._styles and self._has_style(style_name):
+            # A style of the template: return the one of this render
+            self._automatic_styles()
+        return self._styles.get(style_name)
+
+    def insert_style_in_content(self, style_name, attributes=None,
+        **style_properties):
+        """
+            Insert a new style into content.xml's <office:automatic-styles> node.
+            Returns a reference to the newly created node
+        """
+        document = self.compiled.content
+        style_node = document.createElement('style:style')
+
+        style_node.setAttribute('style:name', style_name)
+        style_node.setAttribute('style:family', 'text')
+        style_node.setAttribute('style:parent-style-name', 'Standard')
+
+        if attributes:
+            for k, v in attributes.items():
+                style_node.setAttribute('style:%s' % k, v)
+
+        if style_properties:
+            style_prop = document.createElement('style:text-properties')
+            for k, v in style_properties.items():
+                style_prop.setAttribute('%s' % k, v)
+
+            style_node.appendChild(style_prop)
+
+        return self._add_style(style_node)
+
+    def register_style(self, name=None, attributes=None, **style_properties):
+        """
+            Returns the name of a text style with the given attributes and
+            properties, inserting it into <office:automatic-styles> only if
+            needed.
+
+            Named styles are inserted when the document has no style with
+            that name. Styles without name are shared by the callers using
+            the same attributes and properties, under a generated name.
+        """
+        if name is not None:
+            if not self._has_style(name):
+                self.insert_style_in_content(name, attributes,
+                                             **style_properties)
+            return name
+
+        key = (tuple(sorted((attributes or {}).items())),
+               tuple(sorted(style_properties.items())))
+        name = self._registered_styles.get(key)
+        if name is None:
+            name = 'secretary_%d' % len(self._registered_styles)
+            while self._has_style(name):
+                name += '_'
+
+            self.insert_style_in_content(name, attributes, **style_properties)
+            self._registered_styles[key] = name
+
+        return name
+
+
+    def _page_break_style(self):
+        # Returns the name of an automatic paragraph style starting a new
+        # page, inserting it the first time.
+        name = self._registered_styles.get('page-break')
+        if name is None:
+            name = 'secretary_page_break'
+            while self._has_style(name):
+                name += '_'
+
+            document = self.compiled.content
+            style_node = document.createElement('style:style')
+            style_node.setAttribute('style:name', name)
+            style_node.setAttribute('style:family', 'paragraph')
+            properties = document.createElement('style:paragraph-properties')
+            properties.setAttribute('fo:break-before', 'page')
+            style_node.appendChild(properties)
+
+            self._add_style(style_node)
+            self._registered_styles['page-break'] = name
+
+        return name
+
+
+def _render_context_property(name):
+    # Renderer attributes which used to hold the state of the current render
+    # are now proxies to the RenderContext of the current thread.
+    def getter(self):
+        return getattr(self._current_render_context(), name)
+
+    def setter(self, value):
+        setattr(self._current_render_context(), name, value)
+
+    return property(getter, setter, doc='%s of the current render' % name)
+
+
+# Expressions matching jinja tags, by delimiters of the environment. See
+# Renderer._compile_tags_expressions
+_tags_expressions = {}
+
+def _compile_tags_expressions(variable_start, variable_end, block_start,
+                              block_end):
+    # Returns the Renderer attributes holding the expressions which match
+    # the jinja tags with the given delimiters
+    start_delimiters = (variable_start, block_start)
+    end_delimiters = (variable_end, block_end)
+
+    def chars(delimiters):
+        return re.escape(''.join(sorted(set(''.join(delimiters)))))
+
+    def alternatives(delimiters):
+        return '|'.join(re.escape(delimiter) for delimiter in delimiters)
+
+    variable_start, variable_end, block_start, block_end = [
+        re.escape(delimiter) for delimiter in (variable_start, variable_end,
+                                               block_start, block_end)]
+
+    return {
+        'tag_pattern': re.compile(r'(?is)^({0}|{1}).*({2}|{3})$'.format(
+            variable_start, block_start, variable_end, block_end)),
+        'variable_pattern': re.compile(r'(?is)({0})(.*)({1})$'.format(
+            variable_start, variable_end)),
+        'block_pattern': re.compile(r'(?is)({0})(.*)({1})$'.format(
+            block_start, block_end)),
+
+        # Used to unescape jinja instructions. An entity is within an
+        # instruction when it follows a start delimiter with no chars of end
+        # delimiters in between, and is followed by an end delimiter with no
+        # chars of start delimiters in between.
+        'start_delimiters': start_delimiters,
+        'start_delimiters_chars': frozenset(''.join(start_delimiters)),
+        # A start delimiter and the text following it, up to the first char
+        # of an end delimiter
+        'tag_start_pattern': re.compile(r'(?:{0})([^{1}]*)'.format(
+            alternatives(start_delimiters), chars(end_delimiters))),
+        # Text up to an end delimiter, without chars of start delimiters
+        'tag_end_pattern': re.compile(r'[^{0}]*?(?:{1})'.format(
+            chars(start_delimiters), alternatives(end_delimiters))),
+        'entity_pattern': re.compile(
+            r'(?i)&((?:amp;)*)(gt|lt|amp|quot|apos);'),
+        'link_pattern': re.compile(r'(?is)(xlink:href=\")secretary:(.*?)(\")'),
+    }
+
+
+class Renderer(object):
+    """
+        Main engine to convert and ODT document into a jinja
+        compatible template.
+
+        Basic use example:
+            engine = Renderer()
+            result = engine.render(template, var1=val1, var2=val2, ...)
+
+
+        Renderer provides an environment property which should be used
+        to add custom filters to the ODF render.
+            engine = Renderer()
+            engine.environment.filters['custom_filter'] = filterFn
+            result = engine.render('template.odt', var1=val1, ...)
+
+        A Renderer can be shared by many threads. The state of each render
+        is kept in a RenderContext object.
+    """
+
+    files           = _render_context_property('files')
+    content         = _render_context_property('content')
+    styles          = _render_context_property('styles')
+    manifest        = _render_context_property('manifest')
+    template_images = _render_context_property('template_images')
+    render_vars     = _render_context_property('render_vars')
+
+    def __init__(self, environment=None, **kwargs):
+        """
+        Create a Renderer instance.
+
+        args:
+            environment: Use this jinja2 environment. If not specified, we
+                         create a new environment for this class instance.
+            media_path: Path used by the default media loader to find
+                        images.
+            cache_entries: Max number of compiled templates kept in the
+                           templates cache. Use 0 to disable the cache.
+            cache_size: Max size, in bytes, of the templates cache.
+            streaming: Render content.xml as a stream, see Renderer.render_to.
+            spool_size: When streaming, max size in bytes of the rendered
+                        content kept in memory before using a temporary file.
+            validation: How rendered XML is checked before being written to
+                        the document. One of:
+                        VALIDATE_NONE: no checks at all.
+                        VALIDATE_WELLFORMED (default): check well-formedness
+                            with a fast expat pass.
+                        VALIDATE_DOM: parse rendered XML into a DOM and
+                            serialize it back. This was the only behavior of
+                            Secretary before validation levels existed.
+                        Rendered XML is always parsed into a DOM when images
+                        are replaced.
+            xml_backend: XML library used to prepare templates: 'minidom'
+                         (default), 'etree', 'lxml' or an XMLBackend
+                         instance.
+            mmap_templates: Memory map template files instead of reading
+                            them (default False). Compiled templates keep
+                            their files mapped while they are cached:
+                            mapped files must be replaced by new files
+                            (e.g. os.replace), never written in place, which
+                            kills the process (SIGBUS) when it is truncated.
+            compression: CompressionPolicy of rendered documents, or a zlib
+                         compression level. Defaults to COMPRESSION_DEFAULT.
+            media_cache_entries: Max number of media files kept in memory
+                                 by the default media loader, to be used
+                                 by later renders. Default 0, no cache.
+            media_cache_size: Max size, in bytes, of the media cache.
+            markdown_cache_entries: Max number of markdown texts whose ODT
+                                    text is kept by the markdown filter.
+                                    Default 1024, 0 disables the cache.
+            markdown_cache_size: Max size, in characters, of the markdown
+                                 cache. Default 4M.
+            media_workers: Max number of images requested at once to the
+                           media loader. Default 1: images are loaded one
+                           by one. With more workers the media loader is
+                           called from a pool of threads. Media loaders
+                           returning awaitables are run in an asyncio
+                           event loop, up to media_workers at once.
+                           Images are always added to documents in
+                           document order.
+            media_timeout: Seconds to wait for each image, default None (no
+                           timeout). SecretaryError is raised when an image
+                           is not loaded on time. With a timeout, media
+                           loaders are always called from the pool of
+                           threads, where those timed out keep running.
+            async_executor: concurrent.futures.Executor where render_async
+                            runs renders, usually a ThreadPoolExecutor.
+                            Default None, the default executor of the
+                            event loop.
+            async_renders: Max number of render_async calls rendering at
+                           once in an event loop. Other calls wait for
+                           their turn. Defaults to the number of CPUs.
+            observers: RenderObserver objects notified of the stages of
+                       every render. See also render_with_stats.
+            trace_memory: Trace the memory allocated by every stage of
+                          instrumented renders with tracemalloc (slow).
+                          Stages are not measured while other renders are
+                          traced by another thread.
+            compression_workers: Number of threads used to compress big
+                                 members of documents in parallel. Defaults
+                                 to the number of CPUs, up to 4. Use 0 or 1
+                                 to compress members in the rendering
+                                 thread.
+
+        """
+        self.log = logging.getLogger(__name__)
+        self.log.debug('Initing a Renderer instance\nTemplate')
+
+        if environment:
+            self.environment = environment
+        else:
+            self.environment = Environment(undefined=UndefinedSilently,
+                                           autoescape=True,
+                                           finalize=self.finalize_value)
+            # Register filters
+            self.environment.filters['pad'] = pad_string
+            self.environment.filters['markdown'] = self.markdown_filter
+            self.environment.filters['image'] = self.image_filter
+            self.environment.globals['SafeValue'] = jinja2.Markup
+
+        self.media_path = kwargs.pop('media_path', '')
+        self.media_callback = self.fs_loader
+        self.cache = TemplateCache(kwargs.pop('cache_entries', 32),
+                                   kwargs.pop('cache_size', 64 * 1024 * 1024))
+        self.streaming = kwargs.pop('streaming', False)
+        self.spool_size = kwargs.pop('spool_size', 4 * 1024 * 1024)
+        self.validation = kwargs.pop('validation', VALIDATE_WELLFORMED)
+        if self.validation not in (VALIDATE_NONE, VALIDATE_WELLFORMED,
+                                   VALIDATE_DOM):
+            raise ValueError('Unknown validation level: %r' % self.validation)
+        self.xml_backend = get_xml_backend(kwargs.pop('xml_backend', 'minidom'))
+        self.mmap_templates = kwargs.pop('mmap_templates', False)
+        self.media_cache = MediaCache(kwargs.pop('media_cache_entries', 0),
+                                      kwargs.pop('media_cache_size',
+                                                 32 * 1024 * 1024))
+        self.markdown_cache = LRUCache(
+            kwargs.pop('markdown_cache_entries', 1024),
+            kwargs.pop('markdown_cache_size', 4 * 1024 * 1024))
+        self.media_workers = kwargs.pop('media_workers', 1)
+        self.media_timeout = kwargs.pop('media_timeout', None)
+        self._media_pool = None
+        self.compression = kwargs.pop('compression', COMPRESSION_DEFAULT)
+        if not isinstance(self.compression, CompressionPolicy):
+            self.compression = CompressionPolicy(level=self.compression)
+        self.compression_workers = kwargs.pop('compression_workers', None)
+        if self.compression_workers is None:
+            self.compression_workers = min(4, _CPU_COUNT)
+        self._compression_pool = None
+        self._pool_lock = threading.Lock()
+
+        self.observers = list(kwargs.pop('observers', ()))
+        self.trace_memory = kwargs.pop('trace_memory', False)
+        self.async_executor = kwargs.pop('async_executor', None)
+        self.async_renders = kwargs.pop('async_renders', None) or _CPU_COUNT
+
+        self._local = threading.local()
+        self._compile_tags_expressions()
+
+    def __getstate__(self):
+        # Renderers are pickled to be sent to worker processes. The state of
+        # renders running in this process is left behind.
+        state = self.__dict__.copy()
+        del state['_local']
+        # Loggers are pickled by name only since Python 3.7
+        del state['log']
+        del state['_compression_pool']
+        del state['_media_pool']
+        del state['_pool_lock']
+        state['async_executor'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.log = logging.getLogger(__name__)
+        self._local = threading.local()
+        self._compression_pool = None
+        self._pool_lock = threading.Lock()
+        self._media_pool = None
+
+    @property
+    def render_context(self):
+        """The RenderContext of the render running in the current thread."""
+        return getattr(self._local, 'context', None)
+
+    def _current_render_context(self):
+        render_context = self.render_context
+        if render_context is None:
+            raise AttributeError('No render in progress in this thread')
+
+        return render_context
+
+    @property
+    def _stats(self):
+        # RenderStats of the render running in the current thread
+        return getattr(self._local, 'stats', None) or _NO_STATS
+
+    @contextmanager
+    def _instrument(self, stats=None):
+        # Collects the statistics of the render run in this block, if it is
+        # observed or `stats`, a RenderStats object, is given.
+        if stats is None and self.observers:
+            stats = RenderStats(self.observers, self.trace_memory)
+
+        if stats is None:
+            yield None
+            return
+
+        tracing = stats.trace_memory and _memory_tracing.acquire()
+
+        previous_stats = getattr(self._local, 'stats', None)
+        self._local.stats = stats
+        wall, cpu = _wall_clock(), _cpu_clock()
+        try:
+            yield stats
+        finally:
+            stats.wall_time += _wall_clock() - wall
+            stats.cpu_time += _cpu_clock() - cpu
+            self._local.stats = previous_stats
+            if tracing:
+                _memory_tracing.release()
+
+        for observer in stats.observers:
+            observer.on_render_end(stats)
+
+    @jinja2.evalcontextfilter
+    def finalize_value(self, value, *args):
+        """Escapes variables values."""
+        if isinstance(value, Markup):
+            return value
+
+        return Markup(self.get_escaped_var_value(value))
+
+    def media_loader(self, callback):
+        """This sets the the media loader. A user defined function which
+        loads media. The function should take a template value, optionals
+        args and kwargs. Is media exists should return a tuple whose first
+        element if a file object type representing the media and its second
+        elements is the media mimetype.
+
+        See Renderer.fs_loader funcion for an example"""
+        self.media_callback = callback
+        return callback
+
+    def _unpack_template(self, template):
+        # And Open/libreOffice is just a ZIP file. Here we unarchive the file
+        # and return a dict with every file in the archive
+        self.log.debug('Unpacking template file')
+
+        # Members are not read from the archive: they are views of the
+        # template data, memory mapped for template files. Only the members
+        # we render are decompressed.
+        if isinstance(template, basestring) and self.mmap_templates:
+            buffer = _ArchiveBuffer.map(template)
+            template = open(template, 'rb')
+        else:
+            if isinstance(template, basestring):
+                with open(template, 'rb') as template_file:
+                    data = template_file.read()
+            elif hasattr(template, 'getvalue'):
+                data = template.getvalue()
+            else:
+                template.seek(0)
+                data = template.read()
+
+            buffer = _ArchiveBuffer(data)
+            template = io.BytesIO(data)
+
+        archive_files = {}
+        with zipfile.ZipFile(template, 'r') as archive:
+            for zfile in archive.filelist:
+                if not _RawMember.can_copy(zfile):
+                    archive_files[zfile.filename] = archive.read(zfile.filename)
+                    continue
+
+                member = _RawMember.read(buffer, zfile)
+                if zfile.filename in RENDERED_MEMBERS:
+                    member = member.decompress()
+                archive_files[zfile.filename] = member
+
+        template.close()
+        return archive_files
+
+        self.log.debug('Unpack completed')
+
+    def _pack_document(self, files, zip_file=None):
+        # Store to a zip files in files. The archive is written to zip_file,
+        # which can be any writable file object (seekable or not) or a
+        # filename. A new BytesIO object is used if zip_file is not given.
+        with self._stats.stage('pack') as stage:
+            zip_file = self._pack_members(files, zip_file, stage)
+
+        return zip_file
+
+    def _pack_members(self, files, zip_file, stage):
+        self.log.debug('packing document')
+        if zip_file is None:
+            zip_file = io.BytesIO()
+
+        mimetype = files['mimetype']
+        del files['mimetype']
+
+        zipdoc = zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED)
+
+        # ODF packages start with the mimetype stored without compression.
+        # It is written with its size and CRC in its header, even when
+        # zip_file is not seekable, where zipfile would write them in a
+        # data descriptor after the data.
+        if isinstance(mimetype, _RawMember):
+            mimetype = mimetype.decompress()
+        elif not isinstance(mimetype, bytes):
+            mimetype = mimetype.encode('ascii')
+        _RawMember.compress('mimetype', mimetype, 0).write(zipdoc)
+
+        for fname, content in self._compressed_members(files):
+            if isinstance(content, _RawMember):
+                content.write(zipdoc)
+                continue
+
+            # Streamed members are iterables of chunks, deflated as they
+            # are written into the archive. Older zipfile versions can't
+            # write members in chunks: they are joined and compressed.
+            level = self.compression.level(fname)
+            if not _ZIPFILE_WRITES:
+                _RawMember.compress(fname, b''.join(content), level) \
+                    .write(zipdoc)
+                continue
+
+            with zipdoc.open(_zipinfo(fname, level), 'w') as member:
+                for chunk in content:
+                    member.write(chunk)
+
+        zipdoc.close()
+        self.log.debug('Document packing completed')
+
+        if stage is not None:
+            for zinfo in zipdoc.infolist():
+                stage.bytes_in += zinfo.file_size
+                stage.bytes_out += zinfo.compress_size
+
+        return zip_file
+
+    def _compressed_members(self, files):
+        # Yields (name, content) for the members in files, compressing
+        # members given as bytes into _RawMember objects. Big members are
+        # compressed in parallel by a pool of threads (zlib releases the
+        # GIL), while the previous ones are written. At most
+        # compression_workers of them are compressed ahead, so compressed
+        # members are released as they are written.
+        policy = self.compression
+        pool = None
+        if self.compression_workers > 1 and sum(
+                1 for data in files.values() if isinstance(data, bytes) and
+                len(data) >= PARALLEL_COMPRESSION_SIZE) > 1:
+            pool = self._get_compression_pool()
+
+        def next_member():
+            fname, content = members.popleft()
+            if isinstance(content, tuple):
+                content = _RawMember.compress(*content)
+            elif hasattr(content, 'result'):
+                content = content.result()
+            return fname, content
+
+        members = deque()
+        compressing = 0
+        for fname, content in files.items():
+            if isinstance(content, _RawMember) and not policy.copy_raw:
+                content = content.decompress()
+
+            if isinstance(content, bytes):
+                compress_args = (fname, content, policy.level(fname))
+                if pool is not None and len(content) >= PARALLEL_COMPRESSION_SIZE:
+                    content = pool.submit(_RawMember.compress, *compress_args)
+                    compressing += 1
+                else:
+                    content = compress_args
+
+            members.append((fname, content))
+            while compressing and compressing >= self.compression_workers:
+                if hasattr(members[0][1], 'result'):
+                    compressing -= 1
+                yield next_member()
+
+        while members:
+            yield next_member()
+
+    def _get_compression_pool(self):
+        with self._pool_lock:
+            if self._compression_pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._compression_pool = ThreadPoolExecutor(
+                    max_workers=self.compression_workers)
+
+            return self._compression_pool
+
+    def _get_media_pool(self):
+        with self._pool_lock:
+            if self._media_pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._media_pool = ThreadPoolExecutor(
+                    max_workers=self.media_workers)
+
+            return self._media_pool
+
+    def _compile_tags_expressions(self):
+        # The expressions only depend on the delimiters of the environment,
+        # so Renderers with the same delimiters share them
+        environment = self.environment
+        delimiters = (environment.variable_start_string,
+                      environment.variable_end_string,
+                      environment.block_start_string,
+                      environment.block_end_string)
+        expressions = _tags_expressions.get(delimiters)
+        if expressions is None:
+            expressions = _compile_tags_expressions(*delimiters)
+            _tags_expressions[delimiters] = expressions
+
+        self.__dict__.update(expressions)
+
+    def _is_jinja_tag(self, tag):
+        """
+            Returns True is tag (str) is a valid jinja instruction tag.
+        """
+
+        return len(self.tag_pattern.findall(tag)) > 0
+
+
+    def _is_block_tag(self, tag):
+        """
+            Returns True is tag (str) is a jinja flow control tag.
+        """
+        return len(self.block_pattern.findall(tag)) > 0
+
+
+    def _tags_in_document(self, document):
+        """
+            Yields (tag, content) for every jinja instruction tag in document.
+        """
+        backend = self.xml_backend
+        for tag in backend.fields(document):
+            content = backend.text(tag)
+            if not content:
+                continue
+
+            content = content.strip()
+            if not self._is_jinja_tag(content):
+                continue
+
+            yield tag, content
+
+
+    def _census_tags(self, document, tags):
+        """
+        Make a census of the jinja tags in document. We count all the
+        children tags nodes within their parents. This process is necesary
+        to automaticaly avoid generating invalid documents when mixing block
+        tags in differents parts of a document.
+
+        Only nodes containing one tag have to be told apart from nodes with
+        more, so counts stop at 2: once a node has two tags so do all its
+        ancestors, and climbing the tree stops there. This keeps the census
+        linear in the size of the document.
+
+        Returns a dict with the tags count of every node containing tags.
+        """
+        counts = {}
+        backend = self.xml_backend
+        for tag, content in tags:
+            node = backend.parent(document, tag)
+            while node is not None:
+                count = counts.get(node, 0)
+                if count > 1:
+                    break
+
+                counts[node] = count + 1
+                node = backend.parent(document, node)
+
+        return counts
+
+
+    def  _prepare_document_tags(self, document):
+        """ Here we search for every field node present in xml_document.
+        For each field we found we do:
+        * if field is a print field ({{ field }}), we replace it with a
+          <text:span> node.
+
+        * if field is a control flow ({% %}), then we find immediate node of
+          type indicated in field's `text:description` attribute and replace
+          the whole node and its childrens with field's content.
+
+          If `text:description` attribute starts with `before::` or `after::`,
+          then we move field content before or after the node in description.
+
+          If no `text:description` is available, find the immediate common
+          parent of this and any other field and replace its child and
+          original parent of field with the field content.
+
+          e.g.: original
+          <table>
+              <table:row>
+                  <field>{% for bar in bars %}</field>
+              </table:row>
+              <paragraph>
+                  <field>{{ bar }}</field>
+              </paragraph>
+              <table:row>
+                  <field>{% endfor %}</field>
+              </table:row>
+          </table>
+
+          After processing:
+          <table>
+              {% for bar in bars %}
+              <paragraph>
+                  <text:span>{{ bar }}</text:span>
+              </paragraph>
+              {% endfor %}
+          </table>
+        """
+
+        # -------------------------------------------------------------------- #
+        # We have to replace a node, let's call it "placeholder", with the
+        # content of our jinja tag. The placeholder can be a node with all its
+        # children. Node's "text:description" attribute indicates how far we
+        # can scale up in the tree hierarchy to get our placeholder node. When
+        # said attribute is not present, then we scale up until we find a
+        # common parent for this tag and any other tag.
+        # -------------------------------------------------------------------- #
+        #
+        # Every placeholder is resolved before changing the document, and all
+        # the changes are done at once by the XML backend.
+        # -------------------------------------------------------------------- #
+        self.log.debug('Preparing document tags')
+        backend = self.xml_backend
+        tags = list(self._tags_in_document(document))
+        self._stats.count('fields', len(tags))
+        counts = self._census_tags(document, tags)
+        parents_of_type = {}
+        insertions, removals = [], []
+
+        for tag, content in tags:
+            placeholder = tag
+            is_block = self._is_block_tag(content)
+            scale_to = backend.attribute(tag, 'text:description').strip().lower()
+
+            if content.lower().find('|markdown') > 0:
+                # Take whole paragraph when handling a markdown field
+                scale_to = 'text:p'
+
+            if scale_to:
+                if FLOW_REFERENCES.get(scale_to, False):
+                    placeholder = self._parent_of_type(
+                        document, tag, FLOW_REFERENCES[scale_to],
+                        parents_of_type
+                    )
+
+                span = False
+
+            elif is_block:
+                # expand up the placeholder until a shared parent is found
+                parent = backend.parent(document, placeholder)
+                while not counts[parent] > 1:
+                    placeholder = parent
+                    parent = backend.parent(document, placeholder)
+
+                span = False
+
+            else:
+                span = True
+
+            insertions.append((placeholder, content, span,
+                               scale_to.startswith('after::')))
+
+            if scale_to.startswith(('after::', 'before::')):
+                # Don't remove whole field tag, only "text:text-input" container
+                placeholder = self._parent_of_type(document, tag, 'text:p',
+                                                   parents_of_type)
+
+
+            # Finally, remove the placeholder
+            removals.append(placeholder)
+
+        backend.edit(document, insertions, removals)
+
+    def _unescape_entities(self, xml_text):
+        """
+        Unescape links and '&amp;', '&lt;', '&quot;' and '&gt;' within jinja
+        instructions. xml_text is scanned once, using the expressions
+        compiled in _compile_tags_expressions.
+        """
+        output = []
+        position = 0
+        search_from = 0
+
+        while True:
+            tag_start = self.tag_start_pattern.search(xml_text, search_from)
+            if tag_start is None:
+                break
+
+            start, end = tag_start.span(1)
+            search_from = end
+            for delimiter in self.start_delimiters:
+                # The char ending the text may be the end of a start
+                # delimiter too (e.g. '{%' in '{{ {%'), scan it again.
+                if end < len(xml_text) and \
+                        xml_text.endswith(delimiter, 0, end + 1):
+                    search_from = max(end + 1 - len(delimiter),
+                                      tag_start.start() + 1)
+
+            if '&' not in tag_start.group(1):
+                continue
+
+            # Entities before a char of a start delimiter can't reach an end
+            # delimiter.
+            start = max([start] + [xml_text.rfind(char, start, end) + 1
+                                   for char in self.start_delimiters_chars])
+            if xml_text.find('&', start, end) < 0 or \
+                    not self.tag_end_pattern.match(xml_text, end):
+                continue
+
+            for entity in self.entity_pattern.finditer(xml_text, start, end):
+                output.append(xml_text[position:entity.start()])
+                output.append(self._unescape_entity(entity))
+                position = entity.end()
+
+        output.append(xml_text[position:])
+        return self._unescape_links(''.join(output))
+
+    @staticmethod
+    def _unescape_entity(match):
+        amps, name = match.group(1, 2)
+        if amps and name.lower() in ('gt', 'lt'):
+            # '&amp;gt;' is unescaped once, to '&gt;'
+            return '&%s;' % name
+
+        # '&amp;amp;' and '&amp;quot;' are fully unescaped
+        return XML_UNESCAPED_ENTITIES[name.lower()]
+
+    def _unescape_links(self, xml_text):
+        """Fix Libreoffice auto escaping of xlink:href attribute values.
+        This unescaping is only done on 'secretary' scheme URLs."""
+        nested_links = []
+
+        def replacement(match):
+            value = self.variable_pattern.sub(r'\1 SafeValue(\2) \3',
+                                              unquote(match.group(2)))
+            if re.search(r'(?i)xlink:href=|^secretary:', value):
+                # The unquoted URL contains another link to unescape
+                nested_links.append(value)
+
+            return ''.join([match.group(1), value, match.group(3)])
+
+        xml_text = self.link_pattern.sub(replacement, xml_text)
+        if nested_links:
+            return self._unescape_links(xml_text)
+
+        return xml_text
+
+    @staticmethod
+    def get_escaped_var_value(value):
+        """
+        Encodes XML reserved chars in value (eg. &, <, >) and also replaces
+        the control chars \n and \t control chars to their ODF counterparts.
+        """
+        value = Markup.escape(value)
+        return (
+            value.replace('\n', Markup('<text:line-break/>'))
+                 .replace('\t', Markup('<text:tab/>'))
+                 .replace('\x0b', '<text:space/>')
+                 .replace('\x0c', '<text:space/>')
+        )
+
+
+    def add_media_to_archive(self, media, mime, name=''):
+        """
+        Adds to "Pictures" archive folder the file in `media` and register
+        it into manifest file of the current render.
+        """
+        return self._current_render_context().add_media_to_archive(
+            media, mime, name)
+
+
+    def fs_loader(self, media, *args, **kwargs):
+        """Loads a file from the file system.
+        :param media: A file object or a relative or absolute path of a file.
+        :type media: unicode
+        """
+        if hasattr(media, 'seek') and hasattr(media, 'read'):
+            return (media, 'image/jpeg')
+        elif path.isfile(media):
+            filename = media
+        else:
+            if not self.media_path:
+                self.log.debug('media_path property not specified to load images from.')
+                return
+
+            filename = path.join(self.media_path, media)
+            if not path.isfile(filename):
+                self.log.debug('Media file "%s" does not exists.' % filename)
+                return
+
+        from mimetypes import guess_type
+        mime = guess_type(filename)
+        key = _media_key(filename)
+        if self.media_cache.max_entries:
+            return (self._cached_media(filename, key),
+                    mime[0] if mime else None)
+
+        media = open(filename, 'rb')
+        media._media_key = key
+        return (media, mime[0] if mime else None)
+
+    def _cached_media(self, filename, key):
+        # Returns a file object with the content of filename, which is read
+        # only when it is not in the media cache.
+        media = self.media_cache.get(key)
+        if media is None:
+            with open(filename, 'rb') as media_file:
+                data = media_file.read()
+            media = _LoadedMedia(data, len(data))
+            self.media_cache.put(key, media)
+
+        return _MediaFile(media.data, filename, key)
+
+
+    def replace_images(self, xml_document, render_context=None):
+        """Perform images replacements"""
+        self.log.debug('Inserting images')
+        render_context = render_context or self._current_render_context()
+        template_images = render_context.template_images
+        frames = xml_document.getElementsByTagName('draw:frame')
+
+        images = []
+        for frame in frames:
             if not frame.hasChildNodes():
                 continue
 
             key = frame.getAttribute('draw:name')
-            if key not in self.template_images:
+            if key not in template_images:
                 continue
 
             # Get frame attributes
@@ -541,126 +2530,982 @@ class Renderer(object):
                 attr = image_node.attributes.item(i)
                 image_attrs[attr.name] = attr.value
 
-            # Request to media loader the image to use
-            image = self.media_callback(self.template_images[key]['value'],
-                                        *self.template_images[key]['args'],
-                                        frame_attrs=frame_attrs,
-                                        image_attrs=image_attrs,
-                                        **self.template_images[key]['kwargs'])
+            images.append((frame, image_node, key, frame_attrs, image_attrs))
+
+        self._load_images(render_context,
+                          [image[2:] for image in images])
+
+        for frame, image_node, key, frame_attrs, image_attrs in images:
+            # Update frame and image node attrs (if they where updated in
+            # media_callback call)
+            for k, v in frame_attrs.items():
+                frame.setAttribute(k, v)
+
+            for k, v in image_attrs.items():
+                image_node.setAttribute(k, v)
+
+    def _load_images(self, render_context, images):
+        """
+        Load the images in `images`, a list of (key, frame_attrs,
+        image_attrs) tuples, and add them to the archive in document order.
+        Up to media_workers images are requested at once to the media loader.
+        """
+        if self.media_workers <= 1 or len(images) <= 1:
+            for image in images:
+                self._load_image(render_context, *image)
+            return
+
+        pool = self._get_media_pool()
+        requests = deque(pool.submit(self._request_image, render_context,
+                                     *image) for image in images)
+        loaded = []     # Images waiting for previous awaitables
+        try:
+            for image in images:
+                result = self._image_result(render_context, image[0],
+                                            requests.popleft())
+                if loaded or _isawaitable(result):
+                    loaded.append((image, result))
+                else:
+                    self._add_image(render_context, result, *image)
+        finally:
+            for request in requests:
+                request.cancel()
+
+        results = _await_all([result for image, result in loaded],
+                             self.media_workers, self.media_timeout,
+                             render_context.event_loop)
+        for (image, _), result in zip(loaded, results):
+            self._add_image(render_context, result, *image)
+
+    def _load_image(self, render_context, key, frame_attrs, image_attrs):
+        """
+        Request to media loader the image registered under `key` and add it
+        to the archive. frame_attrs and image_attrs, the attributes of the
+        draw:frame and draw:image nodes, are updated in place.
+        """
+        if self.media_timeout is None:
+            image = self._request_image(render_context, key, frame_attrs,
+                                        image_attrs)
+        else:
+            # Requested from the media pool, to stop waiting on time
+            image = self._image_result(render_context, key,
+                self._get_media_pool().submit(self._request_image,
+                                              render_context, key,
+                                              frame_attrs, image_attrs))
+        if _isawaitable(image):
+            image = _await_all([image], 1, self.media_timeout,
+                               render_context.event_loop)[0]
+
+        self._add_image(render_context, image, key, frame_attrs, image_attrs)
+
+    def _image_result(self, render_context, key, request):
+        # Waits for `request`, the future of a media loader call, up to
+        # media_timeout seconds
+        from concurrent.futures import TimeoutError as FuturesTimeoutError
+        try:
+            return request.result(self.media_timeout)
+        except FuturesTimeoutError:
+            raise SecretaryError('Timed out loading image %r' %
+                render_context.template_images[key]['value'])
+
+    def _request_image(self, render_context, key, frame_attrs, image_attrs):
+        # Calls the media loader, which may run on a thread of the media
+        # pool: the render context is made reachable from it.
+        template_image = render_context.template_images[key]
+        previous_context = self.render_context
+        self._local.context = render_context
+        try:
+            return self.media_callback(template_image['value'],
+                                       *template_image['args'],
+                                       frame_attrs=frame_attrs,
+                                       image_attrs=image_attrs,
+                                       **template_image['kwargs'])
+        finally:
+            self._local.context = previous_context
+
+    def _add_image(self, render_context, image, key, frame_attrs,
+                   image_attrs):
+        # Adds to the archive the image returned by the media loader.
+        template_image = render_context.template_images[key]
+        self._stats.count('images')
+
+        # Keep original image reference value
+        if isinstance(template_image['value'], basestring):
+            frame_attrs['draw:name'] = template_image['value']
+
+        # Does the madia loader returned something?
+        if not image:
+            return
+
+        mname = render_context.add_media_to_archive(media=image[0],
+                                                    mime=image[1],
+                                                    name=key)
+        if mname:
+            image_attrs['xlink:href'] = mname
+
+    def _compile_xml(self, xml_document, static=False):
+        # Prepare the xml object to be processed by jinja2. Static documents
+        # are just prepared, their template is None.
+        self.log.debug('Compiling XML object')
+        template_string = ""
+
+        stats = self._stats
+        try:
+            with stats.stage('prepare'):
+                self._prepare_document_tags(xml_document)
+
+            with stats.stage('unescape') as stage:
+                xml_source = self.xml_backend.serialize(xml_document)
+                xml_source = xml_source.encode('ascii', 'xmlcharrefreplace')
+                template_string = self._unescape_entities(xml_source.decode('utf-8'))
+                if stage is not None:
+                    stage.bytes_in += len(xml_source)
+                    stage.bytes_out += len(template_string)
+
+            jinja_template = None
+            if not static:
+                with stats.stage('compile'):
+                    jinja_template = self.environment.from_string(
+                        template_string)
+
+            return jinja_template, template_string
+        except:
+            self.log.error('Error compiling template:\n%s',
+                           self.xml_backend.serialize(xml_document),
+                           exc_info=True)
+
+            self.log.error('Unescaped template was:\n{0}'.format(template_string))
+            raise
+        finally:
+            self.log.debug('Compiling xml object finished')
+
+    def _render_xml(self, jinja_template, render_context, **kwargs):
+        # Render a compiled xml object. Its result is parsed back into a
+        # DOM only if images should be replaced or if DOM validation was
+        # requested. Otherwise, the rendered string is returned.
+        self.log.debug('Rendering XML object')
+
+        stats = self._stats
+        try:
+            render_context.template_images = dict()
+            kwargs[RENDER_CONTEXT_KEY] = render_context
+            with stats.stage('render') as stage:
+                result = jinja_template.render(**kwargs)
+                if stage is not None:
+                    stage.bytes_out += len(result)
+
+            if not render_context.template_images and \
+               self.validation != VALIDATE_DOM:
+                if self.validation == VALIDATE_WELLFORMED:
+                    with stats.stage('validate'):
+                        self._xml_checker().Parse(result, True)
+
+                return result
+
+            with stats.stage('reparse') as stage:
+                final_xml = parseString(result.encode('ascii', 'xmlcharrefreplace'))
+                if stage is not None:
+                    stage.bytes_in += len(result)
+
+            if render_context.template_images:
+                with stats.stage('images'):
+                    self.replace_images(final_xml, render_context)
+
+            return final_xml
+        except ExpatError as e:
+            near = result.split('\n')[e.lineno -1][e.offset-200:e.offset+200]
+
+            raise ExpatError('ExpatError "%s" at line %d, column %d\nNear of: "[...]%s[...]"' % \
+                             (ErrorString(e.code), e.lineno, e.offset, near))
+        except:
+            self.log.error('Error rendering template', exc_info=True)
+            raise
+        finally:
+            self.log.debug('Rendering xml object finished')
+
+    @staticmethod
+    def _xml_checker():
+        # An expat parser used to check rendered XML, with the same
+        # namespaces checks done by minidom.
+        return expat.ParserCreate(namespace_separator=' ')
+
+    @staticmethod
+    def _content_parts(content):
+        # Returns the serialized content.xml document before and after its
+        # office:body node.
+        return content.toxml().split('<office:body/>', 1)
+
+    def _stream_body(self, jinja_template, render_context, **kwargs):
+        # Render the office:body of content.xml into a temporary file, chunk
+        # by chunk. The body can't be written straight into the archive:
+        # filters may add automatic styles, which come before the body.
+        self.log.debug('Streaming XML object')
+        render_context.template_images = dict()
+        kwargs[RENDER_CONTEXT_KEY] = render_context
+
+        checker = None
+        if self.validation != VALIDATE_NONE:
+            # DOM validation of a streamed body is not possible, the body
+            # is just checked to be well-formed.
+            head, tail = render_context.content_parts()
+            checker = self._xml_checker()
+            checker.Parse(head, False)
+
+        stats = self._stats
+        body = tempfile.SpooledTemporaryFile(self.spool_size)
+        try:
+            with stats.stage('render') as stage:
+                for chunk in _body_chunks(jinja_template.generate(**kwargs)):
+                    chunk = chunk.encode('ascii', 'xmlcharrefreplace')
+                    if checker:
+                        checker.Parse(chunk, False)
+                    body.write(chunk)
+
+                if checker:
+                    checker.Parse(tail, True)
+                if stage is not None:
+                    stage.bytes_out += body.tell()
+
+            if render_context.template_images:
+                with stats.stage('images'):
+                    body = self._replace_images_stream(body, render_context)
+        except:
+            body.close()
+            self.log.error('Error rendering template', exc_info=True)
+            raise
+
+        body.seek(0)
+        return body
+
+    def _replace_images_stream(self, body, render_context):
+        # Same as replace_images, but for a rendered office:body stored in
+        # a file. Returns a new file with the images replaced.
+        self.log.debug('Inserting images')
+        load = None
+        if self.media_workers > 1:
+            # Find the images in a first pass, to load them all at once
+            images = []
+            scanner = _ImagesStreamReplacer(
+                self, render_context, lambda data: None,
+                lambda *image: images.append(image[1:]))
+            self._feed_stream(scanner, body)
+            self._load_images(render_context, images)
+            loaded = deque(images)
+
+            def load_image(render_context, key, frame_attrs, image_attrs):
+                _, loaded_frame, loaded_image = loaded.popleft()
+                frame_attrs.clear()
+                frame_attrs.update(loaded_frame)
+                image_attrs.clear()
+                image_attrs.update(loaded_image)
+
+            load = load_image
+
+        result = tempfile.SpooledTemporaryFile(self.spool_size)
+        replacer = _ImagesStreamReplacer(self, render_context, result.write,
+                                         load)
+        with body:
+            self._feed_stream(replacer, body)
+
+        return result
+
+    @staticmethod
+    def _feed_stream(parser, body):
+        body.seek(0)
+        for chunk in iter(lambda: body.read(STREAM_CHUNK_SIZE), b''):
+            parser.feed(chunk)
+
+        parser.close()
+
+    def _streamed_content(self, render_context, body):
+        # Yields content.xml, placing the rendered body file in the
+        # office:body of the content document of render_context.
+        head, tail = render_context.content_parts()
+        with body:
+            yield head.encode('ascii', 'xmlcharrefreplace')
+            for chunk in iter(lambda: body.read(STREAM_CHUNK_SIZE), b''):
+                yield chunk
+            yield tail.encode('ascii', 'xmlcharrefreplace')
+
+    def _template_cache_key(self, template):
+        """
+            Returns a tuple (key, source) where key identifies `template` in
+            the templates cache and source is what should be given to
+            _unpack_template. Filenames are keyed by path, modification time
+            and size; file objects by a hash of their content.
+        """
+        if isinstance(template, basestring):
+            key = (path.abspath(template), path.getmtime(template),
+                   path.getsize(template))
+            return key, template
+
+        template.seek(0)
+        data = template.read()
+        return hashlib.sha1(data).hexdigest(), io.BytesIO(data)
+
+    def compile(self, template):
+        """
+            Compile a template without rendering it.
+
+            args:
+                template: A template file. Could be a string or a file instance
+
+            returns:
+                A CompiledTemplate object. It is taken from the templates
+                cache if the template was already compiled.
+        """
+        if isinstance(template, CompiledTemplate):
+            if template.renderer is not self:
+                raise SecretaryError('Template was compiled by another Renderer')
+            return template
+
+        key, source = self._template_cache_key(template)
+        compiled = self.cache.get(key)
+        if compiled is not None:
+            self.log.debug('Using cached template')
+            self._stats.count('cached')
+            return compiled
+
+        self.log.debug('Compiling template')
+        with self._stats.stage('unpack') as stage:
+            files = self._unpack_template(source)
+            if stage is not None:
+                stage.bytes_in += path.getsize(source) \
+                    if isinstance(source, basestring) else len(source.getvalue())
+                stage.bytes_out += len(files['content.xml']) + \
+                    len(files['styles.xml'])
+
+        backend = self.xml_backend
+        content = backend.parse(files['content.xml'])
+        content_template, content_source = self._compile_xml(
+            content, static=self._is_static(files['content.xml']))
+
+        # Parts with no jinja syntax are copied to rendered documents as
+        # they are. styles.xml is not even parsed.
+        if content_template is None:
+            files['content.xml'] = self._static_member(files, 'content.xml')
+        if self._is_static(files['styles.xml']):
+            styles_template = styles_source = None
+            files['styles.xml'] = self._static_member(files, 'styles.xml')
+        else:
+            styles = backend.parse(files['styles.xml'])
+            styles_template, styles_source = self._compile_xml(styles)
+
+        # Only the office:body of content.xml is rendered. Keep the rest of
+        # the prepared document to be cloned on every render.
+        backend.clear(content, backend.find(content, 'office:body'))
+        content = backend.to_minidom(content)
+
+        compiled = CompiledTemplate(self, files, content, content_template,
+                                    styles_template, content_source,
+                                    styles_source)
+        self.cache.put(key, compiled)
+
+        return compiled
+
+    def _is_static(self, data):
+        """
+            Returns True if data, the XML of a template part (or its
+            prepared source), has no jinja syntax, so rendering the part
+            would just copy it. Delimiters with XML special chars could be
+            escaped in data: parts are never static for them.
+        """
+        environment = self.environment
+        delimiters = [delimiter for delimiter in (
+            environment.variable_start_string, environment.block_start_string,
+            environment.comment_start_string, environment.line_statement_prefix,
+            environment.line_comment_prefix) if delimiter]
+
+        if any(char in delimiter for delimiter in delimiters
+               for char in '<>&"\''):
+            return False
+
+        # Links to "secretary:" URLs are turned into jinja expressions
+        return not any(delimiter.encode('utf-8') in data
+                       for delimiter in delimiters + ['secretary:'])
+
+    def _static_member(self, files, name):
+        # Returns the static part `name` of files, compressed once for all
+        # the renders of the template
+        data = files[name]
+        if isinstance(data, _RawMember):
+            return data
+
+        return _RawMember.compress(name, data, self.compression.level(name))
+
+    def _source_template(self, source):
+        # Returns the jinja template of a prepared source, or None for
+        # static parts (see compile)
+        if source is None or self._is_static(source.encode('utf-8')):
+            return None
+
+        return self.environment.from_string(source)
+
+    def load_compiled(self, template):
+        """
+            Load a template saved by CompiledTemplate.save.
+
+            Saved templates hold Python code which is run as it is, so only
+            load files as trusted as the application code. Renderer.compile
+            and Renderer.render never load saved code: they handle saved
+            templates like other documents. Renderers with a sandboxed
+            environment can't load saved templates.
+
+            args:
+                template: A saved template. Could be a string or a file
+                          instance
+
+            returns:
+                A CompiledTemplate object. It is taken from the templates
+                cache if the template was already loaded.
+        """
+        if getattr(self.environment, 'sandboxed', False):
+            raise SecretaryError('Saved templates run Python code, they '
+                                 'can\'t be loaded by a sandboxed environment')
+
+        key, source = self._template_cache_key(template)
+        # Not shared with Renderer.compile, which doesn't load saved code
+        key = ('compiled', key)
+        compiled = self.cache.get(key)
+        if compiled is not None:
+            self.log.debug('Using cached template')
+            self._stats.count('cached')
+            return compiled
+
+        with self._stats.stage('unpack'):
+            files = self._unpack_template(source)
+
+        if COMPILED_META not in files:
+            raise SecretaryError('Not a saved compiled template')
+
+        compiled = self._load_compiled(files)
+        self.cache.put(key, compiled)
+        return compiled
+
+    def _load_compiled(self, files):
+        # Returns the CompiledTemplate of the unpacked members of a template
+        # saved by CompiledTemplate.save. Compiled members are removed from
+        # files.
+        self.log.debug('Loading compiled template')
+        compiled = {}
+        for name in [name for name in files
+                     if name.startswith(COMPILED_MEMBERS_DIR)]:
+            data = files.pop(name)
+            if isinstance(data, _RawMember):
+                data = data.decompress()
+            compiled[name[len(COMPILED_MEMBERS_DIR):]] = data
+
+        meta = json.loads(compiled['meta.json'].decode('utf-8'))
+        if meta.get('format') != COMPILED_FORMAT:
+            raise SecretaryError('Unsupported compiled template format: %r' %
+                                 meta.get('format'))
+
+        environment = self.environment
+        if meta['environment'] != _environment_key(environment):
+            raise SecretaryError('Template was compiled with other jinja '
+                                 'environment settings')
+
+        # Code marshalled by other Python or jinja2 versions can't be used,
+        # compile the sources again
+        reuse_code = meta['python'] == _code_tag() and \
+            meta['jinja2'] == jinja2.__version__
+
+        templates = {}
+        with self._stats.stage('compile'):
+            for name in ('content', 'styles'):
+                source = compiled.get(name + '.jinja')
+                if source is not None:
+                    source = source.decode('utf-8')
+
+                # Static parts have no code
+                if name + '.code' not in compiled:
+                    template = None
+                    files[name + '.xml'] = self._static_member(
+                        files, name + '.xml')
+                elif reuse_code:
+                    template = environment.template_class.from_code(
+                        environment, marshal.loads(compiled[name + '.code']),
+                        environment.make_globals(None), None)
+                else:
+                    template = environment.from_string(source)
+                templates[name] = template, source
+
+        return CompiledTemplate(self, files, parseString(compiled['content.xml']),
+                                templates['content'][0], templates['styles'][0],
+                                templates['content'][1], templates['styles'][1])
+
+    def variables(self, template):
+        """
+            Returns the names of the variables referenced by a template, as
+            a frozenset, so callers can compute only the values it needs.
+            See also LazyVariable.
+
+            args:
+                template: A template file. Could be a string, a file instance
+                          or a CompiledTemplate returned by Renderer.compile
+        """
+        return self.compile(template).variables
+
+    def _template_variables(self, compiled):
+        # Implementation of CompiledTemplate.variables
+        from jinja2 import meta
+
+        environment = self.environment
+        variables = set()
+        for template, source in ((compiled.content_template,
+                                  compiled.content_source),
+                                 (compiled.styles_template,
+                                  compiled.styles_source)):
+            # Static parts reference no variables
+            if template is not None:
+                variables.update(meta.find_undeclared_variables(
+                    environment.parse(source)))
+
+        variables.difference_update(environment.globals)
+        variables.discard(RENDER_CONTEXT_KEY)
+        return frozenset(variables)
+
+    def _resolve_variables(self, compiled, kwargs):
+        # Returns the template variables in kwargs, with the values of the
+        # lazy variables the template references. The other ones are left
+        # out.
+        lazy = [name for name, value in kwargs.items()
+                if isinstance(value, LazyVariable)]
+        if not lazy:
+            return kwargs
+
+        variables = compiled.variables
+        kwargs = dict(kwargs)
+        names = []
+        for name in lazy:
+            provider = kwargs.pop(name).provider
+            if name in variables:
+                self._stats.count('lazy_variables')
+                kwargs[name] = provider()
+                names.append(name)
+
+        awaitables = [name for name in names if _isawaitable(kwargs[name])]
+        if awaitables:
+            results = _await_all([kwargs[name] for name in awaitables],
+                                 len(awaitables),
+                                 loop=getattr(self._local, 'event_loop', None))
+            kwargs.update(zip(awaitables, results))
+
+        return kwargs
+
+    def render(self, template, **kwargs):
+        """
+            Render a template
+
+            args:
+                template: A template file. Could be a string, a file instance
+                          or a CompiledTemplate returned by Renderer.compile
+                **kwargs: Template variables. Similar to jinja2
+
+            returns:
+                A binary stream which contains the rendered document.
+        """
+
+        with self._instrument():
+            render_context = self._render(template, **kwargs)
+            document = self._pack_document(render_context.files)
+
+        return document.getvalue()
+
+    def render_with_stats(self, template, **kwargs):
+        """
+            Render a template, collecting statistics of every stage of the
+            render (see RenderObserver).
+
+            args:
+                template: A template file. Could be a string, a file instance
+                          or a CompiledTemplate returned by Renderer.compile
+                **kwargs: Template variables. Similar to jinja2
+
+            returns:
+                A (document, stats) tuple: the rendered document and a
+                RenderStats object.
+        """
+        stats = RenderStats(self.observers, self.trace_memory)
+        with self._instrument(stats):
+            render_context = self._render(template, **kwargs)
+            document = self._pack_document(render_context.files)
+
+        return document.getvalue(), stats
 
-            # Update frame and image node attrs (if they where updated in
-            # media_callback call)
-            for k, v in frame_attrs.items():
-                frame.setAttribute(k, v)
+    def render_to(self, template, fileobj, **kwargs):
+        """
+            Render a template writing the resulting document into `fileobj`,
+            without keeping a copy of the whole document in memory.
 
-            for k, v in image_attrs.items():
-                image_node.setAttribute(k, v)
+            If the Renderer was created with `streaming=True`, content.xml is
+            not built in memory either: its office:body is rendered chunk by
+            chunk (iterators passed as template variables are consumed
+            lazily), spooled into a temporary file and deflated straight
+            into the archive.
 
-            # Keep original image reference value
-            if isinstance(self.template_images[key]['value'], basestring):
-                frame.setAttribute('draw:name',
-                                   self.template_images[key]['value'])
+            args:
+                template: A template file. Could be a string, a file instance
+                          or a CompiledTemplate returned by Renderer.compile
+                fileobj: A writable file object, seekable or not (a file, a
+                         socket wrapper, a WSGI response...) or a filename.
+                **kwargs: Template variables. Similar to jinja2
+        """
+        with self._instrument():
+            render_context = self._render(template, **kwargs)
+            self._pack_document(render_context.files, fileobj)
 
-            # Does the madia loader returned something?
-            if not image:
-                continue
+    def render_async(self, template, **kwargs):
+        """
+            Render a template without blocking the asyncio event loop:
 
-            mname = self.add_media_to_archive(media=image[0], mime=image[1],
-                                              name=key)
-            if mname:
-                image_node.setAttribute('xlink:href', mname)
+                document = await engine.render_async(template, **kwargs)
 
-    def _render_xml(self, xml_document, **kwargs):
-        # Prepare the xml object to be processed by jinja2
-        self.log.debug('Rendering XML object')
-        template_string = ""
+            The template is rendered in `async_executor`, at most
+            `async_renders` at once. Media loaders may return awaitables,
+            which are run in the event loop of the caller, and template
+            variables may be async iterables (e.g. async generators or DB
+            cursors), whose items are fetched from that event loop as the
+            template consumes them.
+
+            Needs Python 3.5 or newer.
 
+            args:
+                template: A template file. Could be a string, a file instance
+                          or a CompiledTemplate returned by Renderer.compile
+                **kwargs: Template variables. Similar to jinja2
+
+            returns:
+                A coroutine, returning the rendered document.
+        """
+        from secretary_async import render_async
+        return render_async(self, template, kwargs)
+
+    def _render(self, template, **kwargs):
+        # Render the parts of template, returning the RenderContext which
+        # holds the files of the document to be packed.
+        self.log.debug('Initing a template rendering')
+        compiled = self.compile(template)
+        kwargs = self._resolve_variables(compiled, kwargs)
+        render_context = RenderContext(self, compiled)
+
+        # Keep the render context reachable from the Renderer instance for
+        # functions or filters written before RenderContext existed.
+        previous_context = self.render_context
+        self._local.context = render_context
         try:
-            self.template_images = dict()
-            self._prepare_document_tags(xml_document)
-            xml_source = xml_document.toxml()
-            xml_source = xml_source.encode('ascii', 'xmlcharrefreplace')
-            jinja_template = self.environment.from_string(
-                self._unescape_entities(xml_source.decode('utf-8'))
-            )
+            self._render_document(compiled, render_context, **kwargs)
+        finally:
+            self._local.context = previous_context
 
-            result = jinja_template.render(**kwargs)
+        return render_context
 
-            final_xml = parseString(result.encode('ascii', 'xmlcharrefreplace'))
-            if self.template_images:
-                self.replace_images(final_xml)
+    def render_many(self, template, contexts, workers=None, chunksize=1,
+                    ordered=True):
+        """
+            Render a template once for every context in `contexts`, using a
+            pool of worker processes.
 
-            return final_xml
-        except ExpatError as e:
-            if not 'result' in locals():
-                result = xml_source
-            near = result.split('\n')[e.lineno -1][e.offset-200:e.offset+200]
+            args:
+                template: A template file. Could be a string, a file instance
+                          or a CompiledTemplate returned by Renderer.compile
+                contexts: An iterable of dicts with the template variables of
+                          each document. Contexts must be picklable.
+                workers: Number of worker processes. Defaults to the number
+                         of processors. Use 0 to render in this process.
+                chunksize: Number of contexts sent at once to a worker.
+                ordered: If False, documents are yielded as soon as they are
+                         rendered instead of in the order of `contexts`.
 
-            raise ExpatError('ExpatError "%s" at line %d, column %d\nNear of: "[...]%s[...]"' % \
-                             (ErrorString(e.code), e.lineno, e.offset, near))
-        except:
-            self.log.error('Error rendering template:\n%s',
-                           xml_document.toprettyxml(), exc_info=True)
+            returns:
+                An iterator of (index, document) tuples, where index is the
+                position of the context in `contexts`. If rendering a
+                document failed, the exception raised is given in place of
+                the document and the rest of the batch is still rendered.
+        """
+        compiled = self.compile(template)
+        chunks = _chunked(enumerate(contexts), max(1, chunksize))
 
-            self.log.error('Unescaped template was:\n{0}'.format(template_string))
-            raise
-        finally:
-            self.log.debug('Rendering xml object finished')
+        if workers == 0:
+            for chunk in chunks:
+                for result in _render_chunk(chunk, compiled):
+                    yield result
+            return
 
+        from multiprocessing import cpu_count
+        from concurrent.futures import ProcessPoolExecutor
 
-    def render(self, template, **kwargs):
+        # Check now that the template can be sent to worker processes
+        try:
+            pickle.dumps(compiled)
+        except Exception as e:
+            raise SecretaryError('Could not send template to worker processes '
+                                 '(are environment filters picklable?): %s' % e)
+
+        # Workers get the template once, from the pool initializer. Pools
+        # have no initializer before Python 3.7: the template is sent
+        # along with every chunk instead.
+        if _POOL_INITIALIZERS:
+            pool_options = {'initializer': _init_render_worker,
+                            'initargs': (compiled,)}
+            chunk_args = ()
+        else:
+            pool_options = {}
+            chunk_args = (compiled,)
+
+        workers = workers or cpu_count()
+        with ProcessPoolExecutor(max_workers=workers,
+                                 **pool_options) as executor:
+            # Keep a bounded number of chunks in flight, so big batches of
+            # contexts are consumed as workers get free.
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(_render_chunk, chunk,
+                                               *chunk_args))
+                if len(pending) >= 2 * workers:
+                    for result in _completed_chunks(pending, ordered):
+                        yield result
+
+            while pending:
+                for result in _completed_chunks(pending, ordered):
+                    yield result
+
+    def render_merged(self, template, contexts, page_breaks=True):
         """
-            Render a template
+            Mail merge: render the body of a template once for every context
+            of `contexts`, into a single document.
+
+            The rendered text of every context (a record) is appended to
+            the document, starting on a new page if page_breaks is True.
+            Records share the document styles and media: styles.xml is
+            rendered once, with the first context, automatic styles added
+            by filters are inserted once (see RenderContext.register_style)
+            and images with the same content are stored once. Tables,
+            drawing objects, bookmarks, reference marks and sections of
+            records after the first one are renamed with a "_<record number>"
+            suffix, so their names are unique. content.xml is streamed,
+            records are not kept in memory.
+
+            Only text documents can be merged.
 
             args:
-                template: A template file. Could be a string or a file instance
-                **kwargs: Template variables. Similar to jinja2
+                template: A template file. Could be a string, a file instance
+                          or a CompiledTemplate returned by Renderer.compile
+                contexts: A non empty iterable of dicts with the template
+                          variables of each record, consumed as the records
+                          are rendered.
+                page_breaks: Start every record on a new page.
 
             returns:
                 A binary stream which contains the rendered document.
         """
+        with self._instrument():
+            render_context = self._render_merged(template, contexts,
+                                                 page_breaks)
+            document = self._pack_document(render_context.files)
 
-        self.log.debug('Initing a template rendering')
-        self.files = self._unpack_template(template)
-        self.render_vars = {}
+        return document.getvalue()
 
-        # Keep content and styles object since many functions or
-        # filters may work with then
-        self.content  = parseString(self.files['content.xml'])
-        self.styles   = parseString(self.files['styles.xml'])
-        self.manifest = parseString(self.files['META-INF/manifest.xml'])
-
-        # Render content.xml keeping just 'office:body' node.
-        rendered_content = self._render_xml(self.content, **kwargs)
-        self.content.getElementsByTagName('office:document-content')[0].replaceChild(
-            rendered_content.getElementsByTagName('office:body')[0],
-            self.content.getElementsByTagName('office:body')[0]
-        )
+    def render_merged_to(self, template, fileobj, contexts, page_breaks=True):
+        """
+            Mail merge the records of `contexts` like render_merged, writing
+            the resulting document into `fileobj` (see render_to).
+        """
+        with self._instrument():
+            render_context = self._render_merged(template, contexts,
+                                                 page_breaks)
+            self._pack_document(render_context.files, fileobj)
+
+    def _render_merged(self, template, contexts, page_breaks):
+        # Render the records of a mail merge, returning the RenderContext
+        # which holds the files of the document to be packed.
+        self.log.debug('Initing a merged rendering')
+        compiled = self.compile(template)
+        render_context = RenderContext(self, compiled)
+
+        previous_context = self.render_context
+        self._local.context = render_context
+        try:
+            body = self._merge_records(compiled, render_context, contexts,
+                                       page_breaks)
+        finally:
+            self._local.context = previous_context
+
+        render_context.files['content.xml'] = self._streamed_content(
+            render_context, body)
+        self._store_styles_and_manifest(render_context)
+
+        return render_context
+
+    def _merge_records(self, compiled, render_context, contexts, page_breaks):
+        # Render the office:body of content.xml for every context into a
+        # temporary file, merging the records into a single office:text.
+        # styles.xml is rendered with the first context.
+        checker = None
+        if self.validation != VALIDATE_NONE:
+            # As for streamed bodies, the merged body is just checked to be
+            # well-formed.
+            head, tail = render_context.content_parts()
+            checker = self._xml_checker()
+            checker.Parse(head, False)
+
+        body = tempfile.SpooledTemporaryFile(self.spool_size)
+
+        def write(data):
+            if checker:
+                checker.Parse(data, False)
+            body.write(data)
+
+        content_template = compiled.content_template or \
+            self.environment.from_string(compiled.content_source)
+        try:
+            index = page_break = None
+            for index, context in enumerate(contexts):
+                context = self._resolve_variables(compiled, context)
+                start, prelude, text = _split_merged_text(self._render_record(
+                    content_template, render_context, context))
+
+                if index == 0:
+                    write(b'<office:body>' + start + prelude)
+                    if compiled.styles_template is not None:
+                        render_context.styles = self._render_xml(
+                            compiled.styles_template, render_context,
+                            **context)
+                elif page_breaks:
+                    if page_break is None:
+                        page_break = ('<text:p text:style-name="%s"/>' %
+                            render_context._page_break_style()).encode('ascii')
+                    write(page_break)
+
+                if index:
+                    text = _rename_record_names(text, index + 1)
+                write(text)
+                self._stats.count('records')
+
+            if index is None:
+                raise SecretaryError('No records to merge')
+
+            write(b'</office:text></office:body>')
+            if checker:
+                checker.Parse(tail, True)
+        except:
+            body.close()
+            self.log.error('Error merging records', exc_info=True)
+            raise
+
+        body.seek(0)
+        return body
+
+    def _render_record(self, jinja_template, render_context, context):
+        # Render the office:body of content.xml for a record of a mail
+        # merge, with its images replaced.
+        render_context.template_images = dict()
+        kwargs = dict(context)
+        kwargs[RENDER_CONTEXT_KEY] = render_context
+
+        stats = self._stats
+        with stats.stage('render') as stage:
+            result = jinja_template.render(**kwargs)
+            start = result.find('<office:body>')
+            end = result.rfind('</office:body>')
+            if start < 0 or end < 0:
+                raise SecretaryError('office:body not found in rendered content')
+
+            record = result[start:end + len('</office:body>')].encode(
+                'ascii', 'xmlcharrefreplace')
+            if stage is not None:
+                stage.bytes_out += len(record)
+
+        if render_context.template_images:
+            with stats.stage('images'):
+                with self._replace_images_stream(io.BytesIO(record),
+                                                 render_context) as result:
+                    result.seek(0)
+                    record = result.read()
+
+        return record
+
+    def _render_document(self, compiled, render_context, **kwargs):
+        # Render content.xml keeping just 'office:body' node. Static parts
+        # (without template) are left as they are in the template files.
+        static_content = compiled.content_template is None
+        if static_content:
+            rendered_body = None
+        elif self.streaming:
+            rendered_body = self._stream_body(compiled.content_template,
+                                              render_context, **kwargs)
+        else:
+            rendered_content = self._render_xml(compiled.content_template,
+                                                render_context, **kwargs)
+            if isinstance(rendered_content, basestring):
+                rendered_body = ''.join(_body_chunks([rendered_content]))
+            else:
+                rendered_body = rendered_content.getElementsByTagName(
+                    'office:body')[0].toxml()
 
         # Render styles.xml
-        self.styles = self._render_xml(self.styles, **kwargs)
+        if compiled.styles_template is not None:
+            render_context.styles = self._render_xml(compiled.styles_template,
+                                                     render_context, **kwargs)
 
         self.log.debug('Template rendering finished')
 
-        self.files['content.xml']           = self.content.toxml().encode('ascii', 'xmlcharrefreplace')
-        self.files['styles.xml']            = self.styles.toxml().encode('ascii', 'xmlcharrefreplace')
-        self.files['META-INF/manifest.xml'] = self.manifest.toxml().encode('ascii', 'xmlcharrefreplace')
+        files = render_context.files
+        if static_content:
+            pass
+        elif self.streaming:
+            files['content.xml']       = self._streamed_content(render_context, rendered_body)
+        else:
+            head, tail = render_context.content_parts()
+            files['content.xml']       = ''.join((head, rendered_body, tail)).encode('ascii', 'xmlcharrefreplace')
+
+        self._store_styles_and_manifest(render_context)
 
-        document = self._pack_document(self.files)
-        return document.getvalue()
+    @staticmethod
+    def _store_styles_and_manifest(render_context):
+        # Store the rendered styles.xml and the manifest into the files of
+        # the document.
+        files = render_context.files
+        if render_context.styles is None:
+            pass
+        elif isinstance(render_context.styles, basestring):
+            files['styles.xml']        = render_context.styles.encode('ascii', 'xmlcharrefreplace')
+        else:
+            files['styles.xml']        = render_context.styles.toxml().encode('ascii', 'xmlcharrefreplace')
+        # The manifest is only changed when media are added
+        if render_context._manifest is not None:
+            files['META-INF/manifest.xml'] = render_context.manifest.toxml().encode('ascii', 'xmlcharrefreplace')
 
 
-    def _parent_of_type(self, node, of_type):
+    def _parent_of_type(self, document, node, of_type, cache=None):
         # Returns the first immediate parent of type `of_type`.
         # Returns None if nothing is found.
+        # `cache` maps (node, of_type) to the first node of type `of_type`
+        # found from node up, and is filled with every visited node, so
+        # sibling fields don't climb the same path again.
+        backend = self.xml_backend
+        if cache is None:
+            cache = {}
+
+        visited = []
+        found = None
+        node = backend.parent(document, node)
+        while node is not None:
+            if (node, of_type) in cache:
+                found = cache[node, of_type]
+                break
 
-        if hasattr(node, 'parentNode'):
-            if node.parentNode.nodeName.lower() == of_type:
-                return node.parentNode
-            else:
-                return self._parent_of_type(node.parentNode, of_type)
-        else:
-            return None
+            visited.append(node)
+            if backend.node_name(node).lower() == of_type:
+                found = node
+                break
+
+            node = backend.parent(document, node)
+
+        for node in visited:
+            cache[node, of_type] = found
+
+        return found
 
     def create_node(self, xml_document, node_type, parent=None):
         """Creates a node in `xml_document` of type `node_type` and specified,
@@ -687,52 +3532,32 @@ class Renderer(object):
 
     def get_style_by_name(self, style_name):
         """
-            Search in <office:automatic-styles> for style_name.
-            Return None if style_name is not found. Otherwise
+            Search in <office:automatic-styles> of the current render for
+            style_name. Return None if style_name is not found. Otherwise
             return the style node
         """
-
-        auto_styles = self.content.getElementsByTagName(
-            'office:automatic-styles')[0]
-
-        if not auto_styles.hasChildNodes():
-            return None
-
-        for style_node in auto_styles.childNodes:
-            if style_node.hasAttribute('style:name') and \
-               (style_node.getAttribute('style:name') == style_name):
-               return style_node
-
-        return None
+        return self._current_render_context().get_style_by_name(style_name)
 
     def insert_style_in_content(self, style_name, attributes=None,
         **style_properties):
         """
-            Insert a new style into content.xml's <office:automatic-styles> node.
-            Returns a reference to the newly created node
+            Insert a new style into content.xml's <office:automatic-styles>
+            node of the current render. Returns a reference to the newly
+            created node
         """
+        return self._current_render_context().insert_style_in_content(
+            style_name, attributes, **style_properties)
 
-        auto_styles = self.content.getElementsByTagName('office:automatic-styles')[0]
-        style_node = self.content.createElement('style:style')
-
-        style_node.setAttribute('style:name', style_name)
-        style_node.setAttribute('style:family', 'text')
-        style_node.setAttribute('style:parent-style-name', 'Standard')
-
-        if attributes:
-            for k, v in attributes.items():
-                style_node.setAttribute('style:%s' % k, v)
-
-        if style_properties:
-            style_prop = self.content.createElement('style:text-properties')
-            for k, v in style_properties.items():
-                style_prop.setAttribute('%s' % k, v)
-
-            style_node.appendChild(style_prop)
-
-        return auto_styles.appendChild(style_node)
+    def register_style(self, name=None, attributes=None, **style_properties):
+        """
+            Returns the name of a text style of the current render with the
+            given attributes and properties. See RenderContext.register_style
+        """
+        return self._current_render_context().register_style(
+            name, attributes, **style_properties)
 
-    def markdown_filter(self, markdown_text):
+    @jinja2.contextfilter
+    def markdown_filter(self, context, markdown_text):
         """
             Convert a markdown text into a ODT formated text
         """
@@ -740,7 +3565,27 @@ class Renderer(object):
         if not isinstance(markdown_text, basestring):
             return ''
 
-        from xml.dom import Node
+        from markdown_map import transform_map
+
+        self._stats.count('markdown')
+        fragment = self.markdown_cache.get(markdown_text)
+        if fragment is None:
+            fragment = self._markdown_to_odt(markdown_text)
+            self.markdown_cache.put(markdown_text, fragment)
+
+        # Create the styles used by the fragment
+        render_context = RenderContext.of(context)
+        for tag in fragment.styles:
+            style = transform_map[tag]['style']
+            render_context.register_style(style['name'],
+                                          style.get('attributes', None),
+                                          **style['properties'])
+
+        return Markup(fragment.text)
+
+    @staticmethod
+    def _markdown_to_odt(markdown_text):
+        # Returns the _MarkdownFragment of a markdown text
         from markdown_map import transform_map
 
         try:
@@ -748,7 +3593,6 @@ class Renderer(object):
         except ImportError:
             raise SecretaryError('Could not import markdown2 library. Install it using "pip install markdown2"')
 
-        styles_cache = {}   # cache styles searching
         html_text = markdown(markdown_text)
         encoded = html_text.encode('ascii', 'xmlcharrefreplace')
         if isinstance(encoded, bytes):
@@ -756,99 +3600,639 @@ class Renderer(object):
             encoded = encoded.decode('ascii')
         xml_object = parseString('<html>%s</html>' % encoded)
 
-        # Transform HTML tags as specified in transform_map
-        # Some tags may require extra attributes in ODT.
-        # Additional attributes are indicated in the 'attributes' property
-
-        for tag in transform_map:
-            html_nodes = xml_object.getElementsByTagName(tag)
-            for html_node in html_nodes:
-                odt_node = xml_object.createElement(transform_map[tag]['replace_with'])
-
-                # Transfer child nodes
-                if html_node.hasChildNodes():
-                    # We can't directly insert text into a text:list-item element.
-                    # The content of the item most be wrapped inside a container
-                    # like text:p. When there's not a double linebreak separating
-                    # list elements, markdown2 creates <li> elements without wraping
-                    # their contents inside a container. Here we automatically create
-                    # the container if one was not created by markdown2.
-                    if (tag=='li' and html_node.childNodes[0].localName != 'p'):
-                        container = xml_object.createElement('text:p')
-                        odt_node.appendChild(container)
-                    elif tag=='code':
-                        def traverse_preformated(node):
-                            if node.hasChildNodes():
-                                for n in node.childNodes:
-                                    traverse_preformated(n)
-                            else:
-                                container = xml_object.createElement('text:span')
-                                for text in re.split('(\n)', node.nodeValue.lstrip('\n')):
-                                    if text == '\n':
-                                        container.appendChild(xml_object.createElement('text:line-break'))
-                                    else:
-                                        container.appendChild(xml_object.createTextNode(text))
-
-                                node.parentNode.replaceChild(container, node)
-                        traverse_preformated(html_node)
-                        container = odt_node
-                    else:
-                        container = odt_node
-
-                    for child_node in html_node.childNodes:
-                        container.appendChild(child_node.cloneNode(True))
-
-                # Add style-attributes defined in transform_map
-                if 'style_attributes' in transform_map[tag]:
-                    for k, v in transform_map[tag]['style_attributes'].items():
-                        odt_node.setAttribute('text:%s' % k, v)
-
-                # Add defined attributes
-                if 'attributes' in transform_map[tag]:
-                    for k, v in transform_map[tag]['attributes'].items():
-                        odt_node.setAttribute(k, v)
-
-                    # copy original href attribute in <a> tag
-                    if tag == 'a':
-                        if html_node.hasAttribute('href'):
-                            odt_node.setAttribute('xlink:href',
-                                html_node.getAttribute('href'))
-
-                # Does the node need to create an style?
-                if 'style' in transform_map[tag]:
-                    name = transform_map[tag]['style']['name']
-                    if not name in styles_cache:
-                        style_node = self.get_style_by_name(name)
-
-                        if style_node is None:
-                            # Create and cache the style node
-                            style_node = self.insert_style_in_content(
-                                name, transform_map[tag]['style'].get('attributes', None),
-                                **transform_map[tag]['style']['properties'])
-                            styles_cache[name] = style_node
-
-                html_node.parentNode.replaceChild(odt_node, html_node)
-
-        def node_to_string(node):
-            return node.toxml()
-
-        ODTText = ''.join(node_as_str for node_as_str in map(node_to_string,
-                xml_object.getElementsByTagName('html')[0].childNodes))
-
-        return Markup(ODTText)
-
-    def image_filter(self, value, *args, **kwargs):
+        used_tags = set()
+        html = xml_object.documentElement
+        _transform_html_children(xml_object, html, transform_map, used_tags)
+
+        writer = io.StringIO()
+        for node in html.childNodes:
+            node.writexml(writer)
+        text = writer.getvalue()
+
+        # Styles are created in transform_map order
+        styles = tuple(tag for tag in transform_map
+                       if tag in used_tags and 'style' in transform_map[tag])
+        return _MarkdownFragment(text, styles, len(text))
+
+    @jinja2.contextfilter
+    def image_filter(self, context, value, *args, **kwargs):
         """Store value into template_images and return the key name where this
         method stored it. The value returned it later used to load the image
         from media loader and finally inserted into the final ODT document."""
-        key = uuid4().hex
-        self.template_images[key] = {
-            'value': value,
-            'args': args,
-            'kwargs': kwargs
-        }
+        return RenderContext.of(context).add_image(value, args, kwargs)
 
-        return key
+
+# ************************************************
+#
+#           MARKDOWN
+#
+# ************************************************
+
+# ODT text of a markdown text and the tags of transform_map whose styles it
+# uses, as stored in Renderer.markdown_cache
+_MarkdownFragment = namedtuple('_MarkdownFragment', ['text', 'styles', 'size'])
+
+
+def _transform_html_children(document, node, transform_map, used_tags):
+    """
+        Transform, in place and in a single traversal, the HTML elements
+        under `node` into ODT elements, as specified in transform_map. Some
+        tags may require extra attributes in ODT. Additional attributes are
+        indicated in the 'attributes' property. The transformed tags are
+        added to `used_tags`.
+    """
+    for child in list(node.childNodes):
+        if child.nodeType == child.ELEMENT_NODE:
+            _transform_html_children(document, child, transform_map,
+                                     used_tags)
+
+            if child.tagName in transform_map:
+                odt_node = _transform_html_node(document, child,
+                                                transform_map[child.tagName])
+                node.replaceChild(odt_node, child)
+                used_tags.add(child.tagName)
+
+
+def _transform_html_node(document, html_node, transform):
+    # Returns the ODT element replacing html_node, whose children are
+    # already transformed.
+    tag = html_node.tagName
+    odt_node = document.createElement(transform['replace_with'])
+
+    # Transfer child nodes
+    if html_node.hasChildNodes():
+        # We can't directly insert text into a text:list-item element.
+        # The content of the item most be wrapped inside a container
+        # like text:p. When there's not a double linebreak separating
+        # list elements, markdown2 creates <li> elements without wraping
+        # their contents inside a container. Here we automatically create
+        # the container if one was not created by markdown2.
+        if tag == 'li' and html_node.childNodes[0].localName != 'p':
+            container = document.createElement('text:p')
+            odt_node.appendChild(container)
+        else:
+            container = odt_node
+            if tag == 'code':
+                _preformat_text(document, html_node)
+
+        for child_node in list(html_node.childNodes):
+            container.appendChild(child_node)
+
+    # Add style-attributes defined in transform_map
+    if 'style_attributes' in transform:
+        for k, v in transform['style_attributes'].items():
+            odt_node.setAttribute('text:%s' % k, v)
+
+    # Add defined attributes
+    if 'attributes' in transform:
+        for k, v in transform['attributes'].items():
+            odt_node.setAttribute(k, v)
+
+        # copy original href attribute in <a> tag
+        if tag == 'a':
+            if html_node.hasAttribute('href'):
+                odt_node.setAttribute('xlink:href',
+                    html_node.getAttribute('href'))
+
+    return odt_node
+
+
+def _preformat_text(document, node):
+    # Replace the text nodes under node with text:span elements, keeping
+    # their line breaks.
+    for child in list(node.childNodes):
+        if child.hasChildNodes():
+            _preformat_text(document, child)
+        elif child.nodeType == child.TEXT_NODE:
+            container = document.createElement('text:span')
+            for text in re.split('(\n)', child.nodeValue.lstrip('\n')):
+                if text == '\n':
+                    container.appendChild(document.createElement('text:line-break'))
+                else:
+                    container.appendChild(document.createTextNode(text))
+
+            node.replaceChild(container, child)
+
+
+# ************************************************
+#
+#           STREAMING HELPERS
+#
+# ************************************************
+
+# Size of the chunks read from streamed files
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def _body_chunks(chunks, start='<office:body>', end='</office:body>'):
+    # Yields the office:body element out of the chunks of a rendered
+    # content.xml. What comes before or after it is discarded.
+    buffer = ''
+    in_body = False
+    for chunk in chunks:
+        # Chunks may be Markup strings, which would escape the buffer if
+        # added with +
+        buffer = ''.join((buffer, chunk))
+        if not in_body:
+            index = buffer.find(start)
+            if index < 0:
+                # Keep what could be the beginning of a split start tag
+                buffer = buffer[-len(start):]
+                continue
+
+            buffer = buffer[index:]
+            in_body = True
+
+        index = buffer.find(end)
+        if index >= 0:
+            yield buffer[:index + len(end)]
+            return
+
+        # Keep what could be the beginning of a split end tag
+        keep = len(end) - 1
+        if len(buffer) > keep:
+            yield buffer[:-keep]
+            buffer = buffer[-keep:]
+
+    raise SecretaryError('office:body not found in rendered content')
+
+
+# The office:text element of the office:body of a record of a mail merge.
+# See Renderer.render_merged
+_MERGED_TEXT_PATTERN = re.compile(
+    br'(?s)^<office:body>\s*(<office:text\b[^>]*>)(.*)</office:text>\s*'
+    br'</office:body>$')
+
+# Declarations which come first in an office:text element, kept only for
+# the first record of a mail merge
+_TEXT_PRELUDE_PATTERN = re.compile(
+    br'(?s)\s*<(office:forms|text:tracked-changes|text:variable-decls|'
+    br'text:sequence-decls|text:user-field-decls|text:dde-connection-decls|'
+    br'text:alphabetical-index-auto-mark-file|table:calculation-settings|'
+    br'table:content-validations|table:label-ranges)\b[^>]*?(?:/>|>.*?</\1>)')
+
+def _split_merged_text(body):
+    # Returns the start tag, the declarations and the rest of the content of
+    # the office:text element of a rendered office:body.
+    match = _MERGED_TEXT_PATTERN.match(body)
+    if match is None:
+        raise SecretaryError('Only text documents can be merged')
+
+    start, text = match.groups()
+    position = 0
+    while True:
+        prelude = _TEXT_PRELUDE_PATTERN.match(text, position)
+        if prelude is None:
+            break
+        position = prelude.end()
+
+    return start, text[:position], text[position:]
+
+
+# Attributes naming objects which must be unique in a document, or
+# referencing them by name
+_RECORD_NAME_PATTERN = re.compile(
+    br'(\s(?:table:name|draw:name|draw:chain-next-name|text:ref-name)=")'
+    br'([^"]*)"')
+
+# Elements whose text:name must be unique in a document
+_RECORD_TEXT_NAME_PATTERN = re.compile(
+    br'<(?:text:bookmark|text:bookmark-start|text:bookmark-end|'
+    br'text:reference-mark|text:reference-mark-start|text:reference-mark-end|'
+    br'text:section)\b[^>]*>')
+
+_TEXT_NAME_PATTERN = re.compile(br'(\stext:name=")([^"]*)"')
+
+_HREF_PATTERN = re.compile(br'(\sxlink:href="#)([^"]*)"')
+
+def _rename_record_names(text, number):
+    # Returns the rendered text of a record of a mail merge, with a suffix
+    # added to the names of its tables, drawing objects, bookmarks,
+    # reference marks and sections (and to the references to them), so
+    # they don't conflict with the names of other records.
+    suffix = ('_%d' % number).encode('ascii')
+    names = set()
+
+    def rename(match):
+        return match.group(1) + match.group(2) + suffix + b'"'
+
+    def rename_text_name(match):
+        names.add(match.group(2))
+        return rename(match)
+
+    def rename_element(match):
+        return _TEXT_NAME_PATTERN.sub(rename_text_name, match.group(0))
+
+    def rename_href(match):
+        if match.group(2) in names:
+            return rename(match)
+        return match.group(0)
+
+    text = _RECORD_NAME_PATTERN.sub(rename, text)
+    text = _RECORD_TEXT_NAME_PATTERN.sub(rename_element, text)
+    if names:
+        text = _HREF_PATTERN.sub(rename_href, text)
+
+    return text
+
+
+XML_ENTITIES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'}
+
+def _escape_xml(text):
+    if not any(char in text for char in XML_ENTITIES):
+        return text
+
+    return ''.join(XML_ENTITIES.get(char, char) for char in text)
+
+
+def _isawaitable(value):
+    return hasattr(value, '__await__')
+
+
+def _await_all(awaitables, limit, timeout=None, loop=None):
+    """
+        Runs `awaitables`, up to `limit` at once, and returns their results.
+        They run in `loop`, an asyncio event loop running in another thread,
+        or in a new event loop. Raises SecretaryError if one of them is not
+        done in `timeout` seconds.
+    """
+    if not awaitables:
+        return []
+
+    import asyncio
+    from concurrent.futures import wait, FIRST_COMPLETED
+    own_loop = loop is None
+    if own_loop:
+        loop = asyncio.new_event_loop()
+
+    def submit(awaitable):
+        coroutine = asyncio.wait_for(awaitable, timeout)
+        if own_loop:
+            return loop.create_task(coroutine)
+        return asyncio.run_coroutine_threadsafe(coroutine, loop)
+
+    def wait_first(pending):
+        if own_loop:
+            return loop.run_until_complete(asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED))[0]
+        return wait(pending, return_when=FIRST_COMPLETED)[0]
+
+    queue = deque(enumerate(awaitables))
+    results = [None] * len(awaitables)
+    tasks = {}
+    try:
+        while queue or tasks:
+            while queue and len(tasks) < limit:
+                index, awaitable = queue.popleft()
+                tasks[submit(awaitable)] = index
+
+            for task in wait_first(list(tasks)):
+                index = tasks.pop(task)
+                try:
+                    results[index] = task.result()
+                except asyncio.TimeoutError:
+                    raise SecretaryError('Timed out loading an image')
+    finally:
+        for task in tasks:
+            task.cancel()
+        if own_loop and tasks:
+            loop.run_until_complete(asyncio.wait(list(tasks)))
+        for _, awaitable in queue:
+            if hasattr(awaitable, 'close'):
+                awaitable.close()
+        if own_loop:
+            loop.close()
+
+    return results
+
+
+class _ImagesStreamReplacer(object):
+    """
+        Streaming counterpart of Renderer.replace_images. XML fed to this
+        object is parsed with expat and written back, through the `write`
+        function, with the draw:frame and draw:image nodes of images
+        registered by the image filter updated.
+    """
+
+    def __init__(self, renderer, render_context, write, load=None):
+        self.renderer = renderer
+        self.render_context = render_context
+        self.write = write
+        self.load = load or renderer._load_image
+
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.ordered_attributes = True
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.characters
+        self.parser.CommentHandler = self.comment
+
+        self.open_tag = False   # True if last start tag is not closed yet
+        self.frame = None       # Pending draw:frame of a template image
+
+    def feed(self, data):
+        self.parser.Parse(data, False)
+
+    def close(self):
+        self.parser.Parse(b'', True)
+
+    def _out(self, text):
+        if self.open_tag:
+            self.write(b'>')
+            self.open_tag = False
+
+        self.write(text.encode('ascii', 'xmlcharrefreplace'))
+
+    def _flush_frame(self):
+        if self.frame is not None:
+            frame, self.frame = self.frame, None
+            self._start_tag('draw:frame', frame)
+
+    def _start_tag(self, name, attrs):
+        self._out('<%s%s' % (name, ''.join(
+            ' %s="%s"' % (k, _escape_xml(v)) for k, v in attrs.items())))
+        self.open_tag = True
+
+    def start_element(self, name, attributes):
+        attrs = OrderedDict(zip(attributes[::2], attributes[1::2]))
+
+        if self.frame is not None:
+            # First child of a template image frame: the draw:image node
+            frame, self.frame = self.frame, None
+            key = frame['draw:name']
+            self.load(self.render_context, key, frame, attrs)
+            self._start_tag('draw:frame', frame)
+
+        elif name == 'draw:frame' and \
+             attrs.get('draw:name') in self.render_context.template_images:
+            self.frame = attrs
+            return
+
+        self._start_tag(name, attrs)
+
+    def end_element(self, name):
+        self._flush_frame()
+        if self.open_tag:
+            self.write(b'/>')
+            self.open_tag = False
+        else:
+            self._out('</%s>' % name)
+
+    def characters(self, data):
+        self._flush_frame()
+        self._out(_escape_xml(data))
+
+    def comment(self, data):
+        self._flush_frame()
+        self._out('<!--%s-->' % data)
+
+
+# ************************************************
+#
+#           ARCHIVE MEMBERS
+#
+# ************************************************
+
+# zipfile compresses new members at the level of their ZipInfo since
+# Python 3.7. Older versions use zlib's default level.
+_ZIPINFO_LEVELS = '_compresslevel' in zipfile.ZipInfo.__slots__
+
+# ZipFile.open can write members since Python 3.6
+_ZIPFILE_WRITES = sys.version_info >= (3, 6)
+
+
+class _ArchiveBuffer(object):
+    """
+        The data of a template archive: the template data or a read only
+        memory map of a template file. Memory maps are shared with other
+        processes mapping the same file, through the page cache.
+    """
+
+    __slots__ = ('data', 'filename', 'stat')
+
+    def __init__(self, data, filename=None, stat=None):
+        self.data = data
+        self.filename = filename
+        self.stat = stat
+
+    @classmethod
+    def map(cls, filename, stat=None):
+        with open(filename, 'rb') as template:
+            file_stat = os.fstat(template.fileno())
+            file_stat = (file_stat.st_size, file_stat.st_mtime)
+            if stat is not None and stat != file_stat:
+                raise SecretaryError('Template %s changed' % filename)
+
+            data = mmap.mmap(template.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return cls(data, filename, file_stat)
+
+    def __reduce__(self):
+        # Mapped files are mapped again when unpickled (e.g. by render_many
+        # workers), instead of copying their data.
+        if self.filename is not None:
+            return (_ArchiveBuffer.map, (self.filename, self.stat))
+
+        return (_ArchiveBuffer, (bytes(self.data), ))
+
+    @property
+    def size(self):
+        """Memory used by this buffer. Mapped files don't count."""
+        return 0 if self.filename is not None else len(self.data)
+
+    def view(self, start, length):
+        return memoryview(self.data)[start:start + length]
+
+
+class _RawMember(object):
+    """
+        A member of a template archive, kept compressed. Its data is a view
+        of the archive data, copied to rendered documents as is, with no
+        inflate/deflate round trip.
+    """
+
+    __slots__ = ('zinfo', 'buffer', 'offset')
+
+    # Local file header signature and size. See the ZIP specification.
+    HEADER_SIGNATURE = b'PK\x03\x04'
+    HEADER_SIZE = 30
+
+    def __init__(self, zinfo, buffer, offset):
+        self.zinfo = zinfo
+        self.buffer = buffer
+        self.offset = offset
+
+    def __len__(self):
+        return self.zinfo.compress_size
+
+    def __getstate__(self):
+        return self.zinfo, self.buffer, self.offset
+
+    def __setstate__(self, state):
+        self.zinfo, self.buffer, self.offset = state
+
+    @property
+    def data(self):
+        """The compressed data of the member."""
+        return self.buffer.view(self.offset, self.zinfo.compress_size)
+
+    @staticmethod
+    def can_copy(zinfo):
+        # Encrypted members and compression methods zlib doesn't support
+        # are read by zipfile and compressed again
+        return not zinfo.flag_bits & 0x01 and \
+            zinfo.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+
+    @classmethod
+    def read(cls, buffer, zinfo):
+        """
+            Returns the member described by zinfo of the archive in buffer
+            (an _ArchiveBuffer).
+        """
+        header = buffer.view(zinfo.header_offset, cls.HEADER_SIZE)
+        if header[:4].tobytes() != cls.HEADER_SIGNATURE:
+            raise zipfile.BadZipfile('Bad local header of %s' % zinfo.filename)
+
+        # Skip the file name and extra field of the local header
+        name_length, extra_length = struct.unpack('<2H', header[26:30])
+        offset = zinfo.header_offset + cls.HEADER_SIZE + name_length + \
+            extra_length
+
+        return cls(zinfo, buffer, offset)
+
+    @classmethod
+    def compress(cls, name, data, level):
+        """
+            Returns a new member named `name` with data compressed at level
+            (0 to store it).
+        """
+        zinfo = _zipinfo(name, level)
+        zinfo.file_size = len(data)
+        zinfo.CRC = zlib.crc32(data) & 0xffffffff
+        if level:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+        zinfo.compress_size = len(data)
+
+        return cls(zinfo, _ArchiveBuffer(data), 0)
+
+    def decompress(self):
+        """Returns the uncompressed data of the member."""
+        if self.zinfo.compress_type == zipfile.ZIP_STORED:
+            data = self.data.tobytes()
+        else:
+            data = zlib.decompress(self.data, -zlib.MAX_WBITS)
+
+        if zlib.crc32(data) & 0xffffffff != self.zinfo.CRC:
+            raise zipfile.BadZipfile('Bad CRC-32 for %s' % self.zinfo.filename)
+
+        return data
+
+    def write(self, zipdoc):
+        """
+            Write this member into zipdoc, a ZipFile opened for writing.
+            zipfile has no API to write compressed data, so this does what
+            ZipFile.write does after compressing a file.
+        """
+        source = self.zinfo
+        zinfo = zipfile.ZipInfo(source.filename, source.date_time)
+        zinfo.compress_type = source.compress_type
+        zinfo.external_attr = source.external_attr
+        zinfo.create_system = source.create_system
+        zinfo.CRC = source.CRC
+        zinfo.compress_size = source.compress_size
+        zinfo.file_size = source.file_size
+
+        if not hasattr(zipdoc, 'start_dir') or \
+                getattr(zipdoc, '_writing', False):
+            # Not the zipfile module we know, compress the data again
+            zipdoc.writestr(zinfo, self.decompress())
+            return
+
+        fileobj = zipdoc.fp
+        zinfo.header_offset = fileobj.tell()
+        fileobj.write(zinfo.FileHeader())
+        fileobj.write(self.data)
+
+        zipdoc._didModify = True
+        zipdoc.filelist.append(zinfo)
+        zipdoc.NameToInfo[zinfo.filename] = zinfo
+        zipdoc.start_dir = fileobj.tell()
+
+
+def _zipinfo(name, level):
+    # Returns a ZipInfo for a new member compressed at level
+    zinfo = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+    zinfo.external_attr = 0o600 << 16
+    if level:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        if _ZIPINFO_LEVELS:
+            zinfo._compresslevel = level
+    else:
+        zinfo.compress_type = zipfile.ZIP_STORED
+
+    return zinfo
+
+
+# ************************************************
+#
+#           BATCH RENDERING WORKERS
+#
+# ************************************************
+
+# ProcessPoolExecutor takes an initializer since Python 3.7
+_POOL_INITIALIZERS = sys.version_info >= (3, 7)
+
+# Template rendered by a worker process of Renderer.render_many
+_worker_template = None
+
+def _init_render_worker(compiled):
+    global _worker_template
+    _worker_template = compiled
+
+def _render_chunk(chunk, compiled=None):
+    # Render a list of (index, context) items. Exceptions are returned in
+    # place of the document, so a single failure doesn't abort the batch.
+    compiled = compiled or _worker_template
+    results = []
+    for index, context in chunk:
+        try:
+            results.append((index, compiled.render(**context)))
+        except Exception as e:
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = SecretaryError('%s: %s' % (e.__class__.__name__, e))
+
+            results.append((index, e))
+
+    return results
+
+def _completed_chunks(pending, ordered):
+    # Wait for the next finished futures of `pending` (the first one if
+    # ordered) and yield their results.
+    if ordered:
+        done = [pending.popleft()]
+    else:
+        from concurrent.futures import wait, FIRST_COMPLETED
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+
+    for future in done:
+        for result in future.result():
+            yield result
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
 
 
 def render_template(template, **kwargs):
@@ -860,7 +4244,45 @@ def render_template(template, **kwargs):
     return engine.render(**kwargs)
 
 
+def main(argv=None):
+    """
+        Command line interface:
+
+            python -m secretary compile template.odt -o template.secretary
+
+        Compiles templates into files Renderer.load_compiled loads ready to
+        be rendered. See CompiledTemplate.save.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m secretary')
+    commands = parser.add_subparsers(dest='command')
+    compile_parser = commands.add_parser(
+        'compile', help='save templates compiled, see CompiledTemplate.save')
+    compile_parser.add_argument('templates', nargs='+', metavar='template')
+    compile_parser.add_argument(
+        '-o', '--output', help='file of the compiled template. Defaults to '
+        'the template filename with a .secretary extension')
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.error('a command is required')
+    if args.output and len(args.templates) > 1:
+        parser.error('--output requires a single template')
+
+    engine = Renderer()
+    for template in args.templates:
+        output = args.output or path.splitext(template)[0] + '.secretary'
+        engine.compile(template).save(output)
+        print('%s: %s' % (template, output))
+
+    return 0
+
+
 if __name__ == "__main__":
+    if sys.argv[1:]:
+        sys.exit(main())
+
     import os
     from datetime import datetime
 
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    asyncio support for Secretary, see Renderer.render_async. This module
+    needs Python 3.5 or newer and is imported only when render_async is
+    called, so secretary.py keeps working on older versions.
+"""
+
+import asyncio
+import weakref
+from functools import partial
+
+
+# Semaphores limiting the renders running at once, by event loop and by
+# Renderer. See Renderer.__init__ async_renders argument.
+_limiters = weakref.WeakKeyDictionary()
+
+
+def _limiter(renderer, loop):
+    limiters = _limiters.setdefault(loop, weakref.WeakKeyDictionary())
+    limiter = limiters.get(renderer)
+    if limiter is None:
+        limiter = limiters[renderer] = asyncio.Semaphore(
+            renderer.async_renders)
+
+    return limiter
+
+
+async def _anext(iterator):
+    return await iterator.__anext__()
+
+
+class AsyncIteratorProxy(object):
+    """
+        Iterator over an async iterable, for templates rendered outside the
+        event loop where the iterable lives. Every item is fetched by the
+        event loop, while the rendering thread waits for it.
+    """
+
+    def __init__(self, iterable, loop):
+        self.iterator = iterable.__aiter__()
+        self.loop = loop
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        future = asyncio.run_coroutine_threadsafe(_anext(self.iterator),
+                                                  self.loop)
+        try:
+            return future.result()
+        except StopAsyncIteration:
+            raise StopIteration
+
+
+def _render(renderer, loop, template, kwargs):
+    # Runs in an executor thread. Awaitables returned by media loaders are
+    # run in the event loop of the render_async call.
+    renderer._local.event_loop = loop
+    try:
+        return renderer.render(template, **kwargs)
+    finally:
+        renderer._local.event_loop = None
+
+
+async def render_async(renderer, template, kwargs):
+    """Implementation of Renderer.render_async"""
+    try:
+        loop = asyncio.get_running_loop()
+    except AttributeError:
+        loop = asyncio.get_event_loop()
+
+    for name, value in kwargs.items():
+        if hasattr(value, '__aiter__'):
+            kwargs[name] = AsyncIteratorProxy(value, loop)
+
+    async with _limiter(renderer, loop):
+        return await loop.run_in_executor(
+            renderer.async_executor,
+            partial(_render, renderer, loop, template, kwargs))
@@ -33,7 +33,7 @@ setup(
     author_email='chris.ramirezg@gmail.com',
     description='Take the power of Jinja2 templates to OpenOffice or LibreOffice.',
     long_description=long_description,
-    py_modules=['secretary', 'markdown_map'],
+    py_modules=['secretary', 'secretary_async', 'markdown_map'],
     platforms='any',
     install_requires=[
         'Jinja2', 'markdown2'
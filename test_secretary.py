@@ -1,10 +1,56 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import io
 import os
-from xml.dom.minidom import getDOMImplementation
+import re
+import sys
+import struct
+import time
+import pickle
+import logging
+import shutil
+import tempfile
+import subprocess
+import zipfile
+import threading
+import jinja2
+from jinja2.sandbox import SandboxedEnvironment
+from xml.dom.minidom import getDOMImplementation, parseString
 from unittest import TestCase
-from secretary import UndefinedSilently, pad_string, Renderer
+from xml.parsers.expat import ExpatError
+from secretary import UndefinedSilently, pad_string, Renderer, TemplateCache, \
+    LRUCache, CompiledTemplate, SecretaryError, RenderContext, VALIDATE_NONE, \
+    VALIDATE_WELLFORMED, VALIDATE_DOM, ElementTreeBackend, MinidomBackend, \
+    CompressionPolicy, COMPRESSION_NONE, COMPRESSION_BEST, LazyVariable
+import secretary
+
+def archive_members(document):
+    """Returns the members of a rendered document, ignoring timestamps"""
+    archive = zipfile.ZipFile(io.BytesIO(document))
+    return [(name, archive.read(name)) for name in archive.namelist()]
+
+def images_template(template):
+    """
+        Returns a file object with the template of samples/images, the
+        paragraph of its image repeated for every item of `images`.
+    """
+    source = zipfile.ZipFile(template)
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w') as archive:
+        for name in source.namelist():
+            data = source.read(name)
+            if name == 'content.xml':
+                frame = data.index(b'<text:p text:style-name="P2">')
+                end = data.index(b'</text:p>', frame) + len('</text:p>')
+                data = (data[:frame] +
+                        b'<text:p>{% for image in images %}</text:p>' +
+                        data[frame:end] +
+                        b'<text:p>{% endfor %}</text:p>' + data[end:])
+            archive.writestr(name, data)
+
+    output.seek(0)
+    return output
 
 def test_undefined_silently():
     undefined = UndefinedSilently()
@@ -44,6 +90,20 @@ class RenderTestCase(TestCase):
             '{{ a &lt; b }}'                                 : '{{ a < b }}',
             '{% a|filter &lt; b %}'                          : '{% a|filter < b %}',
             '<node>{% a == b %}</node>{% else if a &lt; b %}': '<node>{% a == b %}</node>{% else if a < b %}',
+
+            # test scaping of escaped entities
+            '{{ a &amp;amp; b }}'                            : '{{ a & b }}',
+            '{{ &amp;quot;x&amp;quot; }}'                    : '{{ "x" }}',
+            '{{ a &amp;gt; b }}'                             : '{{ a &gt; b }}',
+
+            # test entities out of jinja instructions
+            'a &gt; b {{ c }}'                               : 'a &gt; b {{ c }}',
+            '{{ a }} &amp; {{ b }}'                          : '{{ a }} &amp; {{ b }}',
+            '{{ a &gt; { b }}'                               : '{{ a &gt; { b }}',
+            '{{ a } &gt; b }}'                               : '{{ a } &gt; b }}',
+
+            # test unescaping of links
+            '<a xlink:href="secretary:%7B%7B%20url%20%7D%7D"/>': '<a xlink:href="{{ SafeValue( url ) }}"/>',
         }
 
         for test, expect in test_samples.items():
@@ -64,6 +124,27 @@ class RenderTestCase(TestCase):
     def test_create_text_span_node(self):
         assert self.engine.create_text_span_node(self.document, 'text').toxml() == '<text:span>text</text:span>'
 
+    def test_tags_expressions_by_delimiters(self):
+        assert Renderer().tag_pattern is self.engine.tag_pattern
+
+        engine = Renderer(environment=jinja2.Environment(
+            variable_start_string='[[', variable_end_string=']]'))
+        assert engine.tag_pattern is not self.engine.tag_pattern
+        assert engine._is_jinja_tag('[[ foo ]]')
+        assert not engine._is_jinja_tag('{{ foo }}')
+        assert engine._unescape_entities('[[ a &gt; b ]]') == '[[ a > b ]]'
+
+    def test_import_is_lazy(self):
+        code = ('import sys, secretary; secretary.Renderer(); '
+                'print(" ".join(sorted(sys.modules)))')
+        modules = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().split()
+
+        for module in ('xml.dom.minidom', 'xml.etree.ElementTree',
+                       'mimetypes', 'markdown2', 'markdown_map', 'uuid'):
+            assert module not in modules
+
 
 class EscapingVariablesValues(TestCase):
     """
@@ -84,3 +165,1121 @@ class EscapingVariablesValues(TestCase):
         xml = '1 is > than 0 & -1 is <'
         expected = '1 is &gt; than 0 &amp; -1 is &lt;'
         assert (Renderer.get_escaped_var_value(xml) == expected)
+
+
+class MarkdownFilterTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.engine = Renderer()
+        self.render_context = RenderContext(
+            self.engine, self.engine.compile(
+                os.path.join(root, 'simple_template.odt')))
+        self.context = {secretary.RENDER_CONTEXT_KEY: self.render_context}
+
+    def styles(self):
+        return [node.getAttribute('style:name') for node in
+                self.render_context.content.getElementsByTagName('style:style')]
+
+    def test_markdown_filter(self):
+        text = self.engine.markdown_filter(
+            self.context, '**bold** and *italic* [link](http://example.com)')
+
+        assert text == ('<text:p text:style-name="Standard">'
+                        '<text:span text:style-name="markdown_bold">bold'
+                        '</text:span> and '
+                        '<text:span text:style-name="markdown_italic">italic'
+                        '</text:span> <text:a xlink:type="simple" '
+                        'xlink:href="http://example.com">link</text:a>'
+                        '</text:p>\n')
+        assert self.styles().count('markdown_bold') == 1
+        assert self.styles().count('markdown_italic') == 1
+
+    def test_nested_lists(self):
+        text = self.engine.markdown_filter(
+            self.context, '- item\n\n    - nested\n')
+
+        assert '<ul>' not in text and '<li>' not in text
+        assert text.count('<text:list ') == 2
+
+    def test_cached_fragments(self):
+        for i in range(3):
+            text = self.engine.markdown_filter(self.context, '**bold**')
+
+        assert self.engine.markdown_cache.info().hits == 2
+        assert self.styles().count('markdown_bold') == 1
+        assert text == self.engine.markdown_filter(
+            self.context, '**bold**')
+
+
+class CompiledTemplateTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.template = os.path.join(root, 'simple_template.odt')
+        self.engine = Renderer(cache_entries=0)
+
+    def test_compiled_template_render(self):
+        compiled = self.engine.compile(self.template)
+        countries = [{'country': 'nicaragua', 'capital': 'managua'}]
+
+        assert isinstance(compiled, CompiledTemplate)
+        expected = archive_members(
+            self.engine.render(self.template, countries=countries))
+        assert archive_members(compiled.render(countries=countries)) == expected
+        assert archive_members(
+            self.engine.render(compiled, countries=countries)) == expected
+
+    def test_compiled_template_is_immutable(self):
+        compiled = self.engine.compile(self.template)
+        with self.assertRaises(AttributeError):
+            compiled.files = {}
+
+    def test_compiled_template_of_other_renderer(self):
+        compiled = Renderer().compile(self.template)
+        with self.assertRaises(SecretaryError):
+            self.engine.render(compiled)
+
+    def test_static_parts(self):
+        # styles.xml of the images sample has no fields
+        template = os.path.join(os.path.dirname(__file__), 'samples',
+                                'images', 'template.odt')
+        with zipfile.ZipFile(template) as archive:
+            styles = archive.read('styles.xml')
+
+        compiled = self.engine.compile(template)
+        assert compiled.styles_template is None
+        assert compiled.styles_source is None
+        assert compiled.content_template is not None
+
+        saved = io.BytesIO()
+        compiled.save(saved)
+        for compiled in (compiled, pickle.loads(pickle.dumps(compiled)),
+                         self.engine.load_compiled(saved)):
+            assert compiled.styles_template is None
+            document = zipfile.ZipFile(io.BytesIO(compiled.render()))
+            assert document.read('styles.xml') == styles
+
+    def test_saved_compiled_template(self):
+        countries = [{'country': 'nicaragua', 'capital': 'managua'}]
+        saved = io.BytesIO()
+        self.engine.compile(self.template).save(saved)
+
+        # Saved code is loaded as is, sources are not compiled again
+        engine = Renderer()
+        engine.environment.from_string = None
+        compiled = engine.load_compiled(saved)
+
+        assert 'Secretary/meta.json' not in compiled.files
+        assert archive_members(compiled.render(countries=countries)) == \
+            archive_members(self.engine.render(self.template,
+                                               countries=countries))
+
+    def test_saved_compiled_template_of_other_environment(self):
+        saved = io.BytesIO()
+        self.engine.compile(self.template).save(saved)
+
+        engine = Renderer(environment=jinja2.Environment(
+            variable_start_string='[[', variable_end_string=']]'))
+        with self.assertRaises(SecretaryError):
+            engine.load_compiled(saved)
+
+    def test_saved_code_is_not_loaded_implicitly(self):
+        saved = io.BytesIO()
+        self.engine.compile(self.template).save(saved)
+
+        # Saved members are plain data for compile
+        compiled = Renderer().compile(saved)
+        assert 'Secretary/meta.json' in compiled.files
+        assert compiled.content_template is not None
+
+        with self.assertRaises(SecretaryError):
+            Renderer().load_compiled(self.template)
+
+        engine = Renderer(environment=SandboxedEnvironment())
+        with self.assertRaises(SecretaryError):
+            engine.load_compiled(saved)
+
+    def test_compile_command(self):
+        directory = tempfile.mkdtemp()
+        try:
+            output = os.path.join(directory, 'template.secretary')
+            assert secretary.main(['compile', self.template,
+                                   '-o', output]) == 0
+            compiled = self.engine.load_compiled(output)
+            assert b'Nicaragua' in zipfile.ZipFile(io.BytesIO(
+                compiled.render(countries=[{'country': 'nicaragua'}]))
+                ).read('content.xml')
+        finally:
+            shutil.rmtree(directory)
+
+
+class RenderToTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.template = os.path.join(root, 'simple_template.odt')
+        self.engine = Renderer()
+        self.context = {'countries': [{'country': 'nicaragua'}]}
+
+    def test_render_to_file_object(self):
+        output = io.BytesIO()
+        self.engine.render_to(self.template, output, **self.context)
+
+        assert archive_members(output.getvalue()) == archive_members(
+            self.engine.render(self.template, **self.context))
+
+    def test_render_to_unseekable_stream(self):
+        class Stream(io.RawIOBase):
+            def __init__(self):
+                self.chunks = []
+
+            def writable(self):
+                return True
+
+            def write(self, data):
+                self.chunks.append(bytes(data))
+                return len(data)
+
+        stream = Stream()
+        self.engine.compile(self.template).render_to(stream, **self.context)
+        data = b''.join(stream.chunks)
+        document = zipfile.ZipFile(io.BytesIO(data))
+
+        assert document.testzip() is None
+        assert b'Nicaragua' in document.read('content.xml')
+
+        # A plain stored mimetype comes first, without data descriptor
+        mimetype = document.infolist()[0]
+        assert mimetype.filename == 'mimetype'
+        assert mimetype.compress_type == zipfile.ZIP_STORED
+        assert mimetype.flag_bits & 0x08 == 0
+        expected = b'mimetypeapplication/vnd.oasis.opendocument.text'
+        assert data[30:30 + len(expected)] == expected
+
+
+class RawMembersTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.template = os.path.join(root, 'samples', 'images', 'template.odt')
+        self.engine = Renderer(media_path=os.path.join(root, 'samples', 'images'))
+
+    def raw_data(self, archive, name):
+        info = archive.getinfo(name)
+        archive.fp.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<2H', archive.fp.read(4))
+        archive.fp.seek(name_length + extra_length, io.SEEK_CUR)
+        return archive.fp.read(info.compress_size)
+
+    def test_untouched_members_are_copied(self):
+        template = zipfile.ZipFile(self.template)
+        document = zipfile.ZipFile(io.BytesIO(
+            self.engine.render(self.template, image='writer.png')))
+        copied = ['Thumbnails/thumbnail.png', 'settings.xml', 'meta.xml',
+                  'Pictures/100002010000012C0000012C6B6045FC.png']
+
+        assert document.testzip() is None
+        for name in copied:
+            assert document.getinfo(name).CRC == template.getinfo(name).CRC
+            assert self.raw_data(document, name) == \
+                self.raw_data(template, name)
+            assert document.read(name) == template.read(name)
+
+    def test_mapped_templates(self):
+        root = os.path.dirname(__file__)
+        template = os.path.join(root, 'simple_template.odt')
+        compiled = Renderer(mmap_templates=True).compile(template)
+        not_mapped = self.engine.compile(template)
+
+        assert compiled.files['meta.xml'].buffer.filename == template
+        assert not_mapped.files['meta.xml'].buffer.filename is None
+        assert archive_members(compiled.render()) == \
+            archive_members(not_mapped.render())
+
+    def test_template_overwritten_in_place(self):
+        directory = tempfile.mkdtemp()
+        try:
+            template = os.path.join(directory, 'template.odt')
+            shutil.copy(os.path.join(os.path.dirname(__file__),
+                                     'simple_template.odt'), template)
+            compiled = self.engine.compile(template)
+            with open(template, 'wb') as output:
+                output.write(b'\0' * 100)
+
+            document = zipfile.ZipFile(io.BytesIO(compiled.render()))
+            assert document.testzip() is None
+        finally:
+            shutil.rmtree(directory)
+
+    def test_pickled_raw_members(self):
+        compiled = pickle.loads(pickle.dumps(self.engine.compile(self.template)))
+        document = zipfile.ZipFile(io.BytesIO(compiled.render()))
+
+        assert document.testzip() is None
+        assert document.read('meta.xml') == \
+            zipfile.ZipFile(self.template).read('meta.xml')
+
+
+class CompressionTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.template = os.path.join(root, 'simple_template.odt')
+        self.context = {'countries': [{'country': 'country %d' % i,
+                                       'capital': 'capital %d' % i}
+                                      for i in range(300)]}
+
+    def render(self, **options):
+        engine = Renderer(**options)
+        return zipfile.ZipFile(io.BytesIO(
+            engine.render(self.template, **self.context)))
+
+    def test_policy_levels(self):
+        policy = CompressionPolicy(level=1, rules=[('content.xml', 9),
+                                                   ('image/svg+xml', 0)])
+
+        assert policy.level('content.xml') == 9
+        assert policy.level('Pictures/logo.svg') == 0
+        assert policy.level('Pictures/logo.png') == 0
+        assert policy.level('styles.xml') == 1
+        assert CompressionPolicy(store_compressed=False).level('a.png') == -1
+
+    def test_invalid_level(self):
+        with self.assertRaises(ValueError):
+            CompressionPolicy(level=10)
+
+    def test_stored_documents(self):
+        document = self.render(compression=COMPRESSION_NONE)
+
+        assert document.testzip() is None
+        assert document.getinfo('content.xml').compress_type == zipfile.ZIP_STORED
+        # Members copied from the template keep their compression
+        assert document.getinfo('settings.xml').compress_type == zipfile.ZIP_DEFLATED
+
+    def test_best_compression(self):
+        default = self.render()
+        best = self.render(compression=COMPRESSION_BEST)
+
+        assert best.testzip() is None
+        assert best.getinfo('content.xml').compress_size < \
+            default.getinfo('content.xml').compress_size
+        assert best.read('settings.xml') == default.read('settings.xml')
+
+    def test_streamed_members_without_levels(self):
+        # zipfile of Python < 3.7 can't set the level of a member
+        levels = secretary._ZIPINFO_LEVELS
+        secretary._ZIPINFO_LEVELS = False
+        try:
+            streamed = self.render(compression=COMPRESSION_BEST,
+                                   streaming=True,
+                                   validation=VALIDATE_WELLFORMED)
+        finally:
+            secretary._ZIPINFO_LEVELS = levels
+        document = self.render(compression=COMPRESSION_BEST)
+
+        assert streamed.testzip() is None
+        assert streamed.getinfo('content.xml').compress_type == \
+            zipfile.ZIP_DEFLATED
+        assert parseString(streamed.read('content.xml')).toxml() == \
+            parseString(document.read('content.xml')).toxml()
+
+    def test_streamed_members_without_zipfile_writes(self):
+        # zipfile of Python < 3.6 can't write members in chunks
+        writes = secretary._ZIPFILE_WRITES
+        secretary._ZIPFILE_WRITES = False
+        try:
+            streamed = self.render(compression=COMPRESSION_BEST,
+                                   streaming=True,
+                                   validation=VALIDATE_WELLFORMED)
+        finally:
+            secretary._ZIPFILE_WRITES = writes
+        document = self.render(compression=COMPRESSION_BEST)
+
+        assert streamed.testzip() is None
+        assert streamed.getinfo('content.xml').compress_size == \
+            document.getinfo('content.xml').compress_size
+        assert parseString(streamed.read('content.xml')).toxml() == \
+            parseString(document.read('content.xml')).toxml()
+
+    def test_parallel_compression(self):
+        parallel_size = secretary.PARALLEL_COMPRESSION_SIZE
+        secretary.PARALLEL_COMPRESSION_SIZE = 0
+        try:
+            parallel = self.render(compression_workers=2)
+        finally:
+            secretary.PARALLEL_COMPRESSION_SIZE = parallel_size
+        serial = self.render(compression_workers=0)
+
+        assert parallel.testzip() is None
+        assert parallel.namelist() == serial.namelist()
+        for name in serial.namelist():
+            assert parallel.getinfo(name).CRC == serial.getinfo(name).CRC
+
+    def test_parallel_compression_ahead(self):
+        engine = Renderer(compression_workers=2)
+        pool = engine._get_compression_pool()
+        submitted = []
+
+        class Pool(object):
+            def submit(self, *args):
+                submitted.append(args[1])
+                return pool.submit(*args)
+
+        engine._get_compression_pool = Pool
+        files = dict(('member%d' % i, b'x' * secretary.PARALLEL_COMPRESSION_SIZE)
+                     for i in range(6))
+
+        members = engine._compressed_members(files)
+        written = []
+        for name, member in members:
+            written.append(name)
+            # Members are compressed at most compression_workers ahead
+            assert len(submitted) <= len(written) + 2
+
+        assert written == submitted == list(files)
+
+
+class StreamingTestCase(TestCase):
+    def setUp(self):
+        self.root = os.path.dirname(__file__)
+
+    def check_streamed_content(self, template, **options):
+        def render(streaming):
+            engine = Renderer(streaming=streaming, spool_size=128,
+                              validation=VALIDATE_WELLFORMED if streaming
+                                         else VALIDATE_DOM,
+                              **options)
+            output = io.BytesIO()
+            engine.render_to(template, output, countries=countries,
+                             image='writer.png')
+
+            # Image names are random
+            key = re.compile(b'[0-9a-f]{32}')
+            return dict((re.sub('[0-9a-f]{32}', 'key', name),
+                         key.sub(b'key', data))
+                        for name, data in archive_members(output.getvalue()))
+
+        countries = [
+            {'country': 'M\xe9xico & <co>', 'cities': ['puebla', 'cancun']},
+            {'country': 'Chile', 'capital': '"Santiago"'},
+        ]
+        expected, streamed = render(False), render(True)
+        assert sorted(expected) == sorted(streamed)
+
+        # Static parts are copied as they are: reparse both documents
+        for name in ('content.xml', 'styles.xml'):
+            assert parseString(streamed.pop(name)).toxml() == \
+                parseString(expected.pop(name)).toxml()
+        assert expected == streamed
+
+    def test_streamed_content(self):
+        self.check_streamed_content(
+            os.path.join(self.root, 'simple_template.odt'))
+
+    def test_streamed_content_with_images(self):
+        images_path = os.path.join(self.root, 'samples', 'images')
+        self.check_streamed_content(os.path.join(images_path, 'template.odt'),
+                                    media_path=images_path)
+
+
+class ValidationTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.template = os.path.join(root, 'simple_template.odt')
+        self.countries = [{'country': 'Nicaragua & "M\xe9xico"',
+                           'cities': ['managua']}]
+
+    def render(self, validation, title_filter=None):
+        engine = Renderer(validation=validation)
+        if title_filter:
+            engine.environment.filters['title'] = title_filter
+
+        return dict(archive_members(
+            engine.render(self.template, countries=self.countries)))
+
+    def test_fast_path_output(self):
+        expected = self.render(VALIDATE_DOM)
+        for validation in (VALIDATE_NONE, VALIDATE_WELLFORMED):
+            result = self.render(validation)
+            for name in ('content.xml', 'styles.xml'):
+                reparsed = parseString(result.pop(name)).toxml()
+                assert reparsed.encode('ascii', 'xmlcharrefreplace') == \
+                    expected[name]
+            assert result == dict((name, data) for name, data in
+                                  expected.items() if name in result)
+
+    def test_invalid_xml(self):
+        broken = lambda value: jinja2.Markup('<text:span>')
+        for validation in (VALIDATE_WELLFORMED, VALIDATE_DOM):
+            with self.assertRaises(ExpatError):
+                self.render(validation, broken)
+
+        assert b'<text:span>' in self.render(VALIDATE_NONE, broken)['content.xml']
+
+    def test_unknown_validation_level(self):
+        with self.assertRaises(ValueError):
+            Renderer(validation='strict')
+
+
+class RenderManyTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.template = os.path.join(root, 'simple_template.odt')
+        self.engine = Renderer()
+        self.contexts = [{'countries': [{'country': 'country %d' % i}]}
+                         for i in range(6)]
+        self.contexts[2] = {'countries': 2}   # Not iterable: should fail
+
+    def check_results(self, results):
+        assert sorted(index for index, _ in results) == list(range(6))
+        for index, document in results:
+            if index == 2:
+                assert isinstance(document, TypeError)
+            else:
+                assert archive_members(document) == archive_members(
+                    self.engine.render(self.template, **self.contexts[index]))
+
+    def test_render_many_in_process(self):
+        results = list(self.engine.render_many(self.template, self.contexts,
+                                               workers=0))
+        assert [index for index, _ in results] == list(range(6))
+        self.check_results(results)
+
+    def test_render_many_with_workers(self):
+        results = list(self.engine.render_many(self.template, self.contexts,
+                                               workers=2, chunksize=2))
+        assert [index for index, _ in results] == list(range(6))
+        self.check_results(results)
+
+    def test_render_many_without_pool_initializer(self):
+        # ProcessPoolExecutor of Python < 3.7 has no initializer
+        initializers = secretary._POOL_INITIALIZERS
+        secretary._POOL_INITIALIZERS = False
+        try:
+            self.check_results(list(self.engine.render_many(
+                self.template, self.contexts, workers=2)))
+        finally:
+            secretary._POOL_INITIALIZERS = initializers
+
+    def test_render_many_unordered(self):
+        self.check_results(list(self.engine.render_many(
+            self.template, self.contexts, workers=2, ordered=False)))
+
+    def test_pickle_compiled_template(self):
+        compiled = self.engine.compile(self.template)
+        loaded = pickle.loads(pickle.dumps(compiled))
+
+        assert loaded.renderer is not self.engine
+        assert archive_members(loaded.render(**self.contexts[0])) == \
+            archive_members(compiled.render(**self.contexts[0]))
+
+    def test_pickle_renderer_with_log_handlers(self):
+        # Loggers are pickled by value before Python 3.7, with the locks
+        # of their handlers
+        handler = logging.StreamHandler(io.StringIO())
+        self.engine.log.addHandler(handler)
+        try:
+            loaded = pickle.loads(pickle.dumps(self.engine))
+        finally:
+            self.engine.log.removeHandler(handler)
+
+        assert loaded.log is self.engine.log
+
+
+class MergeTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.template = os.path.join(root, 'simple_template.odt')
+        self.media_path = os.path.join(root, 'samples', 'images')
+        self.engine = Renderer(media_path=self.media_path)
+        self.contexts = [{'countries': [{'country': 'country %d' % i}],
+                          'document': {'md_sample': '**record %d**' % i}}
+                         for i in range(3)]
+
+    def content(self, document):
+        return parseString(zipfile.ZipFile(io.BytesIO(document)).read(
+            'content.xml'))
+
+    def test_render_merged(self):
+        content = self.content(self.engine.render_merged(
+            self.template, iter(self.contexts)))
+        text = content.getElementsByTagName('office:text')
+        xml = text[0].toxml()
+
+        # A single office:text, with declarations only once
+        assert len(text) == 1
+        assert len(content.getElementsByTagName('text:sequence-decls')) == 1
+        positions = [xml.index('Country %d' % i) for i in range(3)]
+        assert positions == sorted(positions)
+
+        breaks = [paragraph for paragraph in
+                  content.getElementsByTagName('text:p')
+                  if paragraph.getAttribute('text:style-name') ==
+                  'secretary_page_break']
+        assert len(breaks) == 2
+
+        styles = [style.getAttribute('style:name') for style in
+                  content.getElementsByTagName('style:style')]
+        assert len(styles) == len(set(styles))
+
+    def test_render_merged_without_page_breaks(self):
+        content = self.content(self.engine.render_merged(
+            self.template, self.contexts, page_breaks=False))
+        assert 'secretary_page_break' not in content.toxml()
+
+    def test_merged_images_stored_once(self):
+        template = images_template(os.path.join(self.media_path,
+                                                'template.odt'))
+        output = io.BytesIO()
+        self.engine.render_merged_to(template, output,
+                                     [{'images': ['writer.png']}] * 4)
+        archive = zipfile.ZipFile(output)
+        content = parseString(archive.read('content.xml'))
+        with open(os.path.join(self.media_path, 'writer.png'), 'rb') as image:
+            data = image.read()
+
+        pictures = [name for name in archive.namelist()
+                    if name.startswith('Pictures/') and
+                    archive.read(name) == data]
+        hrefs = set(image.getAttribute('xlink:href') for image in
+                    content.getElementsByTagName('draw:image'))
+        assert len(pictures) == 1 and hrefs == set(pictures)
+        assert len(content.getElementsByTagName('draw:image')) == 4
+
+    def test_merged_names_are_unique(self):
+        template = images_template(os.path.join(self.media_path,
+                                                'template.odt'))
+        content = zipfile.ZipFile(io.BytesIO(self.engine.render_merged(
+            template, [{'images': ['writer.png']}] * 3))).read('content.xml')
+        content += zipfile.ZipFile(io.BytesIO(self.engine.render_merged(
+            self.template, self.contexts))).read('content.xml')
+
+        names = re.findall(b'(?:table|draw):name="([^"]*)"', content)
+        assert len(names) > 3 and len(names) == len(set(names))
+
+    def test_merged_bookmarks(self):
+        bookmark = (b'<text:p><text:bookmark text:name="mark"/>'
+                    b'<text:bookmark-ref text:ref-name="mark">1'
+                    b'</text:bookmark-ref><text:a xlink:type="simple" '
+                    b'xlink:href="#mark">mark</text:a></text:p>')
+        output = io.BytesIO()
+        with zipfile.ZipFile(self.template) as source, \
+                zipfile.ZipFile(output, 'w') as archive:
+            for name in source.namelist():
+                data = source.read(name)
+                if name == 'content.xml':
+                    data = data.replace(b'</office:text>',
+                                        bookmark + b'</office:text>')
+                archive.writestr(name, data)
+
+        content = self.content(self.engine.render_merged(output,
+                                                         self.contexts))
+        bookmarks = [node.getAttribute('text:name') for node in
+                     content.getElementsByTagName('text:bookmark')]
+        references = [node.getAttribute('text:ref-name') for node in
+                      content.getElementsByTagName('text:bookmark-ref')]
+        links = [node.getAttribute('xlink:href') for node in
+                 content.getElementsByTagName('text:a')
+                 if node.getAttribute('xlink:href').startswith('#')]
+
+        assert bookmarks == references == ['mark', 'mark_2', 'mark_3']
+        assert links == ['#mark', '#mark_2', '#mark_3']
+
+    def test_merge_without_records(self):
+        with self.assertRaises(SecretaryError):
+            self.engine.render_merged(self.template, [])
+
+
+class TemplateVariablesTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.template = os.path.join(root, 'simple_template.odt')
+        self.engine = Renderer()
+
+    def test_variables(self):
+        compiled = self.engine.compile(self.template)
+        assert compiled.variables == frozenset(['countries', 'document'])
+        assert self.engine.variables(self.template) is compiled.variables
+
+    def test_lazy_variables(self):
+        calls = []
+
+        def provider(name, value):
+            def provide():
+                calls.append(name)
+                return value
+            return provide
+
+        countries = [{'country': 'Lazyland'}]
+        document = self.engine.render(
+            self.template,
+            countries=LazyVariable(provider('countries', countries)),
+            unused=LazyVariable(provider('unused', 'never')))
+
+        content = zipfile.ZipFile(io.BytesIO(document)).read('content.xml')
+        assert b'Lazyland' in content
+        assert calls == ['countries']
+
+    def test_merged_lazy_variables(self):
+        calls = []
+
+        def provider(index):
+            calls.append(index)
+            return [{'country': 'country %d' % index}]
+
+        contexts = [{'countries': LazyVariable(lambda i=i: provider(i))}
+                    for i in range(3)]
+        document = self.engine.render_merged(self.template, contexts)
+        content = zipfile.ZipFile(io.BytesIO(document)).read('content.xml')
+        assert calls == [0, 1, 2]
+        assert all(b'Country %d' % i in content for i in range(3))
+
+
+class RenderContextTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.template = os.path.join(root, 'simple_template.odt')
+        self.engine = Renderer()
+
+    def test_filters_reach_render_context(self):
+        contexts = []
+
+        @jinja2.contextfilter
+        def capture(context, value):
+            contexts.append(RenderContext.of(context))
+            return value
+
+        self.engine.environment.filters['title'] = capture
+        self.engine.render(self.template, countries=[{'country': 'chile'}])
+
+        assert contexts and isinstance(contexts[0], RenderContext)
+        assert self.engine.render_context is None
+
+    def test_documents_copied_only_when_changed(self):
+        contexts = []
+
+        @jinja2.contextfilter
+        def capture(context, value):
+            contexts.append(RenderContext.of(context))
+            return value
+
+        self.engine.environment.filters['title'] = capture
+        countries = [{'country': 'chile'}]
+        document = zipfile.ZipFile(io.BytesIO(
+            self.engine.render(self.template, countries=countries)))
+
+        # Nothing changed content.xml out of its office:body, nor the manifest
+        assert contexts[0]._content is None
+        assert contexts[0]._manifest is None
+        assert document.read('META-INF/manifest.xml') == zipfile.ZipFile(
+            self.template).read('META-INF/manifest.xml')
+        parseString(document.read('content.xml'))
+
+    def test_styles_added_without_copying_automatic_styles(self):
+        compiled = self.engine.compile(self.template)
+        template_style = compiled._automatic_styles.getElementsByTagName(
+            'style:style')[0].getAttribute('style:name')
+        render_context = RenderContext(self.engine, compiled)
+
+        name = render_context.register_style(**{'fo:font-weight': 'bold'})
+        assert render_context.register_style(template_style) == template_style
+        assert render_context._auto_styles is None
+        assert render_context._content is None
+
+        head, tail = render_context.content_parts()
+        styles = parseString(head + '<office:body/>' + tail
+                             ).getElementsByTagName('style:style')
+        names = [style.getAttribute('style:name') for style in styles]
+        assert names.count(name) == 1 and names[-1] == name
+        assert names[:-1] == sorted(compiled._style_names, key=names.index)
+
+        # Styles of the template are copied before being returned
+        style = render_context.get_style_by_name(template_style)
+        assert style.parentNode is render_context._auto_styles
+        assert style.parentNode is not compiled._automatic_styles
+        assert render_context.content_parts()[0] == head
+
+    def test_render_state_outside_render(self):
+        with self.assertRaises(AttributeError):
+            self.engine.files
+
+    def test_register_style(self):
+        compiled = self.engine.compile(self.template)
+        render_context = RenderContext(self.engine, compiled)
+        bold = {'fo:font-weight': 'bold'}
+
+        name = render_context.register_style(**bold)
+        assert render_context.register_style(**bold) == name
+        assert render_context.register_style(
+            **{'fo:font-style': 'italic'}) != name
+        assert render_context.register_style('strong', **bold) == 'strong'
+        assert render_context.register_style('strong') == 'strong'
+
+        styles = [node.getAttribute('style:name') for node in
+                  render_context.content.getElementsByTagName('style:style')]
+        assert styles.count(name) == styles.count('strong') == 1
+        assert render_context.get_style_by_name(name) is \
+            render_context.content.getElementsByTagName('style:style')[
+                styles.index(name)]
+        assert render_context.get_style_by_name('missing') is None
+
+    def test_concurrent_renders(self):
+        names = ['country %d' % i for i in range(8)]
+        expected = dict(
+            (name, archive_members(self.engine.render(
+                self.template, countries=[{'country': name}])))
+            for name in names
+        )
+        results = {}
+
+        def render(name):
+            results[name] = archive_members(self.engine.render(
+                self.template, countries=[{'country': name}]))
+
+        threads = [threading.Thread(target=render, args=(name,))
+                   for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == expected
+
+
+class MediaTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.media_path = os.path.join(root, 'samples', 'images')
+        self.template = os.path.join(self.media_path, 'template.odt')
+        self.image = os.path.join(self.media_path, 'writer.png')
+
+    def test_media_added_once(self):
+        engine = Renderer()
+        context = RenderContext(engine, engine.compile(self.template))
+        with open(self.image, 'rb') as image:
+            data = image.read()
+
+        paths = set()
+        for i in range(3):
+            paths.add(context.add_media_to_archive(open(self.image, 'rb'),
+                                                   'image/png'))
+            paths.add(context.add_media_to_archive(io.BytesIO(data),
+                                                   'image/png'))
+
+        entries = [entry for entry in context.manifest.getElementsByTagName(
+            'manifest:file-entry')
+            if entry.getAttribute('manifest:full-path') in paths]
+
+        assert len(paths) == 1 and len(entries) == 1
+        assert context.files[paths.pop()] == data
+
+    def test_media_with_same_name_and_other_content(self):
+        engine = Renderer()
+
+        @engine.media_loader
+        def loader(value, *args, **kwargs):
+            media = io.BytesIO(value.encode('utf-8'))
+            media.name = 'photo.png'
+            return media, 'image/png'
+
+        document = zipfile.ZipFile(io.BytesIO(engine.render(
+            images_template(self.template), images=['first', 'second'])))
+        pictures = [document.read(name) for name in document.namelist()
+                    if name.startswith('Pictures/') and
+                    name.endswith('.png')]
+
+        assert b'first' in pictures and b'second' in pictures
+
+    def test_media_cache(self):
+        engine = Renderer(media_path=self.media_path, media_cache_entries=8)
+        first = engine.render(self.template, image='writer.png')
+        second = engine.render(self.template, image='writer.png')
+        info = engine.media_cache.info()
+
+        assert (info.hits, info.misses, info.entries) == (1, 1, 1)
+        assert info.size == os.path.getsize(self.image)
+        for document in (first, second):
+            document = zipfile.ZipFile(io.BytesIO(document))
+            pictures = [name for name in document.namelist()
+                        if name.startswith('Pictures/') and
+                        name.endswith('.png')]
+            with open(self.image, 'rb') as image:
+                assert image.read() in [document.read(name)
+                                        for name in pictures]
+
+
+class ConcurrentMediaTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.media_path = os.path.join(root, 'samples', 'images')
+        self.template = images_template(
+            os.path.join(self.media_path, 'template.odt'))
+        self.images = ['image %d' % i for i in range(12)]
+
+    def render(self, loader, **options):
+        engine = Renderer(**options)
+        engine.media_loader(loader)
+        document = zipfile.ZipFile(io.BytesIO(
+            engine.render(self.template, images=self.images)))
+        content = document.read('content.xml').decode('utf-8')
+        return re.findall(r'draw:name="([^"]*)"', content)
+
+    def test_images_in_document_order(self):
+        threads = set()
+
+        def loader(value, *args, **kwargs):
+            threads.add(threading.current_thread())
+            time.sleep(0.01 * (len(self.images) - self.images.index(value)))
+            return (io.BytesIO(value.encode('utf-8')), 'image/png')
+
+        assert self.render(loader) == self.images
+        assert len(threads) == 1
+        threads.clear()
+        assert self.render(loader, media_workers=4) == self.images
+        assert len(threads) == 4
+        assert self.render(loader, media_workers=4, streaming=True) == \
+            self.images
+
+    def test_media_timeout(self):
+        def loader(value, *args, **kwargs):
+            time.sleep(0.2)
+
+        with self.assertRaises(SecretaryError):
+            self.render(loader, media_workers=2, media_timeout=0.01)
+        for streaming in (False, True):
+            with self.assertRaises(SecretaryError):
+                self.render(loader, media_timeout=0.01, streaming=streaming)
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.template = os.path.join(root, 'simple_template.odt')
+        self.countries = [{'country': 'country %d' % i} for i in range(5)]
+
+    def test_render_with_stats(self):
+        engine = Renderer()
+        document, stats = engine.render_with_stats(self.template,
+                                                   countries=self.countries)
+
+        assert archive_members(document) == archive_members(
+            engine.render(self.template, countries=self.countries))
+        assert list(stats.stages) == ['unpack', 'prepare', 'unescape',
+                                      'compile', 'render', 'validate', 'pack']
+        assert stats['render'].calls == 2
+        assert stats['prepare'].counters['fields'] == stats.counters['fields']
+        assert stats['pack'].bytes_out == sum(
+            zinfo.compress_size for zinfo in
+            zipfile.ZipFile(io.BytesIO(document)).infolist())
+        assert stats.wall_time >= sum(stage.wall_time
+                                      for stage in stats.stages.values())
+
+        document, stats = engine.render_with_stats(self.template,
+                                                   countries=self.countries)
+        assert stats.counters == {'cached': 1}
+        assert 'unpack' not in stats.stages
+
+    def test_observers(self):
+        events = []
+
+        class Observer(secretary.RenderObserver):
+            def on_stage_start(self, stage, stats):
+                events.append(('start', stage.name))
+
+            def on_stage_end(self, stage, stats):
+                events.append(('end', stage.name))
+
+            def on_render_end(self, stats):
+                events.append(('render', stats.wall_time > 0))
+
+        engine = Renderer(observers=[Observer()], trace_memory=True)
+        engine.render(self.template, countries=self.countries)
+
+        assert events[:2] == [('start', 'unpack'), ('end', 'unpack')]
+        assert events[-1] == ('render', True)
+        assert events.count(('start', 'render')) == 2
+        assert events.count(('end', 'render')) == 2
+
+
+    def test_trace_memory_of_concurrent_renders(self):
+        import tracemalloc
+        engine = Renderer(trace_memory=True)
+        document, stats = engine.render_with_stats(self.template,
+                                                   countries=self.countries)
+        assert stats['render'].peak_memory > 0
+        assert not tracemalloc.is_tracing()
+
+        started, errors = threading.Event(), []
+
+        class Observer(secretary.RenderObserver):
+            def on_stage_start(self, stage, stats):
+                # Keep the first render running while the second starts
+                if not started.is_set():
+                    started.set()
+                    time.sleep(0.1)
+
+        def render():
+            try:
+                engine.render(self.template, countries=self.countries)
+            except Exception as error:
+                errors.append(error)
+
+        engine.observers.append(Observer())
+        thread = threading.Thread(target=render)
+        thread.start()
+        started.wait()
+        document, stats = engine.render_with_stats(self.template,
+                                                   countries=self.countries)
+        thread.join()
+
+        assert errors == []
+        assert stats['render'].peak_memory is None
+        assert not tracemalloc.is_tracing()
+
+class XMLBackendTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.templates = [
+            os.path.join(root, 'simple_template.odt'),
+            os.path.join(root, 'samples', 'images', 'template.odt'),
+        ]
+
+    def compiled_sources(self, xml_backend):
+        engine = Renderer(xml_backend=xml_backend, cache_entries=0)
+        for template in self.templates:
+            compiled = engine.compile(template)
+            yield compiled.content_source, compiled.styles_source
+
+    def test_etree_backend(self):
+        assert list(self.compiled_sources('etree')) == \
+            list(self.compiled_sources('minidom'))
+
+    def test_lxml_backend(self):
+        try:
+            from lxml import etree
+        except ImportError:
+            self.skipTest('lxml is not installed')
+
+        def c14n(source):
+            # Static parts have no source
+            return source and etree.tostring(
+                etree.fromstring(source.encode('utf-8')), method='c14n')
+
+        for sources, expected in zip(self.compiled_sources('lxml'),
+                                     self.compiled_sources('minidom')):
+            assert list(map(c14n, sources)) == list(map(c14n, expected))
+
+    def test_etree_serialization(self):
+        xml = ('<?xml version="1.0"?><a:r xmlns:a="urn:a" b="&amp;&quot;">'
+               '<!-- note -->&gt;"<a:e/>tail<a:c>text</a:c></a:r>').encode('utf-8')
+        etree_backend, minidom_backend = ElementTreeBackend(), MinidomBackend()
+
+        assert etree_backend.serialize(etree_backend.parse(xml)) == \
+            minidom_backend.serialize(minidom_backend.parse(xml))
+
+    def test_etree_without_comments_builder(self):
+        # TreeBuilder of Python < 3.8 builds no comments nor PIs
+        from xml.etree import ElementTree
+
+        class OldElementTree(object):
+            Comment = ElementTree.Comment
+            ProcessingInstruction = ElementTree.ProcessingInstruction
+
+            @staticmethod
+            def TreeBuilder():
+                return ElementTree.TreeBuilder()
+
+        xml = ('<r><?pi data?><!-- note -->text<e/><?alone?></r>'
+               ).encode('utf-8')
+        backend, old_backend = ElementTreeBackend(), ElementTreeBackend()
+        old_backend.etree = OldElementTree
+
+        assert old_backend.serialize(old_backend.parse(xml)) == \
+            backend.serialize(backend.parse(xml))
+
+    def test_prepare_document_tags(self):
+        # Sorted, as minidom writes them before Python 3.8
+        namespaces = (
+            'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+            'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+            'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0"')
+        row = ('<table:table-row><table:table-cell><text:p>%s</text:p>'
+               '</table:table-cell></table:table-row>')
+        xml = (
+            '<office:document-content %s><office:text><table:table>' % namespaces +
+            row % '<text:text-input text:description="table-row">{% for a in b %}</text:text-input>' +
+            row % 'x <text:text-input>{{ a }}</text:text-input> y' +
+            row % '<text:text-input text:description="table-row">{% endfor %}</text:text-input>' +
+            '</table:table>'
+            '<text:p><text:text-input>{% if c %}</text:text-input></text:p>'
+            '<text:p>c</text:p>'
+            '<text:p>d<text:text-input text:description="after::paragraph">{% endif %}</text:text-input></text:p>'
+            '</office:text></office:document-content>').encode('utf-8')
+        expected = (
+            '<?xml version="1.0" ?><office:document-content %s><office:text>'
+            '<table:table>{%% for a in b %%}' % namespaces +
+            row % 'x <text:span>{{ a }}</text:span> y' +
+            '{% endfor %}</table:table>{% if c %}<text:p>c</text:p>{% endif %}'
+            '</office:text></office:document-content>')
+
+        for xml_backend in ('minidom', 'etree'):
+            engine = Renderer(xml_backend=xml_backend)
+            document = engine.xml_backend.parse(xml)
+            engine._prepare_document_tags(document)
+            assert engine.xml_backend.serialize(document) == expected
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            Renderer(xml_backend='sax')
+
+
+class TemplateCacheTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.template = os.path.join(root, 'simple_template.odt')
+
+    def test_render_uses_cache(self):
+        engine = Renderer()
+        first = engine.render(self.template)
+        second = engine.render(self.template)
+        info = engine.cache.info()
+
+        assert archive_members(first) == archive_members(second)
+        assert (info.hits, info.misses, info.entries) == (1, 1, 1)
+
+    def test_file_objects_are_keyed_by_content(self):
+        engine = Renderer()
+        with open(self.template, 'rb') as template:
+            engine.render(template)
+        with open(self.template, 'rb') as template:
+            engine.render(template)
+
+        assert engine.cache.info().hits == 1
+
+    def test_disabled_cache(self):
+        engine = Renderer(cache_entries=0)
+        engine.render(self.template)
+        engine.render(self.template)
+
+        assert len(engine.cache) == 0
+
+    def test_lru_eviction(self):
+        class Entry(object):
+            size = 10
+
+        cache = LRUCache(max_entries=2, max_size=25)
+        cache.put('a', Entry())
+        cache.put('b', Entry())
+        cache.get('a')
+        cache.put('c', Entry())
+
+        assert 'a' in cache and 'c' in cache
+        assert 'b' not in cache
+        assert cache.info().size == 20
+
+    def test_pickled_caches_keep_their_limits(self):
+        engine = pickle.loads(pickle.dumps(Renderer(cache_entries=4,
+                                                    markdown_cache_entries=8)))
+
+        assert type(engine.cache) is TemplateCache
+        assert type(engine.markdown_cache) is LRUCache
+        assert isinstance(engine.media_cache, LRUCache) and \
+            not isinstance(engine.media_cache, TemplateCache)
+        assert (engine.cache.max_entries,
+                engine.markdown_cache.max_entries) == (4, 8)
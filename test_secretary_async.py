@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests of the asyncio support, Renderer.render_async and awaitable
+    variables and media. They need Python 3.5 or newer, and conftest.py
+    skips this module on older versions.
+"""
+
+import io
+import os
+import re
+import time
+import asyncio
+import zipfile
+import threading
+from unittest import TestCase
+from secretary import Renderer, LazyVariable
+from test_secretary import images_template
+
+
+class AsyncRows(object):
+    # An async iterator over rows, as an async DB cursor would be
+    def __init__(self, rows):
+        self.rows = iter(rows)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        for row in self.rows:
+            return asyncio.sleep(0, result=row)
+        raise StopAsyncIteration
+
+
+class AwaitableImage(object):
+    # Waits for a few turns of the event loop before returning the image
+    def __init__(self, value, turns=0, running=None, peak=None):
+        self.value = value
+        self.turns = turns
+        self.running = running if running is not None else []
+        self.peak = peak if peak is not None else [0]
+        self.threads = set()
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.threads.add(threading.current_thread())
+        if self.value not in self.running:
+            self.running.append(self.value)
+            self.peak[0] = max(self.peak[0], len(self.running))
+        if self.turns:
+            self.turns -= 1
+            return None
+
+        self.running.remove(self.value)
+        raise StopIteration((io.BytesIO(self.value.encode('utf-8')),
+                             'image/png'))
+
+
+def run_async(*coroutines):
+    """Runs coroutines in a new event loop, returning their results"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(asyncio.gather(*coroutines))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+class RenderAsyncTestCase(TestCase):
+    def setUp(self):
+        root = os.path.dirname(__file__)
+        self.template = os.path.join(root, 'simple_template.odt')
+        self.media_path = os.path.join(root, 'samples', 'images')
+        self.images_template = images_template(
+            os.path.join(self.media_path, 'template.odt'))
+
+    def test_render_async(self):
+        engine = Renderer(media_path=self.media_path)
+        images = ['writer.png'] * 3
+        document, = run_async(engine.render_async(
+            self.images_template, images=AsyncRows(images)))
+
+        content = zipfile.ZipFile(io.BytesIO(document)).read('content.xml')
+        assert re.findall(b'draw:name="([^"]*)"', content) == \
+            [b'writer.png'] * 3
+
+    def test_awaitable_lazy_variables(self):
+        async def countries():
+            await asyncio.sleep(0)
+            return [{'country': 'Asyncland'}]
+
+        engine = Renderer()
+        document, = run_async(engine.render_async(
+            self.template, countries=LazyVariable(countries)))
+        content = zipfile.ZipFile(io.BytesIO(document)).read('content.xml')
+        assert b'Asyncland' in content
+
+    def test_async_media_loader(self):
+        images = ['image %d' % i for i in range(12)]
+        running, peak = [], [0]
+
+        def render(**options):
+            engine = Renderer(**options)
+            engine.media_loader(lambda value, *args, **kwargs:
+                                AwaitableImage(value, 3, running, peak))
+            self.images_template.seek(0)
+            document = zipfile.ZipFile(io.BytesIO(
+                engine.render(self.images_template, images=images)))
+            content = document.read('content.xml').decode('utf-8')
+            return re.findall(r'draw:name="([^"]*)"', content)
+
+        assert render(media_workers=3) == images
+        assert peak == [3]
+        assert render() == images
+
+    def test_async_media_loader_runs_in_caller_loop(self):
+        loaded = []
+
+        def loader(value, *args, **kwargs):
+            loaded.append(AwaitableImage(value))
+            return loaded[-1]
+
+        engine = Renderer(media_workers=2)
+        engine.media_loader(loader)
+        document, = run_async(engine.render_async(
+            self.images_template, images=['a', 'b', 'c']))
+        document = zipfile.ZipFile(io.BytesIO(document))
+
+        assert set().union(*(image.threads for image in loaded)) == \
+            set([threading.current_thread()])
+        assert sorted(document.read(name) for name in document.namelist()
+                      if name.startswith('Pictures/') and
+                      name.endswith('.png'))[:3] == [b'a', b'b', b'c']
+
+    def test_concurrency_limit(self):
+        running, peak = [], [0]
+
+        def slow(value):
+            running.append(value)
+            peak[0] = max(peak[0], len(running))
+            time.sleep(0.05)
+            running.remove(value)
+            return value
+
+        engine = Renderer(async_renders=2)
+        engine.environment.filters['title'] = slow
+
+        documents = run_async(*[engine.render_async(
+            self.template, countries=[{'country': 'country %d' % i}])
+            for i in range(5)])
+
+        assert len(documents) == 5
+        assert peak == [2]